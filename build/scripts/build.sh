@@ -17,6 +17,11 @@ script_base="$(realpath "$dir")"
 
 IFS=@ read -r task subarch distro version <<< "$1"
 
+if [[ "$task" == "stop-worker" ]]; then
+    (set -x; $DOCKER rm -f $WORKER)
+    exit $?
+fi
+
 SRC="${SRC/#\~/$HOME}"
 SRC=$(realpath "$SRC")
 
@@ -71,18 +76,21 @@ else
     exit 1
 fi
 
-cmd="$DOCKER run --rm "
+# Options for starting a container go in run_opts, everything in cmd can
+# also be passed to exec, for running in a worker container.
+cmd=""
+run_opts=""
 
 if [[ -t 0 ]]; then
     cmd+="-it "
 fi
 
-cmd+="-h $(hostname) "
-cmd+="--network none "
+run_opts+="-h $(hostname) "
+run_opts+="--network none "
 cmd+="-w /linux "
-cmd+="-v $SRC:/linux:ro,z "
+run_opts+="-v $SRC:/linux:ro,z "
 
-cmd+="$alternate_binds "
+run_opts+="$alternate_binds "
 cmd+="-e ARCH=$arch "
 
 if [[ -n $JFACTOR ]]; then
@@ -121,6 +129,14 @@ if [[ -n $MODULES ]]; then
     cmd+="-e MODULES=$MODULES "
 fi
 
+if [[ -n $ARTIFACTS ]]; then
+    cmd+="-e ARTIFACTS=$ARTIFACTS "
+fi
+
+if [[ -n $MODULES_FORMATS ]]; then
+    cmd+="-e MODULES_FORMATS=$MODULES_FORMATS "
+fi
+
 if [[ -n $cross ]]; then
     cmd+="-e CROSS_COMPILE=$cross "
 fi
@@ -184,6 +200,10 @@ fi
 	cmd+="-e MOD2YES=1 "
     fi
 
+    if [[ -n "$CONFIG_ONLY" ]]; then
+	cmd+="-e CONFIG_ONLY=1 "
+    fi
+
     if [[ -n "$CLANG" ]]; then
         cmd+="-e CLANG=1 "
     fi
@@ -205,19 +225,48 @@ if [[ -n $TARGETS ]]; then
     cmd+="-e TARGETS=$TARGETS "
 fi
 
-output_dir=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG" "")
-output_symlink=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG" "symlink")
-mkdir -p "$output_dir" || exit 1
+if [[ -n "$WORKER" && "$task" != "start-worker" ]]; then
+    if ! $DOCKER container inspect $WORKER > /dev/null 2>&1; then
+        echo "## Worker $WORKER not running, using a new container"
+        WORKER=""
+    fi
+fi
 
-cmd+="-v $output_dir:/output:rw,z "
+if [[ "$task" == "start-worker" ]]; then
+    # The worker must be started with everything it'll build into bind
+    # mounted at the same path, eg. via DOCKER_EXTRA_ARGS.
+    if [[ -z "$WORKER" || -z "$CI_OUTPUT" ]]; then
+        echo "Error: set WORKER and CI_OUTPUT to start a worker" >&2
+        exit 1
+    fi
+    user=$(stat -c "%u:%g" $CI_OUTPUT)
+    container_output=""
+else
+    output_dir=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG" "")
+    output_symlink=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG" "symlink")
+    mkdir -p "$output_dir" || exit 1
+
+    if [[ -n "$WORKER" ]]; then
+        container_output="$output_dir"
+        cmd+="-e OUTPUT=$output_dir "
+    else
+        container_output="/output"
+        run_opts+="-v $output_dir:/output:rw,z "
+    fi
+
+    user=$(stat -c "%u:%g" $output_dir)
+fi
 
-user=$(stat -c "%u:%g" $output_dir)
 cmd+="-u $user "
 
 if [[ -n "$CCACHE" ]]; then
-    cmd+="-v $CCACHE:/ccache:z "
+    run_opts+="-v $CCACHE:/ccache:z "
     cmd+="-e CCACHE_DIR=/ccache "
     cmd+="-e CCACHE=1 "
+    if [[ -n "$container_output" ]]; then
+        # Per build stats, the totals in /ccache are shared by concurrent builds
+        cmd+="-e CCACHE_STATSLOG=$container_output/ccache-stats.log "
+    fi
 fi
 
 if [[ -r /etc/timezone ]]; then
@@ -227,10 +276,14 @@ fi
 if [[ -n "$DOCKER_EXTRA_ARGS" ]]; then
     # Can be used for eg. a rootdisk.
     # DOCKER_EXTRA_ARGS="-v /path/to/rootdisk:/path/to/rootdisk:ro"
-    cmd+="$DOCKER_EXTRA_ARGS "
+    run_opts+="$DOCKER_EXTRA_ARGS "
 fi
 
-cmd+="$PODMAN_OPTS "
+run_opts+="$PODMAN_OPTS "
+
+# Run the scripts from this tree, not the copies baked into the image, which
+# may be older, eg. if the image was pulled or built by an older version.
+run_opts+="-v $script_base:/scripts:ro,z "
 
 if [[ -z "$version" ]]; then
     # NB, after we passed $version to get_output_dir()
@@ -239,10 +292,17 @@ fi
 
 image="linuxppc/build:$distro-$version"
 
-cmd+="$image "
-cmd+="/bin/container-build.sh $task"
+if [[ "$task" == "start-worker" ]]; then
+    cmd="$DOCKER run -d --rm --name $WORKER $run_opts $cmd $image sleep infinity"
+elif [[ -n "$WORKER" ]]; then
+    cmd="$DOCKER exec $cmd $WORKER /scripts/container-build.sh $task"
+else
+    cmd="$DOCKER run --rm $run_opts $cmd $image /scripts/container-build.sh $task"
+fi
 
-echo "## output        = $output_dir"
+if [[ -n "$output_dir" ]]; then
+    echo "## output        = $output_dir"
+fi
 
 (set -x; $cmd)
 
@@ -2,6 +2,9 @@
 
 JFACTOR=${JFACTOR:-1}
 
+# Run from the image's /bin, or bind mounted from the host's build/scripts
+script_dir="$(dirname "$0")"
+
 gcc_version=$(${CROSS_COMPILE}gcc --version | head -1)
 ld_version=$(${CROSS_COMPILE}ld --version | head -1)
 
@@ -26,7 +29,9 @@ if [[ -n "$KBUILD_EXTRA_WARN" ]]; then
     echo "## EXTRA_WARN    = $KBUILD_EXTRA_WARN"
 fi
 
-export KBUILD_OUTPUT=/output
+# Where to build, /output unless running in a long lived worker container
+OUTPUT=${OUTPUT:-/output}
+export KBUILD_OUTPUT=$OUTPUT
 
 if [[ -n "$QUIET" ]]; then
     quiet="-s"
@@ -36,6 +41,12 @@ if [[ -n "$VERBOSE" ]]; then
     verbose="V=1"
 fi
 
+# Optional outputs to produce, eg. "modules,compile_commands", or all if unset
+function want_artifact()
+{
+    [[ -z "$ARTIFACTS" || ",$ARTIFACTS," == *",$1,"* ]]
+}
+
 rc=0
 
 if [[ "$1" == "kernel" ]]; then
@@ -60,10 +71,10 @@ if [[ "$1" == "kernel" ]]; then
 
     if [[ -n "$CUSTOM_CONFIG" ]]
     then
-    	cp /config.txt /output/.config
+    	cp /config.txt $OUTPUT/.config
     elif [[ "$DEFCONFIG" == .config* || "$DEFCONFIG" == *.config ]]; then
         echo "## Using existing config $DEFCONFIG"
-        cp -f "$DEFCONFIG" /output/.config || exit 1
+        cp -f "$DEFCONFIG" $OUTPUT/.config || exit 1
     else
         # Strip off any suffix after the first '+' used for unique naming
         DEFCONFIG="${DEFCONFIG%%+*}"
@@ -78,8 +89,8 @@ if [[ "$1" == "kernel" ]]; then
         IFS=',' read -r -a configs <<< "$MERGE_CONFIG"
 
         # merge_config.sh always writes its TMP files to $PWD, so we have to
-        # change into /output before running it.
-        (cd /output; set -x; /linux/scripts/kconfig/merge_config.sh -m .config ${configs[@]})
+        # change into the output directory before running it.
+        (cd $OUTPUT; set -x; /linux/scripts/kconfig/merge_config.sh -m .config ${configs[@]})
         (set -x; make $verbose $quiet $llvm "$cc" olddefconfig)
     fi
 
@@ -89,13 +100,18 @@ if [[ "$1" == "kernel" ]]; then
         (set -x; make $verbose $quiet $llvm "$cc" mod2yesconfig)
     fi
 
+    if [[ -n "$CONFIG_ONLY" ]]; then
+        echo "## Config only, not building"
+        exit $rc
+    fi
+
     if [[ -n "$REPRODUCIBLE" ]]; then
         # Check for options that defeat reproducible builds
         grep \
             -e CONFIG_IKCONFIG=y \
             -e CONFIG_LOCALVERSION_AUTO=y \
             -e CONFIG_IKHEADERS=y \
-            /output/.config
+            $OUTPUT/.config
         if [[ $? -eq 0 ]]; then
             echo "!! Reproducible build specified, but the above options may prevent reproducibility."
         fi
@@ -103,14 +119,14 @@ if [[ "$1" == "kernel" ]]; then
 
     if [[ $rc -eq 0 ]]; then
         if [[ -n "$SPARSE" ]]; then
-            rm -f /output/sparse.log
-            touch /output/sparse.log
-            (set -x; make C=$SPARSE CF=">> /output/sparse.log 2>&1" $verbose $quiet $llvm "$cc" -j $JFACTOR)
+            rm -f $OUTPUT/sparse.log
+            touch $OUTPUT/sparse.log
+            (set -x; make C=$SPARSE CF=">> $OUTPUT/sparse.log 2>&1" $verbose $quiet $llvm "$cc" -j $JFACTOR)
 
             rc=$?
 
             if [[ $rc -eq 0 && -x arch/powerpc/tools/check-sparse-log.sh ]]; then
-                arch/powerpc/tools/check-sparse-log.sh /output/sparse.log
+                arch/powerpc/tools/check-sparse-log.sh $OUTPUT/sparse.log
                 rc=$?
             fi
         else
@@ -119,19 +135,19 @@ if [[ "$1" == "kernel" ]]; then
         fi
     fi
 
-    if [[ $rc -eq 0 && -n "$MODULES" ]]; then
-        if grep CONFIG_MODULES=y /output/.config > /dev/null; then
+    if [[ $rc -eq 0 && -n "$MODULES" ]] && want_artifact modules; then
+        if grep CONFIG_MODULES=y $OUTPUT/.config > /dev/null; then
             echo "## Installing modules"
 
-            mod_path=/output/modules
+            mod_path=$OUTPUT/modules
             # Clean out any old modules
             rm -rf $mod_path
 
             (set -x; make $verbose $quiet -j $JFACTOR $llvm "$cc" INSTALL_MOD_PATH=$mod_path modules_install)
             rc=$?
             if [[ $rc -eq 0 ]]; then
-                tar -cjf /output/modules.tar.bz2 -C $mod_path lib
-                tar -czf /output/modules.tar.gz -C $mod_path lib
+                (set -x; "$script_dir/tarball.sh" $mod_path lib $OUTPUT/modules "${MODULES_FORMATS:-zst,gz}")
+                rc=$?
             fi
         else
             echo "## Modules not configured"
@@ -140,10 +156,12 @@ if [[ "$1" == "kernel" ]]; then
 
     echo "## Kernel build completed rc = $rc"
 
-    /linux/scripts/clang-tools/gen_compile_commands.py -o /output/compile_commands.json /output > /dev/null 2>&1 || true
+    if want_artifact compile_commands; then
+        /linux/scripts/clang-tools/gen_compile_commands.py -o $OUTPUT/compile_commands.json $OUTPUT > /dev/null 2>&1 || true
+    fi
 
-    if [[ -f /output/vmlinux ]]; then
-        size /output/vmlinux
+    if [[ -f $OUTPUT/vmlinux ]]; then
+        size $OUTPUT/vmlinux
     fi
 
     if [[ "$CCACHE" -eq 1 ]]; then
@@ -154,18 +172,18 @@ if [[ "$1" == "kernel" ]]; then
         (set -x; make $verbose $quiet $llvm "$cc" clean)
     fi
 elif [[ "$1" == "docs" ]]; then
-    (set -x -o pipefail; make $verbose $quiet -j $JFACTOR htmldocs 2>&1 | tee /output/docs.log)
+    (set -x -o pipefail; make $verbose $quiet -j $JFACTOR htmldocs 2>&1 | tee $OUTPUT/docs.log)
     rc=$?
 
     if [[ $rc -eq 0 ]]; then
-        grep -i "\bpowerpc\b.*warning" /output/docs.log
+        grep -i "\bpowerpc\b.*warning" $OUTPUT/docs.log
         if [[ $? -eq 0 ]]; then
             echo "## Error, saw powerpc errors/warnings in docs build!"
             rc=1
         fi
     fi
 elif [[ "$1" == "perf" ]]; then
-    cmd="make $quiet -C tools/perf O=/output"
+    cmd="make $quiet -C tools/perf O=$OUTPUT"
 
     if [[ $(uname -m) != "ppc64le" || $CROSS_COMPILE == "powerpc64-linux-gnu-" ]]; then
         cmd+=" NO_LIBELF=1 NO_LIBTRACEEVENT=1"
@@ -199,7 +217,7 @@ else
 
     if [[ -n "$INSTALL" ]]; then
        echo "## INSTALL       = $INSTALL"
-       cmd+=" INSTALL_PATH=/output/install install"
+       cmd+=" INSTALL_PATH=$OUTPUT/install install"
     fi
 
     which dpkg-query > /dev/null 2>&1
@@ -216,7 +234,7 @@ else
     (set -x; $cmd)
     rc=$?
     echo "## Selftest build completed rc = $rc"
-    bins=$(find /output ! -path "/output/install/*" -type f -perm -u+x | wc -l)
+    bins=$(find $OUTPUT ! -path "$OUTPUT/install/*" -type f -perm -u+x | wc -l)
     echo "## Found $bins binaries"
 
     if [[ -n "$POST_CLEAN" ]]; then
@@ -45,6 +45,10 @@ if [[ "$task" == "image" ]]; then
     if [[ -n "$exists" ]]; then
         exit 0
     fi
+elif [[ "$task" == "image-id" ]]; then
+    # Changes whenever the image is rebuilt or pulled, so is used to key caches
+    $DOCKER image inspect --format '{{.Id}}' $image
+    exit $?
 elif [[ "$task" == "pull-image" ]]; then
     arch_image="$image-$(uname -m)"
     cmd="$DOCKER pull ghcr.io/$arch_image"
@@ -42,6 +42,8 @@ function get_output_dir()
     case "$task" in
         kernel) ;&
         prune-kernel) ;&
+        export-kernel) ;&
+        clean-artifacts) ;&
         clean-kernel)
 	    if [[ -n "$symlink" ]]; then
 		echo "$d/latest-kernel"
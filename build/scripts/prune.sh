@@ -13,6 +13,10 @@ IFS=@ read -r task subarch distro version <<< "$1"
 
 output_dir=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG")
 
+kernel_artifacts=".config vmlinux System.map arch/powerpc/boot/zImage include/config/kernel.release \
+                  arch/powerpc/kernel/asm-offsets.s arch/powerpc/boot/uImage modules.tar.zst \
+                  modules.tar.gz sparse.log log.txt ccache-stats.log compile_commands.json"
+
 case "$task" in
     prune-kernel)
         if [[ ! -e "$output_dir/Makefile" ]]; then
@@ -25,9 +29,7 @@ case "$task" in
         set -euo pipefail
         cd "$output_dir"
         mkdir -p "artifacts"
-        for path in .config vmlinux System.map arch/powerpc/boot/zImage include/config/kernel.release \
-                    arch/powerpc/kernel/asm-offsets.s arch/powerpc/boot/uImage modules.tar.bz2 \
-                    modules.tar.gz sparse.log log.txt
+        for path in $kernel_artifacts
         do
             if [[ -e "$path" ]]; then
                 mv "$path" artifacts/
@@ -38,6 +40,44 @@ case "$task" in
         mv artifacts/* .
         rmdir artifacts
         ;;
+    export-kernel)
+        # Copy the artifacts out, leaving the build tree intact for next time
+        if [[ -z "$EXPORT_DIR" ]]; then
+            echo "Error: set EXPORT_DIR to export to" >&2
+            exit 1
+        fi
+
+        echo "Exporting outputs from $output_dir to $EXPORT_DIR"
+
+        set -euo pipefail
+        cd "$output_dir"
+        mkdir -p "$EXPORT_DIR"
+        for path in $kernel_artifacts
+        do
+            if [[ -e "$path" ]]; then
+                cp -f "$path" "$EXPORT_DIR/"
+            fi
+        done
+        if [[ -e "$EXPORT_DIR/.config" ]]; then
+            mv "$EXPORT_DIR/.config" "$EXPORT_DIR/config"
+        fi
+        ;;
+    clean-artifacts)
+        # Remove the outputs of the last build but keep its objects, so a
+        # build starting from them can't ship them as its own.
+        if [[ ! -d "$output_dir" ]]; then
+            exit 0
+        fi
+
+        set -euo pipefail
+        cd "$output_dir"
+        for path in $kernel_artifacts
+        do
+            if [[ "$path" != ".config" ]]; then
+                rm -f "$path"
+            fi
+        done
+        ;;
     prune-selftests)
         if [[ ! -e "$output_dir/kselftest" ]]; then
             # Assume it's already been pruned
@@ -50,9 +90,9 @@ case "$task" in
         cd "$output_dir"
         if [[ -d install ]]; then
             mv install selftests
-            tar -czf selftests.tar.gz selftests
+            "$script_base/tarball.sh" . selftests selftests "${SELFTESTS_FORMATS:-gz}"
         fi
-        find . -not -path "./selftests.tar.gz" -delete
+        find . -not -path "./selftests.tar.*" -delete
         ;;
     *)
         (set -x ; rm -rf "$output_dir")
@@ -0,0 +1,94 @@
+#!/bin/bash
+#
+# Write a tarball of <path>, relative to <dir>, in each of a comma separated
+# list of formats, reading the tree only once.
+#
+# eg. tarball.sh /output/modules lib /output/modules zst,gz
+#     writes /output/modules.tar.zst and /output/modules.tar.gz
+
+if [[ $# -ne 4 ]]; then
+    echo "Usage: $0 <dir> <path> <output base> <formats>" >&2
+    exit 1
+fi
+
+dir="$1"
+path="$2"
+base="$3"
+formats="$4"
+
+function get_compressor()
+{
+    case "$1" in
+        zst)
+            if command -v zstd > /dev/null; then
+                echo "zstd -q -T0"
+            fi
+            ;;
+        gz)
+            if command -v pigz > /dev/null; then
+                echo "pigz"
+            else
+                echo "gzip"
+            fi
+            ;;
+        bz2)
+            if command -v pbzip2 > /dev/null; then
+                echo "pbzip2"
+            else
+                echo "bzip2"
+            fi
+            ;;
+        xz)
+            echo "xz -T0"
+            ;;
+    esac
+}
+
+tmp_dir=$(mktemp -d)
+trap "rm -rf $tmp_dir" EXIT
+
+# Each compressor reads from a fifo, which tee feeds from a single tar
+fifos=()
+pids=()
+outputs=()
+for format in ${formats//,/ }
+do
+    compressor=$(get_compressor $format)
+    if [[ -z "$compressor" ]]; then
+        echo "Warning: no compressor for $format, not writing $base.tar.$format" >&2
+        continue
+    fi
+
+    fifo="$tmp_dir/$format"
+    mkfifo "$fifo"
+    $compressor < "$fifo" > "$base.tar.$format" &
+    pids+=($!)
+    fifos+=("$fifo")
+    outputs+=("$base.tar.$format")
+done
+
+if [[ ${#fifos[@]} -eq 0 ]]; then
+    # Better a gzip tarball than none at all
+    echo "Warning: no compressor for any of '$formats', writing $base.tar.gz" >&2
+    fifo="$tmp_dir/gz"
+    mkfifo "$fifo"
+    $(get_compressor gz) < "$fifo" > "$base.tar.gz" &
+    pids+=($!)
+    fifos+=("$fifo")
+    outputs+=("$base.tar.gz")
+fi
+
+set -o pipefail
+tar -cf - -C "$dir" "$path" | tee "${fifos[@]}" > /dev/null
+rc=$?
+
+for pid in "${pids[@]}"
+do
+    wait $pid || rc=1
+done
+
+if [[ $rc -ne 0 ]]; then
+    rm -f "${outputs[@]}"
+fi
+
+exit $rc
@@ -12,6 +12,11 @@ if [[ "$major" -ge 21 ]]; then
     PACKAGES+=" clang llvm"
 fi
 
+# Older zstd doesn't support -T
+if [[ "$major" -ge 18 ]]; then
+    PACKAGES+=" zstd"
+fi
+
 if [[ "$machine" == "ppc64le" ]]; then
     PACKAGES+=" libcap-dev"
     PACKAGES+=" libcap-ng-dev"
@@ -381,10 +381,12 @@ class BasicBoot:
 
         if args.modules_path and self.install_modules:
             logging.info("Copying modules ...")
-            run(['scp', args.modules_path, f'{self.host_ssh_target}:/var/tmp/ngci-modules.tar.bz2'], check=True, timeout=minutes(5))
+            # Keep the extension, it's whatever format the tarball was made in
+            remote_path = f'/var/tmp/ngci-{os.path.basename(args.modules_path)}'
+            run(['scp', args.modules_path, f'{self.host_ssh_target}:{remote_path}'], check=True, timeout=minutes(5))
             cmds.extend([
                 'cd /lib/modules',
-                'tar --strip-components=2 -xf /var/tmp/ngci-modules.tar.bz2',
+                f'tar --strip-components=2 -xf {remote_path}',
                 'sync',
                ]
             )
@@ -1,25 +1,329 @@
+import argparse
+import csv
+import json
 import os
 import logging
+import mmap
 import struct
 import subprocess
+import sys
+from array import array
+from bisect import bisect_right
+from hashlib import sha1
+from operator import add
 from subprocess import check_output
-from utils import get_endian
 
 
-def read_symbols(vmlinux_path):
-    last_function = ''
-    last_addr = 0
+EM_PPC = 20
+EM_PPC64 = 21
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_NOBITS = 8
+
+NT_GNU_BUILD_ID = 3
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+SHN_UNDEF = 0
+SHN_ABS = 0xfff1
+SHN_COMMON = 0xfff2
+
+STB_LOCAL = 0
+STB_WEAK = 2
+
+STT_OBJECT = 1
+STT_SECTION = 3
+STT_FILE = 4
+
+
+class ElfSection:
+    def __init__(self, name, sh_type, flags, addr, offset, size, link, entsize):
+        self.name = name
+        self.type = sh_type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.entsize = entsize
+
+    def contains(self, start_vaddr, end_vaddr):
+        return start_vaddr >= self.addr and end_vaddr <= self.addr + self.size
+
+    def __repr__(self):
+        return f'ElfSection({self.name}, addr={self.addr:x}, offset={self.offset:x}, size={self.size:x})'
+
+
+class ElfFile:
+    # Reads sections and symbols straight from an ELF (32 or 64-bit, either
+    # endian), over an mmap of the file, rather than running nm/objdump.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.map)
+
+        ident = bytes(self.data[:16])
+        if len(ident) < 16 or ident[:4] != b'\x7fELF':
+            raise Exception(f'Not an ELF? {path}')
+
+        if ident[4] == 1:
+            self.bits = 32
+        elif ident[4] == 2:
+            self.bits = 64
+        else:
+            raise Exception(f'Unknown ELF class {ident[4]} in {path}')
+
+        if ident[5] == 1:
+            self.endian = 'little'
+            self.prefix = '<'
+        elif ident[5] == 2:
+            self.endian = 'big'
+            self.prefix = '>'
+        else:
+            raise Exception(f'Unknown endian {ident[5]} in {path}')
+
+        self.machine, = self.unpack_from('H', 0x12)
+
+        if self.bits == 64:
+            shoff, = self.unpack_from('Q', 0x28)
+            shentsize, shnum, shstrndx = self.unpack_from('HHH', 0x3a)
+            shdr_fmt = 'IIQQQQIIQQ'
+        else:
+            shoff, = self.unpack_from('I', 0x20)
+            shentsize, shnum, shstrndx = self.unpack_from('HHH', 0x2e)
+            shdr_fmt = 'IIIIIIIIII'
+
+        headers = []
+        for i in range(shnum):
+            headers.append(self.unpack_from(shdr_fmt, shoff + i * shentsize))
+
+        if shstrndx < len(headers):
+            shstr_offset = headers[shstrndx][4]
+        else:
+            shstr_offset = None
+
+        self.sections = []
+        self.by_name = {}
+        for (name, sh_type, flags, addr, offset, size, link, _, _, entsize) in headers:
+            if shstr_offset is not None:
+                name = self.read_string(shstr_offset + name)
+            else:
+                name = ''
+            section = ElfSection(name, sh_type, flags, addr, offset, size, link, entsize)
+            self.sections.append(section)
+            self.by_name.setdefault(name, section)
+
+    def unpack_from(self, fmt, offset):
+        return struct.unpack_from(self.prefix + fmt, self.data, offset)
+
+    def read_string(self, offset):
+        end = self.map.find(b'\0', offset)
+        if end == -1:
+            end = len(self.map)
+        return str(self.map[offset:end], 'utf-8', 'replace')
+
+    def find_section(self, name):
+        return self.by_name.get(name)
 
-    cmd = 'nm -n %s' % vmlinux_path
-    lines = check_output(cmd.split(), stderr=subprocess.STDOUT).decode('utf-8').splitlines()
-    if ': no symbols' in lines[0]:
-        logging.debug("No symbols found in vmlinux!")
-        sys_map = get_system_map()
-        if sys_map is None:
-            logging.error("No SYSTEM_MAP, can't proceed")
+    def find_section_by_addr(self, start_vaddr, end_vaddr):
+        # Only sections with contents in the file, so not .bss etc.
+        for section in self.sections:
+            if not section.flags & SHF_ALLOC or section.type == SHT_NOBITS:
+                continue
+
+            if section.contains(start_vaddr, end_vaddr):
+                return section
+
+        return None
+
+    def addr_to_offset(self, start_vaddr, end_vaddr=None):
+        if end_vaddr is None:
+            end_vaddr = start_vaddr
+
+        section = self.find_section_by_addr(start_vaddr, end_vaddr)
+        if section is None:
+            return None
+
+        return section.offset + (start_vaddr - section.addr)
+
+    def section_data(self, section):
+        # Zero-copy view of the section contents
+        if section.type == SHT_NOBITS:
+            return self.data[0:0]
+        return self.data[section.offset:section.offset + section.size]
+
+    def read(self, vaddr, size):
+        # Zero-copy view of size bytes at vaddr, or None if it's not in the file
+        offset = self.addr_to_offset(vaddr, vaddr + size)
+        if offset is None:
+            return None
+        return self.data[offset:offset + size]
+
+    def build_id(self):
+        # The GNU build-id note as hex, or None
+        for section in self.sections:
+            if section.type != SHT_NOTE:
+                continue
+
+            offset = section.offset
+            end = section.offset + section.size
+            while offset + 12 <= end:
+                namesz, descsz, note_type = self.unpack_from('III', offset)
+                name_offset = offset + 12
+                desc_offset = name_offset + ((namesz + 3) & ~3)
+                if note_type == NT_GNU_BUILD_ID and bytes(self.data[name_offset:name_offset + namesz]) == b'GNU\0':
+                    return bytes(self.data[desc_offset:desc_offset + descsz]).hex()
+                offset = desc_offset + ((descsz + 3) & ~3)
+
+        return None
+
+    def symbol_sections(self):
+        # The symbol table and its string table, or None
+        for section in self.sections:
+            if section.type == SHT_SYMTAB and section.link < len(self.sections):
+                return (section, self.sections[section.link])
+        return None
+
+    def symbol_type(self, bind, sym_type, shndx):
+        # The type letter nm would show for the symbol
+        if shndx == SHN_UNDEF:
+            if bind == STB_WEAK:
+                return 'v' if sym_type == STT_OBJECT else 'w'
+            return 'U'
+
+        if bind == STB_WEAK:
+            return 'V' if sym_type == STT_OBJECT else 'W'
+
+        if shndx == SHN_ABS:
+            c = 'a'
+        elif shndx == SHN_COMMON:
+            c = 'c'
+        elif shndx < len(self.sections):
+            section = self.sections[shndx]
+            if section.flags & SHF_EXECINSTR:
+                c = 't'
+            elif section.type == SHT_NOBITS:
+                c = 'b'
+            elif not section.flags & SHF_ALLOC:
+                c = 'n'
+            elif section.flags & SHF_WRITE:
+                c = 'd'
+            else:
+                c = 'r'
+        else:
+            c = '?'
+
+        if bind != STB_LOCAL:
+            c = c.upper()
+
+        return c
+
+    def read_symbols(self):
+        # (addr, name, type) for each symbol, sorted as nm -n does, or None
+        # if there's no symbol table.
+        found = self.symbol_sections()
+        if found is None:
             return None
 
-        lines = open(sys_map).readlines()
+        symtab, strtab = found
+
+        if self.bits == 64:
+            fmt = self.prefix + 'IBBHQQ'
+        else:
+            fmt = self.prefix + 'IIIBBH'
+
+        entsize = struct.calcsize(fmt)
+        data = self.section_data(symtab)
+        data = data[:len(data) - len(data) % entsize]
+
+        undefined = []
+        symbols = []
+        # Skip the null symbol
+        for fields in struct.iter_unpack(fmt, data[entsize:]):
+            if self.bits == 64:
+                name, info, _, shndx, value, _ = fields
+            else:
+                name, value, _, info, _, shndx = fields
+
+            bind = info >> 4
+            sym_type = info & 0xf
+            # nm doesn't show these without -a
+            if sym_type in (STT_SECTION, STT_FILE) or name == 0:
+                continue
+
+            entry = (value, self.read_string(strtab.offset + name),
+                     self.symbol_type(bind, sym_type, shndx))
+            if shndx == SHN_UNDEF:
+                undefined.append(entry)
+            else:
+                symbols.append(entry)
+
+        # nm -n puts undefined symbols first, then sorts by address then name
+        undefined.sort(key=lambda s: s[1])
+        symbols.sort(key=lambda s: (s[0], s[1]))
+        return undefined + symbols
+
+
+elf_files = {}
+
+def get_elf(path):
+    # Each ELF is only mapped and parsed once, unless it's rebuilt
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    elf = elf_files.get(key)
+    if elf is None:
+        elf = ElfFile(path)
+        elf_files[key] = elf
+    return elf
+
+
+def get_system_map(vmlinux_path=None):
+    path = os.environ.get('SYSTEM_MAP', None)
+    if path:
+        return path
+
+    if vmlinux_path:
+        path = os.path.join(os.path.dirname(vmlinux_path), 'System.map')
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def read_symbols(vmlinux_path):
+    # From the symbol index cache if we can, see load_symbol_index()
+    index_path = symbol_index_path(vmlinux_path)
+    if index_path:
+        syms = load_symbol_index(index_path)
+        if syms is not None:
+            return syms
+
+    syms = parse_symbols(vmlinux_path)
+    if syms is not None and index_path:
+        try:
+            write_symbol_index(syms, index_path)
+        except OSError as e:
+            logging.debug(f"Couldn't write symbol index {index_path}: {e}")
+
+    return syms
+
+
+def parse_symbols(vmlinux_path):
+    symbols = get_elf(vmlinux_path).read_symbols()
+    if symbols:
+        return SymbolTable(symbols)
+
+    logging.debug("No symbols found in vmlinux!")
+    sys_map = get_system_map(vmlinux_path)
+    if sys_map is None:
+        logging.error("No SYSTEM_MAP, can't proceed")
+        return None
+
+    lines = open(sys_map).readlines()
 
     addrs = []
     last_addr = 0
@@ -39,60 +343,275 @@ def read_symbols(vmlinux_path):
         addrs.append((addr, name, sym_type))
         last_addr = addr
 
-    return addrs
+    return SymbolTable(addrs)
 
 
-def find_symbol(symbol_map, name):
-    for addr, cur_name, sym_type in symbol_map:
-        if cur_name == name:
-            return addr
+class SymbolTable:
+    # Symbols in address order, indexed for lookups by name and address.
+    # Still behaves as the list of (addr, name, type) it was created from.
+    def __init__(self, symbols):
+        self.addrs = array('Q', [s[0] for s in symbols])
+        self.names = [s[1] for s in symbols]
+        self.types = array('B', [ord(s[2]) for s in symbols])
 
-    return None
+        # First symbol with each name
+        self.by_name = {}
+        for i, name in enumerate(self.names):
+            self.by_name.setdefault(name, i)
 
+        # For find_addr(), each address that has a symbol, other than weak
+        # symbols, and the index of the longest named symbol there.
+        self.func_addrs = array('Q')
+        self.func_index = array('I')
+        weak = (ord('w'), ord('W'))
+        for i, (addr, name, sym_type) in enumerate(zip(self.addrs, self.names, self.types)):
+            if sym_type in weak:
+                continue
 
-def find_symbol_and_size(symbol_map, name):
-    saddr = None
-    i = 0
-    for addr, cur_name, sym_type in symbol_map:
-        if cur_name == name:
-            saddr = addr
-            break
-        i += 1
-
-    if saddr is None:
-        return (None, None)
-
-    i += 1
-    if i >= len(symbol_map):
-        size = -1
-    else:
-        size = symbol_map[i][0] - saddr
+            if len(self.func_addrs) and self.func_addrs[-1] == addr:
+                if len(name) > len(self.names[self.func_index[-1]]):
+                    self.func_index[-1] = i
+            else:
+                self.func_addrs.append(addr)
+                self.func_index.append(i)
 
-    return (saddr, size)
+    def __len__(self):
+        return len(self.addrs)
 
+    def __getitem__(self, i):
+        return (self.addrs[i], self.names[i], chr(self.types[i]))
 
-def find_addr(symbol_map, addr):
-    last_addr = 0
-    last_function = ''
+    def __iter__(self):
+        for i in range(len(self.addrs)):
+            yield self[i]
 
-    for current_addr, name, sym_type in symbol_map:
-        if sym_type.lower() == 'w':
-            continue
+    def index_of(self, name):
+        return self.by_name.get(name)
+
+    def find_symbol(self, name):
+        i = self.index_of(name)
+        if i is None:
+            return None
+        return self.addrs[i]
 
-        if current_addr > addr:
-            offset = addr - last_addr
-            return (last_function, offset)
+    def find_symbol_and_size(self, name):
+        i = self.index_of(name)
+        if i is None:
+            return (None, None)
 
-        if current_addr == last_addr:
-            # If we get multiple symbols for the same addr, use the longest
-            if len(name) > len(last_function):
-                last_function = name
+        saddr = self.addrs[i]
+        if i + 1 >= len(self.addrs):
+            size = -1
         else:
-            last_function = name
+            size = self.addrs[i + 1] - saddr
+
+        return (saddr, size)
+
+    def find_addr(self, addr):
+        # The symbol at or before addr, and the offset from it
+        i = bisect_right(self.func_addrs, addr)
+        if i == len(self.func_addrs):
+            return (addr, 0)
+        elif i == 0:
+            return ('', addr)
+
+        return (self.names[self.func_index[i - 1]], addr - self.func_addrs[i - 1])
+
+
+# Symbol index files are native endian, so the arrays can be used in place
+SYMBOL_INDEX_MAGIC = b'SYMIDX01'
+SYMBOL_INDEX_HEADER = '=8s1s3xIIQ'
+
+
+def align8(n):
+    return (n + 7) & ~7
+
+
+def symbol_index_layout(count, func_count, strtab_size):
+    # Offsets of each array in an index file
+    offset = align8(struct.calcsize(SYMBOL_INDEX_HEADER))
+    layout = {}
+    for name, typecode, n in [('addrs', 'Q', count), ('func_addrs', 'Q', func_count),
+                              ('name_offsets', 'I', count + 1), ('sorted_names', 'I', count),
+                              ('func_index', 'I', func_count), ('types', 'B', count),
+                              ('strtab', 'B', strtab_size)]:
+        size = n * struct.calcsize(typecode)
+        layout[name] = (offset, size, typecode)
+        offset = align8(offset + size)
+
+    return layout, offset
+
+
+def write_symbol_index(symbol_map, path):
+    syms = symbol_table(symbol_map)
+
+    names = [name.encode('utf-8') for name in syms.names]
+    name_offsets = array('I', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    # Symbol indices in name order, the first symbol of each name first
+    sorted_names = array('I', sorted(range(len(names)), key=lambda i: (names[i], i)))
+
+    strtab = b''.join(names)
+    layout, size = symbol_index_layout(len(names), len(syms.func_addrs), len(strtab))
+    arrays = {'addrs': syms.addrs, 'func_addrs': syms.func_addrs, 'name_offsets': name_offsets,
+              'sorted_names': sorted_names, 'func_index': syms.func_index, 'types': syms.types,
+              'strtab': strtab}
+
+    data = bytearray(size)
+    struct.pack_into(SYMBOL_INDEX_HEADER, data, 0, SYMBOL_INDEX_MAGIC, sys.byteorder[0].encode(),
+                     len(names), len(syms.func_addrs), len(strtab))
+    for name, (offset, length, _) in layout.items():
+        data[offset:offset + length] = bytes(arrays[name])
+
+    # Write and rename, so concurrent readers never see a partial index
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class IndexedNames:
+    # The names of an index file, decoded as they're used
+    def __init__(self, strtab, name_offsets):
+        self.strtab = strtab
+        self.name_offsets = name_offsets
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def name_bytes(self, i):
+        return bytes(self.strtab[self.name_offsets[i]:self.name_offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return str(self.name_bytes(i), 'utf-8')
+
+
+class MappedSymbolTable(SymbolTable):
+    # A SymbolTable over an mmap of an index file, so loading it costs
+    # nothing, rather than parsing every symbol.
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self.map)
+
+        magic, byteorder, count, func_count, strtab_size = \
+            struct.unpack_from(SYMBOL_INDEX_HEADER, data, 0)
+        if magic != SYMBOL_INDEX_MAGIC or byteorder != sys.byteorder[0].encode():
+            raise ValueError(f'Not a symbol index for this host: {path}')
+
+        layout, size = symbol_index_layout(count, func_count, strtab_size)
+        if len(data) != size:
+            raise ValueError(f'Truncated symbol index: {path}')
+
+        views = {}
+        for name, (offset, length, typecode) in layout.items():
+            views[name] = data[offset:offset + length].cast(typecode)
+
+        self.addrs = views['addrs']
+        self.types = views['types']
+        self.func_addrs = views['func_addrs']
+        self.func_index = views['func_index']
+        self.sorted_names = views['sorted_names']
+        self.names = IndexedNames(views['strtab'], views['name_offsets'])
+
+    def index_of(self, name):
+        # Binary search of the names, for the first symbol with the name
+        key = name.encode('utf-8')
+        lo = 0
+        hi = len(self.sorted_names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.names.name_bytes(self.sorted_names[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(self.sorted_names) and self.names.name_bytes(self.sorted_names[lo]) == key:
+            return self.sorted_names[lo]
+
+        return None
 
-        last_addr = current_addr
 
-    return (addr, 0)
+def symbol_cache_dir():
+    # Symbols are only cached if $SYMBOL_CACHE names a directory to keep them
+    # in. Nothing expires them, so it's for interactive use, not CI hosts.
+    path = os.environ.get('SYMBOL_CACHE', '')
+    if path in ['', 'none']:
+        return None
+    return path
+
+
+def symbol_index_key(vmlinux_path):
+    # The build-id if there is one, otherwise the size and mtime. Plus where
+    # the symbols come from, so a System.map for another build doesn't get
+    # cached as this one's symbols. The symbol table only needs hashing if
+    # there's no build-id.
+    elf = get_elf(vmlinux_path)
+    build_id = elf.build_id()
+
+    found = elf.symbol_sections()
+    if found:
+        if build_id:
+            source = 'symtab'
+        else:
+            h = sha1()
+            for section in found:
+                h.update(elf.section_data(section))
+            source = f'symtab-{h.hexdigest()}'
+    else:
+        sys_map = get_system_map(vmlinux_path)
+        if sys_map is None or not os.path.isfile(sys_map):
+            return None
+        source = f'sysmap-{sha1(open(sys_map, "rb").read()).hexdigest()}'
+
+    if build_id:
+        return f'build-id-{build_id}-{source}'
+
+    st = os.stat(vmlinux_path)
+    return f'{st.st_size}-{st.st_mtime_ns}-{source}'
+
+
+def symbol_index_path(vmlinux_path):
+    cache_dir = symbol_cache_dir()
+    if cache_dir is None:
+        return None
+
+    key = symbol_index_key(vmlinux_path)
+    if key is None:
+        return None
+
+    return os.path.join(cache_dir, f'{key}.idx')
+
+
+def load_symbol_index(path):
+    # Returns None if there's no usable index at path
+    try:
+        return MappedSymbolTable(path)
+    except (OSError, ValueError, struct.error) as e:
+        if os.path.exists(path):
+            logging.debug(f"Ignoring symbol index {path}: {e}")
+        return None
+
+
+def symbol_table(symbol_map):
+    if isinstance(symbol_map, SymbolTable):
+        return symbol_map
+    return SymbolTable(symbol_map)
+
+
+def find_symbol(symbol_map, name):
+    return symbol_table(symbol_map).find_symbol(name)
+
+
+def find_symbol_and_size(symbol_map, name):
+    return symbol_table(symbol_map).find_symbol_and_size(name)
+
+
+def find_addr(symbol_map, addr):
+    return symbol_table(symbol_map).find_addr(addr)
 
 
 objdump_bin = None
@@ -127,65 +646,83 @@ def find_objdump():
 
 
 def find_section_by_addr(vmlinux_path, start_vaddr, end_vaddr):
-    objdump = find_objdump()
-    cmd = f'{objdump} -w -h {vmlinux_path}'
-    output = check_output(cmd.split())
+    return get_elf(vmlinux_path).addr_to_offset(start_vaddr, end_vaddr)
 
-    for line in output.decode('utf-8').splitlines():
-        tokens = line.split()
-        if len(tokens) < 6 or tokens[0] == 'Idx':
-            continue
 
-        section_size = int(tokens[2], 16)
-        section_start_vaddr = int(tokens[3], 16)
-        section_offset = int(tokens[5], 16)
-        section_end_vaddr = section_start_vaddr + section_size
+def read_section_info(vmlinux_path, section_name):
+    section = get_elf(vmlinux_path).find_section(section_name)
+    if section is None:
+        raise Exception(f"Couldn't find section {section_name} in vmlinux")
 
-        if start_vaddr >= section_start_vaddr and \
-           end_vaddr <= section_end_vaddr:
-            return section_offset + (start_vaddr - section_start_vaddr)
+    return (section.addr, section.offset, section.size)
 
-    return None
 
+class Table:
+    # Named columns of a decoded table, eg. an array per field of a section.
+    # Columns listed in hex are addresses etc. and shown in hex.
+    def __init__(self, name, columns, hex=()):
+        self.name = name
+        self.columns = dict(columns)
+        self.hex = set(hex)
 
-def read_section_info(vmlinux_path, section_name):
-    objdump = find_objdump()
-    cmd = f'{objdump} -h -j {section_name} {vmlinux_path}'
-    output = check_output(cmd.split())
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
 
-    for line in output.decode('utf-8').splitlines():
-        if section_name not in line:
-            continue
+    def __getitem__(self, name):
+        return self.columns[name]
 
-        tokens = line.split()
-        size = int(tokens[2], 16)
-        start_addr = int(tokens[3], 16)
-        offset = int(tokens[5], 16)
-        return (start_addr, offset, size)
+    def add_column(self, name, values, hex=False):
+        self.columns[name] = values
+        if hex:
+            self.hex.add(name)
 
-    raise Exception("Couldn't parse vmlinux")
+    def add_symbols(self, symbol_map, column):
+        # Add <column>_symbol and <column>_offset, from find_addr()
+        syms = symbol_table(symbol_map)
+        found = [syms.find_addr(addr) for addr in self.columns[column]]
+        self.add_column(f'{column}_symbol', [f[0] for f in found])
+        self.add_column(f'{column}_offset', [f[1] for f in found], hex=True)
 
+    def rows(self):
+        return zip(*self.columns.values())
 
-def iter_fixup_section(vmlinux_path, section):
-    start_addr, offset, size = read_section_info(vmlinux_path, section)
-    endian = get_endian(vmlinux_path)
+    def records(self):
+        # Rows as dicts, with hex columns formatted as strings
+        names = list(self.columns)
+        for row in self.rows():
+            yield {name: (f'0x{val:x}' if name in self.hex and isinstance(val, int) else val)
+                   for name, val in zip(names, row)}
 
-    f = open(vmlinux_path, 'rb')
 
-    if endian == 'little':
-        fmt = '<q'
-    else:
-        fmt = '>q'
+def read_array(elf, typecode, data):
+    # Decode data as an array of typecode, in the byte order of the ELF
+    values = array(typecode)
+    values.frombytes(data[:len(data) - len(data) % values.itemsize])
+    if elf.endian != sys.byteorder:
+        values.byteswap()
+    return values
+
 
-    f.seek(offset)
-    data = f.read(size)
+def entry_addrs(start_addr, count, size):
+    return array('Q', range(start_addr, start_addr + count * size, size))
 
-    cur_addr = start_addr
-    for tupl in struct.iter_unpack(fmt, data):
-        val = tupl[0]
-        addr = cur_addr + val
-        yield (cur_addr, addr)
-        cur_addr += 8
+
+def read_fixup_table(vmlinux_path, section):
+    # Uses a single FTR_ENTRY_OFFSET
+    elf = get_elf(vmlinux_path)
+    start_addr, offset, size = read_section_info(vmlinux_path, section)
+
+    offsets = read_array(elf, 'q', elf.data[offset:offset + size])
+    entries = entry_addrs(start_addr, len(offsets), 8)
+    addrs = array('Q', map(add, entries, offsets))
+    return Table(section, [('entry', entries), ('addr', addrs)], hex=['entry', 'addr'])
+
+
+def iter_fixup_section(vmlinux_path, section):
+    table = read_fixup_table(vmlinux_path, section)
+    return table.rows()
 
 
 def iter_nospec_fixups(vmlinux_path):
@@ -206,3 +743,374 @@ def iter_stf_entry_barrier_fixups(vmlinux_path):
 def iter_stf_exit_barrier_fixups(vmlinux_path):
     # Uses a single FTR_ENTRY_OFFSET
     return iter_fixup_section(vmlinux_path, '__stf_exit_barrier_fixup')
+
+
+cpu_features = [
+    (0x0000000000000001, 'CPU_FTR_COHERENT_ICACHE'),
+    (0x0000000000000002, 'CPU_FTR_ALTIVEC'),
+    (0x0000000000000004, 'CPU_FTR_DBELL'),
+    (0x0000000000000008, 'CPU_FTR_CAN_NAP'),
+    (0x0000000000000010, 'CPU_FTR_DEBUG_LVL_EXC'),
+    (0x0000000000000020, 'CPU_FTR_NODSISRALIGN'),
+    (0x0000000000000040, 'CPU_FTR_FPU_UNAVAILABLE'),
+    (0x0000000000000080, 'CPU_FTR_LWSYNC'),
+    (0x0000000000000100, 'CPU_FTR_NOEXECUTE'),
+    (0x0000000000000200, 'CPU_FTR_EMB_HV'),
+    (0x0000000000001000, 'CPU_FTR_REAL_LE'),
+    (0x0000000000002000, 'CPU_FTR_HVMODE'),
+    (0x0000000000008000, 'CPU_FTR_ARCH_206'),
+    (0x0000000000010000, 'CPU_FTR_ARCH_207S'),
+    (0x0000000000020000, 'CPU_FTR_ARCH_300'),
+    (0x0000000000040000, 'CPU_FTR_MMCRA'),
+    (0x0000000000080000, 'CPU_FTR_CTRL'),
+    (0x0000000000100000, 'CPU_FTR_SMT'),
+    (0x0000000000200000, 'CPU_FTR_PAUSE_ZERO'),
+    (0x0000000000400000, 'CPU_FTR_PURR'),
+    (0x0000000000800000, 'CPU_FTR_CELL_TB_BUG'),
+    (0x0000000001000000, 'CPU_FTR_SPURR'),
+    (0x0000000002000000, 'CPU_FTR_DSCR'),
+    (0x0000000004000000, 'CPU_FTR_VSX'),
+    (0x0000000008000000, 'CPU_FTR_SAO'),
+    (0x0000000010000000, 'CPU_FTR_CP_USE_DCBTZ'),
+    (0x0000000020000000, 'CPU_FTR_UNALIGNED_LD_STD'),
+    (0x0000000040000000, 'CPU_FTR_ASYM_SMT'),
+    (0x0000000080000000, 'CPU_FTR_STCX_CHECKS_ADDRESS'),
+    (0x0000000100000000, 'CPU_FTR_POPCNTB'),
+    (0x0000000200000000, 'CPU_FTR_POPCNTD'),
+    (0x0000000400000000, 'CPU_FTR_PKEY'),
+    (0x0000000800000000, 'CPU_FTR_VMX_COPY'),
+    (0x0000001000000000, 'CPU_FTR_TM'),
+    (0x0000002000000000, 'CPU_FTR_CFAR'),
+    (0x0000004000000000, 'CPU_FTR_HAS_PPR'),
+    (0x0000008000000000, 'CPU_FTR_DAWR'),
+    (0x0000010000000000, 'CPU_FTR_DABRX'),
+    (0x0000020000000000, 'CPU_FTR_PMAO_BUG'),
+    (0x0000080000000000, 'CPU_FTR_POWER9_DD2_1'),
+    (0x0000100000000000, 'CPU_FTR_P9_TM_HV_ASSIST'),
+    (0x0000200000000000, 'CPU_FTR_P9_TM_XER_SO_BUG'),
+    (0x0000400000000000, 'CPU_FTR_P9_TLBIE_STQ_BUG'),
+    (0x0000800000000000, 'CPU_FTR_P9_TIDR'),
+    (0x0001000000000000, 'CPU_FTR_P9_TLBIE_ERAT_BUG'),
+    (0x0002000000000000, 'CPU_FTR_P9_RADIX_PREFETCH_BUG'),
+    (0x0004000000000000, 'CPU_FTR_ARCH_31'),
+    (0x0008000000000000, 'CPU_FTR_DAWR1'),
+]
+
+def decode_ftr(features, value):
+    s = []
+    remainder = value
+    for mask, name in features:
+        if value & mask:
+            s.append(name)
+        remainder &= ~mask
+
+    if remainder:
+        s.append("UNKNOWN={:x}".format(remainder))
+
+    return ', '.join(s)
+
+
+def decode_cpu_ftr(value):
+    return decode_ftr(cpu_features, value)
+
+mmu_features = [
+    (0x00000001, 'MMU_FTR_HPTE_TABLE'),
+    (0x00000002, 'MMU_FTR_TYPE_8xx'),
+    (0x00000004, 'MMU_FTR_TYPE_40x'),
+    (0x00000008, 'MMU_FTR_TYPE_44x'),
+    (0x00000010, 'MMU_FTR_TYPE_FSL_E'),
+    (0x00000020, 'MMU_FTR_TYPE_47x'),
+    (0x00000040, 'MMU_FTR_TYPE_RADIX'),
+    (0x00000200, 'MMU_FTR_BOOK3S_KUAP'),
+    (0x00000400, 'MMU_FTR_BOOK3S_KUEP'),
+    (0x00000800, 'MMU_FTR_PKEY'),
+    (0x00002000, 'MMU_FTR_68_BIT_VA'),
+    (0x00004000, 'MMU_FTR_KERNEL_RO'),
+    (0x00008000, 'MMU_FTR_TLBIE_CROP_VA'),
+    (0x00010000, 'MMU_FTR_USE_HIGH_BATS'),
+    (0x00020000, 'MMU_FTR_BIG_PHYS'),
+    (0x00040000, 'MMU_FTR_USE_TLBIVAX_BCAST'),
+    (0x00080000, 'MMU_FTR_USE_TLBILX'),
+    (0x00100000, 'MMU_FTR_LOCK_BCAST_INVAL'),
+    (0x00200000, 'MMU_FTR_NEED_DTLB_SW_LRU'),
+    (0x00800000, 'MMU_FTR_USE_TLBRSRV'),
+    (0x01000000, 'MMU_FTR_USE_PAIRED_MAS'),
+    (0x02000000, 'MMU_FTR_NO_SLBIE_B'),
+    (0x04000000, 'MMU_FTR_16M_PAGE'),
+    (0x08000000, 'MMU_FTR_TLBIEL'),
+    (0x10000000, 'MMU_FTR_LOCKLESS_TLBIE'),
+    (0x20000000, 'MMU_FTR_CI_LARGE_PAGE'),
+    (0x40000000, 'MMU_FTR_1T_SEGMENT'),
+    (0x80000000, 'MMU_FTR_RADIX_KUAP'),
+]
+
+
+def decode_mmu_ftr(value):
+    return decode_ftr(mmu_features, value)
+
+
+fw_features = [
+    (0x0000000000000001, 'FW_FEATURE_PFT'),
+    (0x0000000000000002, 'FW_FEATURE_TCE'),
+    (0x0000000000000004, 'FW_FEATURE_SPRG0'),
+    (0x0000000000000008, 'FW_FEATURE_DABR'),
+    (0x0000000000000010, 'FW_FEATURE_COPY'),
+    (0x0000000000000020, 'FW_FEATURE_ASR'),
+    (0x0000000000000040, 'FW_FEATURE_DEBUG'),
+    (0x0000000000000080, 'FW_FEATURE_TERM'),
+    (0x0000000000000100, 'FW_FEATURE_PERF'),
+    (0x0000000000000200, 'FW_FEATURE_DUMP'),
+    (0x0000000000000400, 'FW_FEATURE_INTERRUPT'),
+    (0x0000000000000800, 'FW_FEATURE_MIGRATE'),
+    (0x0000000000001000, 'FW_FEATURE_PERFMON'),
+    (0x0000000000002000, 'FW_FEATURE_CRQ'),
+    (0x0000000000004000, 'FW_FEATURE_VIO'),
+    (0x0000000000008000, 'FW_FEATURE_RDMA'),
+    (0x0000000000010000, 'FW_FEATURE_LLAN'),
+    (0x0000000000020000, 'FW_FEATURE_BULK_REMOVE'),
+    (0x0000000000040000, 'FW_FEATURE_XDABR'),
+    (0x0000000000080000, 'FW_FEATURE_PUT_TCE_IND'),
+    (0x0000000000100000, 'FW_FEATURE_SPLPAR'),
+    (0x0000000000400000, 'FW_FEATURE_LPAR'),
+    (0x0000000000800000, 'FW_FEATURE_PS3_LV1'),
+    (0x0000000001000000, 'FW_FEATURE_HPT_RESIZE'),
+    (0x0000000002000000, 'FW_FEATURE_CMO'),
+    (0x0000000004000000, 'FW_FEATURE_VPHN'),
+    (0x0000000008000000, 'FW_FEATURE_XCMO'),
+    (0x0000000010000000, 'FW_FEATURE_OPAL'),
+    (0x0000000040000000, 'FW_FEATURE_SET_MODE'),
+    (0x0000000080000000, 'FW_FEATURE_BEST_ENERGY'),
+    (0x0000000100000000, 'FW_FEATURE_TYPE1_AFFINITY'),
+    (0x0000000200000000, 'FW_FEATURE_PRRN'),
+    (0x0000000400000000, 'FW_FEATURE_DRMEM_V2'),
+    (0x0000000800000000, 'FW_FEATURE_DRC_INFO'),
+    (0x0000001000000000, 'FW_FEATURE_BLOCK_REMOVE'),
+    (0x0000002000000000, 'FW_FEATURE_PAPR_SCM'),
+    (0x0000004000000000, 'FW_FEATURE_ULTRAVISOR'),
+    (0x0000008000000000, 'FW_FEATURE_STUFF_TCE'),
+]
+
+
+def decode_fw_ftr(value):
+    return decode_ftr(fw_features, value)
+
+
+ftr_fixup_sections = [
+    ('CPU', '__ftr_fixup', decode_cpu_ftr),
+    ('MMU', '__mmu_ftr_fixup', decode_mmu_ftr),
+    ('Firmware', '__fw_ftr_fixup', decode_fw_ftr),
+]
+
+
+def read_ftr_fixups(vmlinux_path, section, symbol_map=None, decode_fn=None):
+    # struct fixup_entry: mask, value, then start/end, alt_start/alt_end as
+    # offsets from the entry. Optionally with the symbol of each address, and
+    # the features in the mask and value.
+    elf = get_elf(vmlinux_path)
+    start_addr, offset, size = read_section_info(vmlinux_path, section)
+
+    fields = read_array(elf, 'q', elf.data[offset:offset + size])
+    count = len(fields) // 6
+    entries = entry_addrs(start_addr, count, 6 * 8)
+
+    columns = [('entry', entries), ('mask', fields[0:count * 6:6]), ('value', fields[1:count * 6:6])]
+    for i, name in enumerate(['start', 'end', 'alt_start', 'alt_end'], 2):
+        columns.append((name, array('Q', map(add, entries, fields[i:count * 6:6]))))
+
+    table = Table(section, columns, hex=[c[0] for c in columns])
+
+    if symbol_map is not None:
+        for column in ['start', 'end', 'alt_start', 'alt_end']:
+            table.add_symbols(symbol_map, column)
+
+    if decode_fn:
+        table.add_column('mask_features', [decode_fn(mask) for mask in table['mask']])
+        table.add_column('value_features', [decode_fn(value) for value in table['value']])
+
+    return table
+
+
+def read_extable(vmlinux_path):
+    # struct exception_table_entry: insn and fixup, each relative to itself
+    elf = get_elf(vmlinux_path)
+    start_addr, offset, size = read_section_info(vmlinux_path, '__ex_table')
+
+    fields = read_array(elf, 'i', elf.data[offset:offset + size])
+    count = len(fields) // 2
+    entries = entry_addrs(start_addr, count, 8)
+    faults = array('Q', map(add, entries, fields[0:count * 2:2]))
+    fixups = array('Q', map(add, entry_addrs(start_addr + 4, count, 8), fields[1:count * 2:2]))
+
+    return Table('__ex_table', [('entry', entries), ('fault', faults), ('fixup', fixups)],
+                 hex=['entry', 'fault', 'fixup'])
+
+
+def read_mcount(vmlinux_path, symbol_map):
+    # The mcount_loc records, and the instruction at each
+    syms = symbol_table(symbol_map)
+    start_vaddr = syms.find_symbol('__start_mcount_loc')
+    end_vaddr = syms.find_symbol('__stop_mcount_loc')
+
+    table = Table('mcount_loc', [('entry', array('Q')), ('addr', array('Q')), ('instruction', array('I'))],
+                  hex=['entry', 'addr', 'instruction'])
+    if start_vaddr is None or end_vaddr is None:
+        return table
+
+    elf = get_elf(vmlinux_path)
+    data = elf.read(start_vaddr, end_vaddr - start_vaddr)
+    if data is None:
+        return table
+
+    addrs = read_array(elf, 'Q', data)
+    inst_fmt = f'{elf.prefix}I'
+    instructions = array('I')
+    for addr in addrs:
+        # Zero if the address isn't in the file, eg. it was discarded
+        inst = elf.read(addr, 4)
+        instructions.append(struct.unpack(inst_fmt, inst)[0] if inst is not None else 0)
+
+    table.add_column('entry', entry_addrs(start_vaddr, len(addrs), 8))
+    table.add_column('addr', addrs)
+    table.add_column('instruction', instructions)
+    return table
+
+
+def read_sys_call_table(vmlinux_path, symbol_map):
+    # Returns None if sys_call_table or its size can't be found
+    start_vaddr, size = symbol_table(symbol_map).find_symbol_and_size('sys_call_table')
+    if start_vaddr is None or size == -1:
+        return None
+
+    elf = get_elf(vmlinux_path)
+    data = elf.read(start_vaddr, size)
+    if data is None:
+        return None
+
+    addrs = read_array(elf, 'Q', data)
+    return Table('sys_call_table', [('num', range(len(addrs))),
+                                    ('entry', entry_addrs(start_vaddr, len(addrs), 8)),
+                                    ('addr', addrs)],
+                 hex=['entry', 'addr'])
+
+
+def add_in_init(table, symbol_map, column='addr'):
+    syms = symbol_table(symbol_map)
+    init_begin = syms.find_symbol('__init_begin')
+    init_end = syms.find_symbol('__init_end')
+
+    if init_begin and init_end:
+        in_init = [init_begin <= addr and addr <= init_end for addr in table[column]]
+    else:
+        in_init = [False] * len(table)
+
+    table.add_column('in_init', in_init)
+
+
+def dump_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                        help='Output format (default text)')
+    parser.add_argument('vmlinux', help='Path to vmlinux')
+    return parser
+
+
+def write_tables(tables, fmt, f=sys.stdout):
+    # Write tables as text, a block of rows per table, JSON, an object of
+    # lists of rows keyed by table name, or CSV, with the table name in the
+    # first column.
+    try:
+        if fmt == 'json':
+            json.dump({t.name: list(t.records()) for t in tables}, f, indent=1)
+            f.write('\n')
+            return
+
+        if fmt == 'text':
+            for table in tables:
+                print(f'# Dumping {table.name} ({len(table)} entries)', file=f)
+                print('# ' + ' '.join(table.columns), file=f)
+                for record in table.records():
+                    print(' '.join(str(val) for val in record.values()), file=f)
+                print(file=f)
+            return
+
+        writer = csv.writer(f)
+        header = None
+        for table in tables:
+            names = list(table.columns)
+            if names != header:
+                if header is not None:
+                    writer.writerow([])
+                writer.writerow(['table'] + names)
+                header = names
+
+            for record in table.records():
+                writer.writerow([table.name] + list(record.values()))
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+
+# Sections of FTR_ENTRY_OFFSETs, dumped by dump-{rfi-flush,entry-flush,...}
+fixup_sections = ['__rfi_flush_fixup', '__entry_flush_fixup', '__scv_entry_flush_fixup',
+                  '__uaccess_flush_fixup', '__stf_entry_barrier_fixup', '__stf_exit_barrier_fixup',
+                  '__spec_barrier_fixup', '__lwsync_fixup']
+
+
+def read_all_tables(vmlinux_path, symbol_map=None):
+    # Every table the dump-* scripts show, other than disassembly, reading
+    # vmlinux and its symbols once. Tables that aren't in this vmlinux, eg.
+    # because of the config, are skipped.
+    if symbol_map is None:
+        symbol_map = read_symbols(vmlinux_path)
+        if symbol_map is None:
+            return None
+
+    syms = symbol_table(symbol_map)
+    elf = get_elf(vmlinux_path)
+    tables = []
+
+    for section in fixup_sections:
+        if elf.find_section(section) is None:
+            continue
+
+        table = read_fixup_table(vmlinux_path, section)
+        table.add_symbols(syms, 'addr')
+        add_in_init(table, syms)
+        tables.append(table)
+
+    for _, section, decode_fn in ftr_fixup_sections:
+        if elf.find_section(section) is not None:
+            tables.append(read_ftr_fixups(vmlinux_path, section, syms, decode_fn))
+
+    if elf.find_section('__ex_table') is not None:
+        table = read_extable(vmlinux_path)
+        table.add_symbols(syms, 'fault')
+        table.add_symbols(syms, 'fixup')
+        tables.append(table)
+
+    table = read_mcount(vmlinux_path, syms)
+    if len(table):
+        table.add_symbols(syms, 'addr')
+        tables.append(table)
+
+    table = read_sys_call_table(vmlinux_path, syms)
+    if table is not None:
+        table.add_symbols(syms, 'addr')
+        tables.append(table)
+
+    return tables
+
+
+def dump_all(vmlinux_path, output=None, fmt='json'):
+    # Write all the tables of vmlinux to output, or stdout. Returns the tables,
+    # or None if there are no symbols to decode them with.
+    tables = read_all_tables(vmlinux_path)
+    if tables is None:
+        return None
+
+    if output is None:
+        write_tables(tables, fmt)
+    else:
+        with open(output, 'w') as f:
+            write_tables(tables, fmt, f)
+
+    return tables
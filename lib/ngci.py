@@ -6,16 +6,20 @@ import logging
 import os
 import os.path
 import re
+import shlex
+import shutil
 import time
 from copy import copy
 from collections import OrderedDict
 from datetime import datetime
 from hashlib import sha1
 from multiprocessing import Process, Pipe
-from subprocess import check_output, call, run, DEVNULL, Popen, PIPE
+from multiprocessing.connection import wait
+from subprocess import check_output, call, run, DEVNULL, Popen, PIPE, CalledProcessError
 
 import defaults
-from qemu import kvm_present
+from dump import dump_all, get_elf, EM_PPC, EM_PPC64
+from qemu import kvm_present, fill_overlay_pool, qemu_resources, boot_overlay_spec, boot_overlay_image
 
 try:
     from termcolor import colored
@@ -64,13 +68,37 @@ class State:
         self.build_dir = f'{self.output_dir}/build'
         self.boot_dir = f'{self.output_dir}/boot'
         self.config_dir = f'{script_dir}/etc/configs'
-        self.kfactor = args.kfactor    # number of parallel builds
         self.jfactor = args.jfactor    # parallelism of each build
-        self.bfactor = args.bfactor    # number of parallel boots
+        self.cpu_budget = args.cpu_budget  # CPUs shared by all builds & boots
+        self.mem_budget = args.mem_budget  # memory (MB) shared by all builds & boots
+
+        # With a CPU budget the number of builds/boots is only capped if asked
+        default = 0 if self.cpu_budget else 1
+        self.kfactor = default if args.kfactor is None else args.kfactor  # number of parallel builds
+        self.bfactor = default if args.bfactor is None else args.bfactor  # number of parallel boots
         self.kfilter = args.kfilter    # kernels to build
         self.sfilter = args.sfilter    # selftests to build
         self.bfilter = args.bfilter    # hosts to boot
         self.tfilter = args.tfilter    # tests to run
+        self.build_cache = args.build_cache  # where to keep built kernels for reuse
+        self.ccache = args.ccache      # root of the per image ccache directories
+        self.ccache_size = args.ccache_size  # max size of each ccache directory
+        self.warm_trees = args.warm_trees  # where to keep kernel build trees between runs
+        if self.warm_trees:
+            self.warm_trees = os.path.abspath(self.warm_trees)
+        self.seed_variants = args.seed_variants  # start variant builds from their base's objects
+        self.workers = args.workers    # build in one long lived container per image
+        self.worker_prefix = f'ngci-{os.getpid()}'
+        self.ifactor = args.ifactor    # number of images to prepare at once
+        self.pull_images = args.pull_images  # pull missing images rather than building them
+        self.artifacts = args.artifacts  # optional outputs to produce for every kernel
+        self.dump_tables = args.dump_tables  # decode the tables of each vmlinux after building
+        self.fs_images = args.fs_images  # mount modules/selftests in qemu rather than extracting
+        self.abort_on_warning = args.abort_on_warning  # stop qemu guests on the first warning
+        self.bake_cloud_init = args.bake_cloud_init  # boot cloud images with cloud-init already run
+        self.boot_snapshots = args.boot_snapshots  # where qemu keeps snapshots of booted guests
+        if self.boot_snapshots:
+            self.boot_snapshots = os.path.abspath(self.boot_snapshots)
 
 
 def defconfig_subarch(defconfig):
@@ -116,6 +144,11 @@ class KernelBuild:
         subarch = defconfig_subarch(defconfig)
         self.subarch = subarch
         self.name = f'{defconfig}@{image}'
+        self.full_image = f'{subarch}@{image}'
+        self.artifacts = set()  # optional outputs something needs, eg. modules
+        self.modules_formats = set()  # modules tarball formats needed by boots
+        self.seed = None       # build whose object tree this one starts from
+        self.variants = []     # builds seeded from this one
 
     def dir_name(self):
         # Has to match get_output_dir() in lib.sh
@@ -162,9 +195,13 @@ class SelftestsBuild:
 
         self.name = f'{target_dir}@{self.full_image}'
         self.output_dir = self.name
+        self.formats = set()   # tarball formats needed by tests
 
 
 class BootConfig:
+    # The modules are extracted on the target, whose tar may not know zstd
+    modules_format = 'gz'
+
     def __init__(self, name, defconfig, image, script=None, tests=[], cmdline=None):
         self.name = name
         self.defconfig = defconfig
@@ -200,11 +237,35 @@ class BootConfig:
     def get_args(self, state):
         return []
 
+    def cpu_cost(self, state):
+        # Booting real hardware only needs the harness running locally
+        return 1
+
+    def mem_cost(self, state):
+        return 0
+
+    def overlay_spec(self, state):
+        return None
+
+    def get_tests(self, state):
+        return [test for test in self.tests
+                if not state.tfilter or filter_matches(test.name, state.tfilter)]
+
+    def dependencies(self, state):
+        # The builds whose artifacts are needed before booting
+        deps = [self.kernel_build]
+        for test in self.get_tests(state):
+            deps.extend(test.dependencies())
+        return deps
+
     def long_description(self):
         return f'{self.name} with {self.defconfig} using {self.script}'
 
 
 class QemuBootConfig(BootConfig):
+    # The guest extracts the modules with zcat
+    modules_format = 'gz'
+
     def __init__(self, name, defconfig, image, script=None, tests=[],
                  qemu=None, cmdline=None):
         super().__init__(name, defconfig, image, script, tests, cmdline)
@@ -213,6 +274,7 @@ class QemuBootConfig(BootConfig):
         self.qemu_version = qemu
         self.callbacks = []
         self.args = []
+        self.overlay_pool = 0  # boots sharing this one's root disk overlays
 
     def __eq__(self, other):
         return (super().__eq__(other) and
@@ -225,6 +287,29 @@ class QemuBootConfig(BootConfig):
     def long_description(self):
         return f'{self.name} with {self.defconfig} using {self.script} using qemu {self.qemu_version}'
 
+    def script_settings(self, state):
+        # As boot_script_settings(), with all the arguments the base boot
+        # script will get
+        machine, script_args, smp, mem = boot_script_settings(state, self.script)
+        args = script_args + shlex.split(' '.join(self.get_args(state)))
+        return (machine, args, smp, mem)
+
+    def resources(self, state):
+        # The CPUs and MB of memory the guest is given, see qemu_resources()
+        machine, args, smp, mem = self.script_settings(state)
+        return qemu_resources(machine, args, smp, mem)
+
+    def overlay_spec(self, state):
+        # What the guest's root disk is an overlay of, see boot_overlay_spec()
+        machine, args, _, _ = self.script_settings(state)
+        return boot_overlay_spec(machine, args)
+
+    def cpu_cost(self, state):
+        return self.resources(state)[0]
+
+    def mem_cost(self, state):
+        return self.resources(state)[1]
+
     def dir_name(self):
         if self.qemu_version in ['mainline', 'host']:
             # Use it directly
@@ -243,6 +328,21 @@ class QemuBootConfig(BootConfig):
         args = copy(self.args)
         args.extend([f'--callback "{c}"' for c in self.callbacks])
 
+        if state.fs_images:
+            args.append('--fs-images')
+
+        if state.abort_on_warning:
+            args.append('--abort-on-warning')
+
+        if state.bake_cloud_init:
+            args.append('--bake-cloud-init')
+
+        if state.boot_snapshots:
+            args.append(f'--boot-snapshot-dir {state.boot_snapshots}')
+
+        if self.overlay_pool > 1:
+            args.append(f'--overlay-pool {self.overlay_pool}')
+
         ver = self.qemu_version
         if self.qemu_version == 'host':
             # No qemu path needed, default to path lookup
@@ -260,6 +360,9 @@ class QemuBootConfig(BootConfig):
 
 
 class TestConfig:
+    # Format of the selftests tarball the test reads, if any
+    selftests_format = None
+
     def __init__(self, name):
         self.name = name
         self.run = True
@@ -268,8 +371,14 @@ class TestConfig:
         gen_script(f'{test_dir}/run.sh', f'{state.script_dir}/scripts/test/{self.name} {boot.name}\n')
         pass
 
+    def dependencies(self):
+        return []
+
 
 class SelftestsConfig(TestConfig):
+    # remote-selftests untars them on the target
+    selftests_format = 'gz'
+
     def __init__(self, selftest_build, collection, exclude=[]):
         name = f'selftests-{collection}'
         super().__init__(name)
@@ -277,8 +386,11 @@ class SelftestsConfig(TestConfig):
         self.collection = collection
         self.exclude = exclude
 
+    def dependencies(self):
+        return [self.selftests]
+
     def setup(self, state, boot, test_dir):
-        selftests_tar = f'{state.build_dir}/{self.selftests.output_dir}/selftests.tar.gz'
+        selftests_tar = f'{state.build_dir}/{self.selftests.output_dir}/selftests.tar.{self.selftests_format}'
         run(f'ln -sf {selftests_tar}'.split(), cwd=test_dir, check=True)
 
         cmd = [f'{state.script_dir}/scripts/test/remote-selftests']
@@ -321,6 +433,9 @@ class QemuTestConfig(TestConfig):
 
 
 class QemuSelftestsConfig(TestConfig):
+    # The guest extracts the selftests with zcat
+    selftests_format = 'gz'
+
     def __init__(self, selftest_build, collection=None, exclude=[], extra_callbacks=[]):
         name = 'qemu-selftests'
         if collection:
@@ -332,6 +447,9 @@ class QemuSelftestsConfig(TestConfig):
         self.exclude = exclude
         self.extra_callbacks = extra_callbacks
 
+    def dependencies(self):
+        return [self.selftests]
+
     def setup(self, state, boot, test_dir):
         start_marker = f'starting-{self.name}'
         end_marker = f'end-{self.name}'
@@ -345,7 +463,7 @@ class QemuSelftestsConfig(TestConfig):
 
         gen_script(f'{test_dir}/run.sh', '\n'.join(script))
 
-        selftests_tar = f'{state.build_dir}/{self.selftests.output_dir}/selftests.tar.gz'
+        selftests_tar = f'{state.build_dir}/{self.selftests.output_dir}/selftests.tar.{self.selftests_format}'
         run(f'ln -sf {selftests_tar}'.split(), cwd=test_dir, check=True)
 
         # Pass selftest to qemu
@@ -408,6 +526,13 @@ class TestSuite:
         return build
 
 
+def env_int(name, default=None):
+    val = os.environ.get(name, None)
+    if val is None:
+        return default
+    return int(val)
+
+
 def ngci_get_parser():
     parser = argparse.ArgumentParser(description='Not Good (Very Bad) CI harness')
     parser.add_argument('--dry-run', action='store_true', help='Dry run')
@@ -415,10 +540,43 @@ def ngci_get_parser():
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose messages')
     parser.add_argument('-j', dest='jfactor', type=int, default=int(os.environ.get('JFACTOR', 1)),
                         help='Kernel build parallelism')
-    parser.add_argument('-k', dest='kfactor', type=int, default=int(os.environ.get('KFACTOR', 1)),
+    parser.add_argument('-k', dest='kfactor', type=int, default=env_int('KFACTOR'),
                         help='Number of concurrent kernel builds')
-    parser.add_argument('-b', dest='bfactor', type=int, default=int(os.environ.get('BFACTOR', 1)),
+    parser.add_argument('-b', dest='bfactor', type=int, default=env_int('BFACTOR'),
                         help='Number of concurrent boots')
+    parser.add_argument('--pull-images', action='store_true',
+                        help='Try pulling missing build images before building them locally')
+    parser.add_argument('--image-jobs', dest='ifactor', type=int, default=env_int('IFACTOR', 4),
+                        help='Number of build images to check/pull/build concurrently')
+    parser.add_argument('-c', '--cpus', dest='cpu_budget', type=int, default=env_int('CPU_BUDGET', 0),
+                        help='Number of host CPUs to share between all builds and boots')
+    parser.add_argument('-m', '--mem', dest='mem_budget', type=int, default=env_int('MEM_BUDGET', 0),
+                        help='Host memory (MB) to share between all builds and boots')
+    parser.add_argument('--build-cache', type=str, default=os.environ.get('BUILD_CACHE', None),
+                        help='Directory to cache kernel builds in, reused while the inputs are unchanged')
+    parser.add_argument('--ccache', type=str, default=os.environ.get('CCACHE_ROOT', None),
+                        help='Directory to keep a ccache per build image in')
+    parser.add_argument('--ccache-size', type=str, default=os.environ.get('CCACHE_SIZE', '10G'),
+                        help='Maximum size of each image\'s ccache, eg. 10G')
+    parser.add_argument('--warm-trees', type=str, default=os.environ.get('WARM_TREES', None),
+                        help='Directory to keep kernel build trees in, for incremental rebuilds')
+    parser.add_argument('--seed-variants', action='store_true',
+                        help='Start building config variants from a copy of their base build')
+    parser.add_argument('--workers', action='store_true',
+                        help='Build in one long lived container per image, rather than one per build')
+    parser.add_argument('-A', '--artifact', dest='artifacts', type=str, default=[], action='append',
+                        choices=['modules', 'compile_commands'],
+                        help='Produce an optional build output even if nothing in the suite uses it')
+    parser.add_argument('--dump-tables', action='store_true',
+                        help='Decode the fixup, exception, mcount and syscall tables of each powerpc vmlinux built, into tables.json')
+    parser.add_argument('--fs-images', action='store_true',
+                        help='Give qemu guests modules/selftests as filesystem images to mount, rather than tarballs to extract')
+    parser.add_argument('--abort-on-warning', action='store_true',
+                        help='Stop qemu guests as soon as a warning is seen on the console, rather than at the end')
+    parser.add_argument('--bake-cloud-init', action='store_true',
+                        help='Boot qemu cloud images from a copy that has already run cloud-init\'s first boot')
+    parser.add_argument('--boot-snapshots', type=str, default=os.environ.get('BOOT_SNAPSHOTS', None),
+                        help='Directory to keep snapshots of booted qemu guests in, boots of the same kernel restore from them')
     parser.add_argument('-K', dest='kfilter', type=str, default=None, action='append', help='Filter kernel builds')
     parser.add_argument('-S', dest='sfilter', type=str, default=None, action='append', help='Filter selftest builds')
     parser.add_argument('-B', dest='bfilter', type=str, default=None, action='append', help='Filter boots')
@@ -478,6 +636,13 @@ def ngci_args(args, test_suite):
     logging.info(f'jfactor: {state.jfactor} # kernel build parallelism')
     logging.info(f'kfactor: {state.kfactor} # number of concurrent kernel builds')
     logging.info(f'bfactor: {state.bfactor} # number of concurrent boots')
+    logging.info(f'ifactor: {state.ifactor} # number of images prepared concurrently')
+    if state.pull_images:
+        logging.info('pulling missing images before building them')
+    if state.cpu_budget:
+        logging.info(f'cpus:    {state.cpu_budget} # CPUs shared by builds and boots')
+    if state.mem_budget:
+        logging.info(f'mem:     {state.mem_budget} # MB of memory shared by builds and boots')
     if state.kfilter:
         logging.info(f'kfilter: {state.kfilter} # kernel build filter')
     if state.sfilter:
@@ -488,6 +653,29 @@ def ngci_args(args, test_suite):
         logging.info(f'tfilter: {state.tfilter} # test filter')
     if args.images:
         logging.info(f'images: {args.images}')
+    if state.build_cache:
+        logging.info(f'build cache: {state.build_cache}')
+    if state.ccache:
+        logging.info(f'ccache:  {state.ccache} # max {state.ccache_size} per image')
+    if state.warm_trees:
+        logging.info(f'warm trees: {state.warm_trees}')
+    if state.seed_variants:
+        if state.workers:
+            logging.warning('not seeding variant builds, workers build each at its own path')
+        else:
+            logging.info('seeding variant builds from their base builds')
+    if state.workers:
+        logging.info('building in worker containers')
+    if state.artifacts:
+        logging.info(f'artifacts: {state.artifacts} # produced for every kernel')
+    if state.dump_tables:
+        logging.info('dumping the tables of each vmlinux built')
+    if state.abort_on_warning:
+        logging.info('stopping qemu guests on the first warning')
+    if state.bake_cloud_init:
+        logging.info('booting cloud images with cloud-init already run')
+    if state.boot_snapshots:
+        logging.info(f'boot snapshots: {state.boot_snapshots}')
     logging.info('')
 
     if args.dry_run:
@@ -502,23 +690,46 @@ def ngci_args(args, test_suite):
 def run_one_config(test_suite, state):
     start = datetime.now()
 
-    build_result = build(test_suite, state)
-    if build_result:
-        banner("OK", colour='green')
-    elif test_suite.continue_on_error:
-        banner("Failed - continuing", char='!', colour='red')
+    # Don't seed anything from a previous run's snapshots
+    shutil.rmtree(f'{state.build_dir}/seeds', ignore_errors=True)
 
-    if build_result or test_suite.continue_on_error:
-        boot_result = boot_kernels(test_suite, state)
+    build_jobs = get_build_jobs(test_suite, state)
+    boot_jobs = get_boot_jobs(test_suite, state, build_jobs)
 
-    if not build_result or not boot_result:
-        banner("Failed", char='!', colour='red')
-    else:
+    # Builds that something is waiting on go first, so boots can start early
+    build_jobs = list(build_jobs.values())
+    build_jobs.sort(key=lambda job: len(job.consumers) == 0)
+
+    banner('Building kernels & selftests, booting kernels ...')
+
+    # Get the images ready up front, rather than in the first build using each
+    image_jobs = get_image_jobs(state, build_jobs)
+    root_disk_jobs = get_root_disk_jobs(state, boot_jobs)
+
+    factors = {'image': state.ifactor, 'root-disk': state.ifactor, 'build': state.kfactor, 'boot': state.bfactor}
+    budget = Budget(state.cpu_budget, state.mem_budget)
+
+    try:
+        result = run_jobs(image_jobs + root_disk_jobs + build_jobs + boot_jobs, factors, test_suite.continue_on_error, budget)
+    finally:
+        if state.workers and not state.dry_run:
+            stop_workers(state, [job.args[1] for job in image_jobs])
+
+    if result:
         banner("OK", colour='green')
+    else:
+        banner("Failed", char='!', colour='red')
+
+    # Snapshots of the base builds, only needed while the variants build
+    shutil.rmtree(f'{state.build_dir}/seeds', ignore_errors=True)
+
+    if state.ccache and not state.dry_run:
+        report_ccache_stats(state, test_suite.kernels.values())
 
     end = datetime.now()
     logging.info(f'Completed {test_suite.name} in {end - start}')
 
+    build_result = all(job.result for job in build_jobs)
     return build_result
 
 
@@ -537,29 +748,288 @@ def filter_matches(name, filters):
     return False
 
 
-def build(test_suite, state):
-    banner('Building kernels & selftests ...')
-
-    jobs = []
+def get_build_jobs(test_suite, state):
+    jobs = OrderedDict()
     for k in test_suite.kernels.values():
         if state.kfilter and not filter_matches(k.name, state.kfilter):
             logging.debug(f'Skipping kernel build {k.name} due to filter')
             continue
-        jobs.append(Job(build_one_kernel, (state, k)))
+        jobs[k.name] = Job(build_one_kernel, (state, k), k.name,
+                           cpus=state.jfactor, mem=build_mem_cost(state), elastic=True)
 
     for s in test_suite.selftests.values():
         if state.sfilter and not filter_matches(s.target, state.sfilter):
             logging.debug(f'Skipping selftest build {s.target} due to filter')
             continue
-        jobs.append(Job(build_one_selftest, (state, s)))
+        jobs[s.name] = Job(build_one_selftest, (state, s), s.name,
+                           cpus=state.jfactor, mem=build_mem_cost(state), elastic=True)
+
+    # Workers build each kernel at its own path, so the base's objects would
+    # all be rebuilt anyway
+    if state.seed_variants and not state.workers:
+        for variant, base in get_seed_builds(test_suite.kernels.values()):
+            if variant.name not in jobs or base.name not in jobs:
+                continue
+
+            variant.seed = base
+            base.variants.append(variant)
+            # Wait for the base, but still build if it fails
+            job = jobs[variant.name]
+            job.after.append(jobs[base.name])
+            jobs[base.name].consumers.append(job)
+
+    return jobs
+
+
+def get_seed_builds(kernels):
+    # Returns (variant, base) pairs.
+    # Variants are named <base defconfig>+<suffix>, and can start from the
+    # objects of another build of the same base, with the same compiler.
+    # Sparse builds only check what they compile, so are never seeded.
+    groups = OrderedDict()
+    for k in kernels:
+        if k.sparse:
+            continue
+        base_defconfig = k.defconfig.split('+')[0]
+        key = (base_defconfig, k.image, k.clang, k.llvm_ias)
+        groups.setdefault(key, []).append(k)
+
+    seeds = []
+    for (base_defconfig, *_), group in groups.items():
+        if len(group) < 2:
+            continue
+
+        # Prefer the plain defconfig if it's built, otherwise the first one
+        base = group[0]
+        for k in group:
+            if k.defconfig == base_defconfig:
+                base = k
+                break
+
+        for k in group:
+            if k is not base:
+                seeds.append((k, base))
+
+    return seeds
+
+
+def get_image_jobs(state, build_jobs):
+    jobs = OrderedDict()
+    for build_job in build_jobs:
+        full_image = build_job.args[1].full_image
+        if full_image not in jobs:
+            jobs[full_image] = Job(prepare_image, (state, full_image), f'image@{full_image}', kind='image')
+
+        job = jobs[full_image]
+        build_job.deps = build_job.deps + [job]
+        job.consumers.append(build_job)
+
+    return list(jobs.values())
+
+
+def boot_script_settings(state, script):
+    # Returns the machine a qemu boot script's QemuConfig is for, the smp and
+    # mem it sets itself if any, and the arguments wrappers of it pass it.
+    args = []
+    body = ''
+    while True:
+        try:
+            body = open(f'{state.script_dir}/scripts/boot/{script}').read()
+        except OSError:
+            break
+
+        m = re.search(r'^exec "\$\(dirname "\$0"\)"/(\S+)(.*)"\$@"', body, re.M)
+        if m is None:
+            break
+
+        # Each wrapper's arguments go before those it was passed
+        script = m.group(1)
+        args = shlex.split(m.group(2)) + args
+
+    m = re.search(r"QemuConfig\('([^']+)'\)", body)
+    machine = m.group(1) if m else ''
+    m = re.search(r'qconf\.smp\s*=\s*(\d+)', body)
+    smp = m.group(1) if m else None
+    m = re.search(r"qconf\.mem\s*=\s*'([^']+)'", body)
+    mem = m.group(1) if m else None
+
+    return (machine, args, smp, mem)
+
+
+def overlay_spec_name(spec):
+    image, baked, provisioned, size = spec
+    name = image
+    if baked:
+        name += '+cloud-init'
+    if provisioned:
+        name += f'+{provisioned}'
+    if size:
+        name += f'@{size}'
+    return name
+
+
+def get_root_disk_jobs(state, boot_jobs):
+    # Overlays for the boots of each root disk, created ahead of the boots
+    groups = OrderedDict()
+    for boot_job in boot_jobs:
+        boot = boot_job.args[1]
+        spec = boot.overlay_spec(state)
+        if spec:
+            groups.setdefault(spec, []).append(boot)
+
+    jobs = []
+    for spec, boots in groups.items():
+        # If the image is derived and doesn't exist yet, the boot that
+        # creates it makes the overlays for the others instead.
+        for boot in boots:
+            boot.overlay_pool = len(boots)
+
+        jobs.append(Job(prepare_root_disk, (state, spec, len(boots)),
+                        f'root-disk@{overlay_spec_name(spec)}', kind='root-disk'))
+
+    return jobs
 
-    result = run_jobs(jobs, state.kfactor, test_suite.continue_on_error)
-    return result
 
+def prepare_root_disk(state, spec, count, number, total):
+    name = overlay_spec_name(spec)
+    logging.info(f'Preparing root disk {number}/{total} {name}, {count} overlays ...')
 
-def build_one_kernel(state, kernel, number, total):
+    if state.dry_run:
+        return True
+
+    rdpath = f'{state.script_dir}/root-disks'
+    try:
+        # Not an error, the boots will create what they need
+        image = boot_overlay_image(rdpath, spec)
+        if image is None:
+            logging.info(f'Not preparing overlays, {name} not created yet')
+            return True
+
+        fill_overlay_pool(rdpath, image, count, spec[3])
+    except (OSError, CalledProcessError) as e:
+        logging.warning(f'Failed preparing overlays of {name}: {e}')
+
+    return True
+
+
+def prepare_image(state, full_image, number, total):
+    logging.info(f'Preparing image {number}/{total} {full_image} ...')
+
+    if state.dry_run:
+        return True
+
+    image_dir = f'{state.build_dir}/images'
+    mkdirp(image_dir)
+    log_path = f'{image_dir}/{full_image}.log'
+    log = open(log_path, 'w')
+
+    base_cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
+
+    # Use the local image if there is one, otherwise build it, or with
+    # --pull-images try pulling it first. Either way the containers run the
+    # scripts from this tree, not the image's copies.
+    start = datetime.now()
+    how = 'found'
+    if get_image_id(state, full_image) is None:
+        result = None
+        if state.pull_images:
+            how = 'pulled'
+            cmd = base_cmd + [f'pull-image@{full_image}']
+            logging.debug(cmd)
+            result = run(cmd, stdout=log, stderr=log, stdin=DEVNULL)
+        if result is None or result.returncode != 0:
+            how = 'built'
+            cmd = base_cmd + [f'image@{full_image}']
+            logging.debug(cmd)
+            result = run(cmd, stdout=log, stderr=log, stdin=DEVNULL)
+            if result.returncode != 0:
+                log.close()
+                logging.error(colored(f'Failed preparing image {full_image}', 'red'))
+                logging.info(f'See: {log_path}')
+                dump_log(log_path)
+                return False
+    end = datetime.now()
+    log.close()
+
+    logging.info(f'{ok()} Image {full_image} {how} in {end - start}')
+
+    if state.workers:
+        start_worker(state, full_image)
+
+    return True
+
+
+def worker_name(state, full_image):
+    return f'{state.worker_prefix}-{full_image.replace("@", "-")}'
+
+
+def start_worker(state, full_image):
+    # Start a container for the image, that builds are then exec'ed in. It
+    # sees the output directories at the same paths as the host does, so
+    # the output directory for each build can be passed at exec time.
+    build_dir = os.path.realpath(state.build_dir)
+    mkdirp(build_dir)
+    binds = [f'-v {state.config_dir}:/configs:ro', f'-v {build_dir}:{build_dir}:rw,z']
+    if state.warm_trees:
+        mkdirp(state.warm_trees)
+        warm_trees = os.path.realpath(state.warm_trees)
+        binds.append(f'-v {warm_trees}:{warm_trees}:rw,z')
+    env = dict(os.environ, DOCKER_EXTRA_ARGS=' '.join(binds))
+
+    name = worker_name(state, full_image)
+    cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
+    cmd.append(f'SRC={state.src}')
+    cmd.append(f'CI_OUTPUT={build_dir}')
+    cmd.append(f'WORKER={name}')
+    if state.ccache:
+        cmd.append(f'CCACHE={setup_ccache(state, full_image.split("@", 1)[1])}')
+    cmd.append(f'start-worker@{full_image}')
+    logging.debug(cmd)
+
+    result = run(cmd, stdin=DEVNULL, capture_output=True, env=env)
+    if result.returncode != 0:
+        # build.sh will just start a container per build for this image
+        logging.warning(f'Failed starting worker for {full_image}')
+        logging.debug(result.stdout.decode('utf-8', errors='replace'))
+        return
+
+    logging.info(f'Started worker {name}')
+
+
+def stop_workers(state, full_images):
+    for full_image in full_images:
+        cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
+        cmd.append(f'SRC={state.src}')
+        cmd.append(f'WORKER={worker_name(state, full_image)}')
+        cmd.append(f'stop-worker@{full_image}')
+        logging.debug(cmd)
+        run(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+
+def get_artifacts(state, kernel):
+    # The optional outputs of a kernel build that something will use
+    return sorted(kernel.artifacts | set(state.artifacts))
+
+
+def tarball_formats(formats):
+    # If nothing needs a particular format use gzip, which every host and
+    # image has, unlike zstd.
+    if len(formats) == 0:
+        return 'gz'
+    return ','.join(sorted(formats))
+
+
+def build_mem_cost(state):
+    # Rough guess, in MB, of what each compiler process needs
+    return state.jfactor * 512
+
+
+def build_one_kernel(state, kernel, number, total, jfactor=None):
     logging.info(f'Building {number}/{total} {kernel.name} ...')
 
+    if jfactor is None:
+        jfactor = state.jfactor
+
     extra = f"-v {state.config_dir}:/configs:ro"
     os.environ['DOCKER_EXTRA_ARGS'] = extra
 
@@ -567,7 +1037,7 @@ def build_one_kernel(state, kernel, number, total):
     base_cmd.append(f'SRC={state.src}')
     base_cmd.append(f'DEFCONFIG={kernel.defconfig}')
     base_cmd.append(f'CI_OUTPUT={state.build_dir}')
-    base_cmd.append(f'JFACTOR={state.jfactor}')
+    base_cmd.append(f'JFACTOR={jfactor}')
     base_cmd.append('QUIET=1')
 
     if kernel.clang:
@@ -580,12 +1050,22 @@ def build_one_kernel(state, kernel, number, total):
     if kernel.sparse:
         base_cmd.append('SPARSE=1')
 
-    full_image = f'{kernel.subarch}@{kernel.image}'
+    if state.ccache:
+        base_cmd.append(f'CCACHE={setup_ccache(state, kernel.image)}')
+
+    full_image = kernel.full_image
+    if state.workers:
+        base_cmd.append(f'WORKER={worker_name(state, full_image)}')
+
     cmd = copy(base_cmd)
     cmd.append(f'kernel@{full_image}')
 
-    if kernel.modules:
+    artifacts = get_artifacts(state, kernel)
+    cmd.append(f'ARTIFACTS={",".join(artifacts) or "none"}')
+
+    if kernel.modules and 'modules' in artifacts:
         cmd.append('MODULES=1')
+        cmd.append(f'MODULES_FORMATS={tarball_formats(kernel.modules_formats)}')
 
     if kernel.merge_config:
         configs = munge_configs(state, kernel.merge_config)
@@ -603,6 +1083,20 @@ def build_one_kernel(state, kernel, number, total):
 
     ci_output_dir = f'{state.build_dir}/{kernel.dir_name()}'
     mkdirp(ci_output_dir)
+
+    cache_key = None
+    if state.build_cache and not state.dry_run:
+        cache_key = kernel_cache_key(state, kernel)
+        if cache_key and restore_cached_kernel(state, cache_key, ci_output_dir):
+            logging.info(f'{ok()} Build of {kernel.name} found in cache ({cache_key[:12]})')
+            # The cached build may predate --dump-tables
+            if state.dump_tables and not os.path.exists(f'{ci_output_dir}/tables.json'):
+                dump_kernel_tables(kernel, ci_output_dir)
+            return True
+
+    if kernel.seed and not state.dry_run and not state.warm_trees:
+        seed_build_tree(state, kernel, base_cmd, full_image, state.build_dir)
+
     log_path = f'{ci_output_dir}/log.txt'
     log = open(log_path, 'w')
 
@@ -611,6 +1105,12 @@ def build_one_kernel(state, kernel, number, total):
     if state.dry_run:
         return True
 
+    if state.warm_trees:
+        warm_inputs, reused = prepare_warm_tree(state, kernel, base_cmd, cmd, full_image, log)
+        cmd = with_output(cmd, state.warm_trees)
+        if kernel.seed and not reused:
+            seed_build_tree(state, kernel, base_cmd, full_image, state.warm_trees)
+
     start = datetime.now()
     result = run(cmd, stdout=log, stderr=log, stdin=DEVNULL)
     end = datetime.now()
@@ -624,15 +1124,343 @@ def build_one_kernel(state, kernel, number, total):
 
     logging.info(f'{ok()} Build of {kernel.name} took {end - start}')
 
-    cmd = copy(base_cmd)
-    cmd.append(f'prune-kernel@{full_image}')
+    if state.warm_trees:
+        # Copy the artifacts out, the tree is kept for next time
+        cmd = with_output(base_cmd, state.warm_trees)
+        cmd.append(f'EXPORT_DIR={ci_output_dir}')
+        cmd.append(f'export-kernel@{full_image}')
+        logging.debug(cmd)
+        run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
+        stamp_warm_tree(state, kernel, warm_inputs)
+    else:
+        if kernel.variants:
+            # Keep a copy of the objects for the variants to start from
+            snapshot = seed_dir(state, kernel)
+            shutil.rmtree(snapshot, ignore_errors=True)
+            mkdirp(os.path.dirname(snapshot))
+            run(['cp', '-a', '--reflink=auto', ci_output_dir, snapshot], check=True)
+
+        cmd = copy(base_cmd)
+        cmd.append(f'prune-kernel@{full_image}')
+        logging.debug(cmd)
+        run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
+    log.close()
+
+    if state.dump_tables:
+        dump_kernel_tables(kernel, ci_output_dir)
+
+    if state.build_cache:
+        # The image may only have been created by this build, so try again
+        if cache_key is None:
+            cache_key = kernel_cache_key(state, kernel)
+        if cache_key:
+            store_cached_kernel(state, cache_key, ci_output_dir)
+
+    return True
+
+
+def dump_kernel_tables(kernel, ci_output_dir):
+    # Decode the tables in-process, they're only in powerpc kernels
+    vmlinux = f'{ci_output_dir}/vmlinux'
+    output = f'{ci_output_dir}/tables.json'
+    if not os.path.exists(vmlinux):
+        return
+
+    try:
+        if get_elf(vmlinux).machine not in (EM_PPC, EM_PPC64):
+            return
+        tables = dump_all(vmlinux, output)
+    except Exception as e:
+        logging.warning(f'Failed dumping tables of {kernel.name}: {e}')
+        return
+
+    if tables is None:
+        logging.warning(f'No symbols to dump the tables of {kernel.name} with')
+    else:
+        logging.debug(f'Dumped {len(tables)} tables of {kernel.name} to {output}')
+
+
+def get_image_id(state, full_image):
+    cmd = ['make', '--no-print-directory', '-s', '-C', f'{state.script_dir}/build', f'image-id@{full_image}']
+    result = run(cmd, stdin=DEVNULL, capture_output=True)
+    if result.returncode != 0:
+        return None
+
+    lines = result.stdout.decode('utf-8').split()
+    if len(lines) == 0:
+        return None
+
+    return lines[-1]
+
+
+def kernel_config_hash(state, kernel, image_id):
+    # Hash of everything other than the source that goes into a kernel build
+    h = sha1()
+    h.update(f'image={image_id}\n'.encode('utf-8'))
+    h.update(f'defconfig={kernel.defconfig}\n'.encode('utf-8'))
+    h.update(f'subarch={kernel.subarch}\n'.encode('utf-8'))
+    for flag in ['clang', 'llvm_ias', 'sparse', 'modules']:
+        h.update(f'{flag}={getattr(kernel, flag)}\n'.encode('utf-8'))
+
+    if kernel.merge_config:
+        configs = munge_configs(state, kernel.merge_config)
+        if configs is None:
+            return None
+
+        for path in configs:
+            # Map the container paths back to the host
+            if path.startswith('/linux/'):
+                host_path = f'{state.src}/{path[7:]}'
+            else:
+                host_path = f'{state.config_dir}/{path[9:]}'
+
+            h.update(f'config={path}\n'.encode('utf-8'))
+            h.update(open(host_path, 'rb').read())
+
+    return h.hexdigest()
+
+
+def kernel_cache_key(state, kernel):
+    # Returns None if the build can't be cached, eg. the source tree is dirty
+    result = run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                 cwd=state.src, capture_output=True)
+    if result.returncode != 0 or len(result.stdout):
+        logging.debug(f'Not caching {kernel.name}, source tree is dirty')
+        return None
+
+    result = run(['git', 'rev-parse', 'HEAD^{tree}'], cwd=state.src, capture_output=True)
+    if result.returncode != 0:
+        return None
+    tree = result.stdout.decode('utf-8').strip()
+
+    image_id = get_image_id(state, kernel.full_image)
+    if image_id is None:
+        logging.debug(f'Not caching {kernel.name}, no image id for {kernel.image}')
+        return None
+
+    config_hash = kernel_config_hash(state, kernel, image_id)
+    if config_hash is None:
+        return None
+
+    h = sha1()
+    h.update(f'tree={tree}\n'.encode('utf-8'))
+    h.update(f'config={config_hash}\n'.encode('utf-8'))
+    # Which optional outputs were produced
+    h.update(f'artifacts={get_artifacts(state, kernel)}\n'.encode('utf-8'))
+    h.update(f'modules_formats={tarball_formats(kernel.modules_formats)}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def with_output(cmd, output):
+    return [f'CI_OUTPUT={output}' if arg.startswith('CI_OUTPUT=') else arg for arg in cmd]
+
+
+def file_sha1(path):
+    if not os.path.exists(path):
+        return None
+    return sha1(open(path, 'rb').read()).hexdigest()
+
+
+def prepare_warm_tree(state, kernel, base_cmd, cmd, full_image, log):
+    # Cleans the warm tree unless it's safe to build incrementally in it.
+    # Returns the hash of the build inputs, to stamp the tree with once the
+    # build has succeeded.
+    warm_dir = f'{state.warm_trees}/{kernel.dir_name()}'
+    stamp_path = f'{warm_dir}.stamp'
+
+    image_id = get_image_id(state, full_image)
+    inputs = None
+    if image_id:
+        inputs = kernel_config_hash(state, kernel, image_id)
+
+    reuse = False
+    if inputs and os.path.isdir(warm_dir) and os.path.exists(stamp_path):
+        old_inputs, old_config = open(stamp_path).read().split()
+        if old_inputs != inputs:
+            logging.info(f'Image or config inputs for {kernel.name} changed, cleaning warm tree')
+        else:
+            # Regenerate the .config, the tree is only reused if that comes
+            # out the same as for the last build in it.
+            config_cmd = with_output(cmd, state.warm_trees)
+            config_cmd.append('CONFIG_ONLY=1')
+            logging.debug(config_cmd)
+            result = run(config_cmd, stdout=log, stderr=log, stdin=DEVNULL)
+            if result.returncode == 0 and file_sha1(f'{warm_dir}/.config') == old_config:
+                reuse = True
+            else:
+                logging.info(f'Resolved .config for {kernel.name} changed, cleaning warm tree')
+
+    # Only put back once the build succeeds, so a failed build is never reused
+    if os.path.exists(stamp_path):
+        os.unlink(stamp_path)
+
+    if reuse:
+        logging.info(f'Building {kernel.name} incrementally in {warm_dir}')
+        # Everything in the tree is exported after the build, so drop outputs
+        # this build might not produce, eg. from other ARTIFACTS or SPARSE.
+        # Also ccache appends to its stats log.
+        clean_artifacts(base_cmd, full_image, state.warm_trees, log)
+    else:
+        clean_cmd = with_output(base_cmd, state.warm_trees)
+        clean_cmd.append(f'clean-kernel@{full_image}')
+        logging.debug(clean_cmd)
+        run(clean_cmd, stdin=DEVNULL, check=True)
+
+    return (inputs, reuse)
+
+
+def seed_dir(state, kernel):
+    # Where the object tree of a build that seeds others can be found
+    if state.warm_trees:
+        return f'{state.warm_trees}/{kernel.dir_name()}'
+    return f'{state.build_dir}/seeds/{kernel.dir_name()}'
+
+
+def seed_build_tree(state, kernel, base_cmd, full_image, output):
+    # Without workers both trees are built at /output in the container, so the
+    # paths recorded by kbuild still match, and only what the config change
+    # touches is rebuilt. Workers build at the host paths, which differ, so
+    # variants aren't seeded then, see get_build_jobs().
+    seed = seed_dir(state, kernel.seed)
+    if not os.path.isdir(f'{seed}/include/config'):
+        logging.info(f'No objects from {kernel.seed.name} to seed {kernel.name} from')
+        return
+
+    logging.info(f'Seeding {kernel.name} from {kernel.seed.name}')
+    tree = f'{output}/{kernel.dir_name()}'
+    mkdirp(tree)
+    run(['cp', '-a', '--reflink=auto', f'{seed}/.', f'{tree}/'], check=True)
+
+    # The base's outputs aren't this build's, even if it doesn't replace them
+    clean_artifacts(base_cmd, full_image, output)
+
+
+def clean_artifacts(base_cmd, full_image, output, log=None):
+    # Removes the outputs from a build tree, leaving the objects
+    cmd = with_output(base_cmd, output)
+    cmd.append(f'clean-artifacts@{full_image}')
     logging.debug(cmd)
     run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
-    log.close()
 
+
+def stamp_warm_tree(state, kernel, inputs):
+    if inputs is None:
+        # Couldn't identify the image, so the tree can't be safely reused
+        return
+
+    warm_dir = f'{state.warm_trees}/{kernel.dir_name()}'
+    with open(f'{warm_dir}.stamp', 'w') as f:
+        f.write(f'{inputs}\n{file_sha1(f"{warm_dir}/.config")}\n')
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def restore_cached_kernel(state, key, ci_output_dir):
+    cache_dir = f'{state.build_cache}/{key}'
+    if not os.path.isdir(cache_dir):
+        return False
+
+    logging.debug(f'Restoring {ci_output_dir} from {cache_dir}')
+    for name in os.listdir(cache_dir):
+        link_or_copy(f'{cache_dir}/{name}', f'{ci_output_dir}/{name}')
+
+    with open(f'{ci_output_dir}/log.txt', 'w') as log:
+        log.write(f'Restored from build cache {cache_dir}\n')
+
+    # Bump the mtime so old entries can be expired by age
+    os.utime(cache_dir)
     return True
 
 
+def store_cached_kernel(state, key, ci_output_dir):
+    cache_dir = f'{state.build_cache}/{key}'
+    if os.path.isdir(cache_dir):
+        return
+
+    # Populate a temporary directory and rename it into place, so concurrent
+    # runs never see a partial entry.
+    tmp_dir = f'{cache_dir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    mkdirp(tmp_dir)
+    for name in os.listdir(ci_output_dir):
+        path = f'{ci_output_dir}/{name}'
+        # The log is rewritten in place by later builds, so don't share it,
+        # and the ccache stats are only meaningful for the build that did them
+        if os.path.isfile(path) and name not in ['log.txt', 'ccache-stats.log']:
+            link_or_copy(path, f'{tmp_dir}/{name}')
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+        logging.debug(f'Stored {ci_output_dir} in {cache_dir}')
+    except OSError:
+        # Someone else stored it first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def setup_ccache(state, image):
+    # One cache per image, they can't share objects anyway as the compilers
+    # differ, and that way one busy image can't evict everything else.
+    path = os.path.realpath(f'{state.ccache}/{image}')
+    mkdirp(path)
+
+    # ccache reads this from CCACHE_DIR, and evicts the oldest files once
+    # the cache grows past max_size.
+    conf = f'max_size = {state.ccache_size}\n'
+    conf_path = f'{path}/ccache.conf'
+    if not os.path.exists(conf_path) or open(conf_path).read() != conf:
+        with open(conf_path, 'w') as f:
+            f.write(conf)
+
+    return path
+
+
+def read_ccache_stats(path):
+    # The stats log has a "# <file>" line per compile followed by the
+    # counters it bumped, eg. direct_cache_hit or cache_miss.
+    hits = misses = 0
+    for line in open(path):
+        line = line.strip()
+        if line.startswith('#') or len(line) == 0:
+            continue
+        if 'cache_hit' in line:
+            hits += 1
+        elif 'cache_miss' in line:
+            misses += 1
+
+    return (hits, misses)
+
+
+def report_ccache_stats(state, kernels):
+    def pct(hits, misses):
+        total = hits + misses
+        return f'{hits}/{total} ({100 * hits / total:.1f}%)' if total else '-'
+
+    total_hits = total_misses = 0
+    lines = []
+    for kernel in kernels:
+        path = f'{state.build_dir}/{kernel.dir_name()}/ccache-stats.log'
+        if not os.path.exists(path):
+            continue
+
+        hits, misses = read_ccache_stats(path)
+        total_hits += hits
+        total_misses += misses
+        lines.append(f'  {kernel.name:64} {pct(hits, misses)}')
+
+    if len(lines) == 0:
+        return
+
+    logging.info('ccache hits:')
+    for line in lines:
+        logging.info(line)
+    logging.info(f'  {"total":64} {pct(total_hits, total_misses)}')
+
+
 def munge_configs(state, merge_config):
     l = []
     for path in merge_config:
@@ -658,18 +1486,24 @@ def munge_configs(state, merge_config):
     return l
 
 
-def build_one_selftest(state, selftest, number, total):
+def build_one_selftest(state, selftest, number, total, jfactor=None):
     logging.info(f'Building {number}/{total} {selftest.target} for {selftest.full_image} ...')
 
+    if jfactor is None:
+        jfactor = state.jfactor
+
     base_cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
     base_cmd.append(f'SRC={state.src}')
     base_cmd.append(f'CI_OUTPUT={state.build_dir}')
-    base_cmd.append(f'JFACTOR={state.jfactor}')
+    base_cmd.append(f'JFACTOR={jfactor}')
     base_cmd.append('QUIET=1')
 
     if selftest.target == 'ppctests':
         base_cmd.append('TARGETS=powerpc')
 
+    if state.workers:
+        base_cmd.append(f'WORKER={worker_name(state, selftest.full_image)}')
+
     cmd = copy(base_cmd)
     cmd.append('INSTALL=1')
     cmd.append(f'{selftest.target}@{selftest.full_image}')
@@ -705,6 +1539,7 @@ def build_one_selftest(state, selftest, number, total):
     logging.info(f'{ok()} Build of {selftest.target} for {selftest.full_image} took {end - start}')
 
     cmd = copy(base_cmd)
+    cmd.append(f'SELFTESTS_FORMATS={tarball_formats(selftest.formats)}')
     cmd.append(f'prune-selftests@{selftest.full_image}')
     logging.debug(cmd)
     run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
@@ -712,16 +1547,13 @@ def build_one_selftest(state, selftest, number, total):
 
     return True
 
-def boot_kernels(test_suite, state):
+def get_boot_jobs(test_suite, state, build_jobs):
+    jobs = []
     if len(test_suite.boots) == 0:
-        return True
-
-    banner('Booting kernels ...')
+        return jobs
 
     mkdirp(f'{state.boot_dir}')
 
-    n = 1
-    jobs = []
     have_kvm = kvm_present()
     pattern = re.compile('\\bkvm\\b')
     for boot in test_suite.boots.values():
@@ -733,11 +1565,29 @@ def boot_kernels(test_suite, state):
             logging.warn(colored(f'Skipping boot of {boot.name} due to KVM not present', 'yellow'))
             continue
 
+        # Builds that were filtered out aren't waited on, their artifacts
+        # may be left over from a previous run.
+        deps = []
+        for build in boot.dependencies(state):
+            job = build_jobs.get(build.name, None)
+            if job:
+                deps.append(job)
+
+        # Only the outputs and tarball formats something reads are produced
+        boot.kernel_build.artifacts.add('modules')
+        boot.kernel_build.modules_formats.add(boot.modules_format)
+        for test in boot.get_tests(state):
+            if test.selftests_format:
+                test.selftests.formats.add(test.selftests_format)
+
         logging.debug(f'Adding boot job {boot.name}')
-        jobs.append(Job(boot_and_test, (state, boot)))
+        job = Job(boot_and_test, (state, boot), boot.name, kind='boot', deps=deps,
+                  cpus=boot.cpu_cost(state), mem=boot.mem_cost(state))
+        for dep in deps:
+            dep.consumers.append(job)
+        jobs.append(job)
 
-    result = run_jobs(jobs, state.bfactor, test_suite.continue_on_error)
-    return result
+    return jobs
 
 
 def boot_and_test(state, boot, number, total):
@@ -783,7 +1633,7 @@ def boot_host(state, boot, host_dir, number, total):
 
     boot_args = [
         f'--kernel-path {artifact_dir}/vmlinux',
-        f'--modules-path {artifact_dir}/modules.tar.gz',
+        f'--modules-path {artifact_dir}/modules.tar.{boot.modules_format}',
         f'--release-path {artifact_dir}/kernel.release'
     ]
 
@@ -888,56 +1738,159 @@ def dump_log(path, message=None):
 
 
 class Job:
-    def __init__(self, func, args):
+    def __init__(self, func, args, name, kind='build', deps=[], cpus=1, mem=0, elastic=False):
         self.func = func
         self.args = args
+        self.name = name
+        self.kind = kind
+        self.deps = deps
+        self.after = []        # jobs to wait for, that don't have to succeed
+        self.cpus = cpus       # CPUs the job will keep busy
+        self.mem = mem         # memory (MB) the job will use
+        self.elastic = elastic # can be given more CPUs, via func(..., jfactor=cpus)
+        self.consumers = []
+        self.proc = None
+        self.result = None
+        self.queued = None     # when the job became runnable
+        self.start = None
+        self.end = None
+
+    def ready(self):
+        # All dependencies have finished, one way or another
+        return all(dep.result is not None for dep in self.deps + self.after)
+
+    def blocked(self):
+        return not all(dep.result for dep in self.deps)
 
     def run(self, number, total):
+        kwargs = {}
+        if self.elastic:
+            kwargs['jfactor'] = self.cpus
+
         def f():
-            return sys.exit(0 if self.func(*self.args, number, total) else 1)
+            return sys.exit(0 if self.func(*self.args, number, total, **kwargs) else 1)
 
+        self.start = datetime.now()
         self.proc = Process(target=f)
         self.proc.start()
 
 
-# make -j in python ¯\_(ツ)_/¯
-def run_jobs(jobs, factor, continue_on_error):
-    if factor == 0:
-        factor = len(jobs)
+class Budget:
+    # Host CPUs and memory (MB) shared by all running jobs, 0 means unlimited
+    def __init__(self, cpus=0, mem=0):
+        self.cpus = cpus
+        self.mem = mem
+        self.used_cpus = 0
+        self.used_mem = 0
+
+    def free_cpus(self):
+        return self.cpus - self.used_cpus
 
-    n = 1
-    total = len(jobs)
+    def fits(self, job):
+        # A job bigger than the whole budget still fits once nothing else is running
+        if self.cpus and self.used_cpus and self.used_cpus + min(job.cpus, self.cpus) > self.cpus:
+            return False
+        if self.mem and self.used_mem and self.used_mem + min(job.mem, self.mem) > self.mem:
+            return False
+        return True
+
+    def take(self, job):
+        self.used_cpus += job.cpus
+        self.used_mem += job.mem
+
+    def release(self, job):
+        self.used_cpus -= job.cpus
+        self.used_mem -= job.mem
+
+
+# make -j in python ¯\_(ツ)_/¯
+#
+# Jobs are started as soon as the jobs they depend on have completed, with at
+# most factors[kind] jobs of each kind running at once (0 means no limit), and
+# the CPUs/memory used by all running jobs kept within the budget.
+def run_jobs(jobs, factors, continue_on_error, budget=None):
+    if budget is None:
+        budget = Budget()
+
+    totals = {}
+    for job in jobs:
+        totals[job.kind] = totals.get(job.kind, 0) + 1
+
+    numbers = {kind: 1 for kind in totals}
+    limits = {kind: factors.get(kind, 0) or totals[kind] for kind in totals}
     result = True
+    pending = list(jobs)
     running = []
 
-    def wait_for_one_job(timeout=None):
-        job = running.pop(0)
-        job.proc.join(timeout)
-        if job.proc.exitcode is None:
-            # Didn't exit, put it at the back
-            running.append(job)
-            return None
-        return job.proc.exitcode == 0
-
-    while len(jobs) and (result or continue_on_error):
-        while len(running) < factor and len(jobs):
-            try:
-                job = jobs.pop(0)
-            except IndexError:
+    def num_running(kind):
+        return len([job for job in running if job.kind == kind])
+
+    def wait_for_jobs():
+        # Wakes up as soon as any running job exits
+        sentinels = wait([job.proc.sentinel for job in running])
+        result = True
+        for job in [job for job in running if job.proc.sentinel in sentinels]:
+            job.proc.join()
+            job.end = datetime.now()
+            job.result = job.proc.exitcode == 0
+            running.remove(job)
+            budget.release(job)
+            logging.debug(f'Job {job.name} exited {job.proc.exitcode}, running = {len(running)}')
+            result &= job.result
+        return result
+
+    def grant_cpus(job, ready):
+        # Once nothing else can queue up behind them, share any spare CPUs
+        # between the remaining elastic jobs, eg. the last few kernel builds.
+        if not budget.cpus or not job.elastic:
+            return job.cpus
+
+        if any(j.elastic and not j.ready() for j in pending):
+            return job.cpus
+
+        stragglers = len([j for j in ready if j.elastic and j in pending])
+        return max(job.cpus, budget.free_cpus() // stragglers)
+
+    while len(pending) and (result or continue_on_error):
+        now = datetime.now()
+        ready = [job for job in pending if job.ready()]
+        for job in ready:
+            if not (result or continue_on_error):
                 break
 
-            job.run(n, total)
-            running.append(job)
-            logging.debug(f'Started job {n}, running = {len(running)}')
-            n += 1
-
-        logging.debug(f'Waiting for a job to complete, running = {len(running)}')
-        job_result = wait_for_one_job(10)
-        if job_result is not None:
-            result &= job_result
+            if job.queued is None:
+                job.queued = now
+
+            if job.blocked():
+                pending.remove(job)
+                logging.error(colored(f'Not running {job.name} due to failed dependencies', 'red'))
+                job.result = False
+                result = False
+            elif num_running(job.kind) < limits[job.kind] and budget.fits(job):
+                job.cpus = grant_cpus(job, ready)
+                pending.remove(job)
+                budget.take(job)
+                job.run(numbers[job.kind], totals[job.kind])
+                running.append(job)
+                logging.debug(f'Started {job.kind} job {numbers[job.kind]} using {job.cpus} CPUs, running = {len(running)}')
+                numbers[job.kind] += 1
+
+        if len(running):
+            result &= wait_for_jobs()
 
     while len(running):
-        logging.debug(f'Waiting for a job to complete, running = {len(running)}')
-        result &= wait_for_one_job()
+        result &= wait_for_jobs()
+
+    report_job_times(jobs)
 
     return result
+
+
+def report_job_times(jobs):
+    started = [job for job in jobs if job.start]
+    if len(started) == 0:
+        return
+
+    logging.info('Job times (waited in queue / ran for):')
+    for job in started:
+        logging.info(f'  {job.kind:<9} {job.name:<64} {job.start - job.queued} / {job.end - job.start}')
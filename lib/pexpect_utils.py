@@ -2,6 +2,18 @@ import logging
 import pexpect
 import sys
 import time
+from pexpect.expect import searcher_re
+from utils import WarningMonitor, WarningFound
+
+
+class WindowSearcher(searcher_re):
+    # pexpect searches everything since the last match each time more output
+    # arrives, which is quadratic when there's lots of output between matches.
+    # Setting longest_string makes it search only the new output plus this
+    # much of what came before, which limits how long a match can be.
+    def __init__(self, patterns, window):
+        super().__init__(patterns)
+        self.longest_string = window
 
 
 class PexpectHelper:
@@ -13,6 +25,12 @@ class PexpectHelper:
         r'\( 700 \) Program Exception',
     ]
 
+    # Longest output a pattern can match
+    search_window = 64 * 1024
+
+    # Compiled pattern lists, keyed by the tuple of patterns
+    compiled_patterns = {}
+
     def __init__(self):
         self.child = None
         self.prompt = None
@@ -22,6 +40,8 @@ class PexpectHelper:
     def spawn(self, *args, **kwargs):
         logging.debug("Spawning '%s'" % args)
         quiet = kwargs.pop('quiet', False)
+        # Read in big chunks when there's lots of output, so there are fewer searches
+        kwargs.setdefault('maxread', self.search_window)
         self.child = pexpect.spawn(*args, encoding='utf-8', codec_errors='replace',
                                    echo=False, **kwargs)
         if not quiet:
@@ -30,17 +50,34 @@ class PexpectHelper:
     def log_to(self, output_file):
         self.child.logfile_read = output_file
 
+    def watch_warnings(self, outfile, abort=False):
+        # Check the output for warnings as it arrives, see WarningMonitor
+        self.child.logfile_read = WarningMonitor(outfile, abort, self.child.logfile_read)
+        return self.child.logfile_read
+
     def wait_for_exit(self, timeout=-1):
-        self.child.expect(pexpect.EOF, timeout=timeout)
+        try:
+            self.child.expect(pexpect.EOF, timeout=timeout)
+        except WarningFound as e:
+            self.stop_on_warning(e)
         self.child.wait()
 
     def terminate(self):
         self.child.terminate()
         self.wait_for_exit()
 
+    def stop_on_warning(self, e):
+        # Only the first warning raises, so the child can be reaped here
+        logging.error(f"Error: saw warning, stopping: {e}")
+        self.terminate()
+        raise e
+
     def drain(self):
         # Wait for 10s out of output, which should give oopses time to be logged
-        self.child.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=10)
+        try:
+            self.child.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=10)
+        except WarningFound as e:
+            self.stop_on_warning(e)
 
     def drain_and_terminate(self):
         self.drain()
@@ -59,9 +96,22 @@ class PexpectHelper:
         if bug_patterns is None:
             bug_patterns = self.bug_patterns
 
-        patterns.extend(bug_patterns)
+        # Don't modify the caller's list
+        patterns = tuple(patterns) + tuple(bug_patterns)
+
+        compiled = self.compiled_patterns.get(patterns)
+        if compiled is None:
+            compiled = self.child.compile_pattern_list(list(patterns))
+            self.compiled_patterns[patterns] = compiled
+
+        if timeout == -1:
+            timeout = self.child.timeout
 
-        idx = self.child.expect(patterns, timeout=timeout)
+        searcher = WindowSearcher(compiled, self.search_window)
+        try:
+            idx = self.child.expect_loop(searcher, timeout)
+        except WarningFound as e:
+            self.stop_on_warning(e)
         if self.child.match == pexpect.TIMEOUT:
             logging.debug("Timed out looking for a match")
         else:
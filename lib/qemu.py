@@ -1,4 +1,8 @@
 import argparse
+import fcntl
+import pexpect
+import re
+import time
 import uuid
 import tarfile
 import atexit
@@ -7,6 +11,11 @@ import sys
 import subprocess
 import logging
 import tempfile
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from hashlib import sha1
 from utils import *
 from pexpect_utils import PexpectHelper, standard_boot, ping_test, wget_test
 import qemu_callbacks
@@ -55,6 +64,18 @@ class QemuConfig:
         self.test_base_dir = None
         self.test_name = None
         self.test_tarball = None
+        self.fs_images = False
+        self.modules_image = None
+        self.selftests_image = None
+        self.cloud_overlay = None
+        self.boot_snapshot_dir = None
+        self.boot_snapshot_max = 8
+        self.bake_cloud_init = False
+        self.abort_on_warning = False
+        self.provision = False
+        self.provisioning = False
+        self.provisioned = False
+        self.overlay_pool = 0
 
         # Detect root disks if we're called from scripts/boot/qemu-xxx
         base = os.path.dirname(sys.argv[0])
@@ -140,7 +161,14 @@ class QemuConfig:
         parser.add_argument('--kernel-path', type=str, help='Path to kernel (vmlinux)')
         parser.add_argument('--modules-path', type=str, help='Path to modules tarball')
         parser.add_argument('--selftests-path', type=str, help='Path to selftests tarball')
+        parser.add_argument('--fs-images', action='store_true', help='Mount modules/selftests from filesystem images rather than extracting the tarballs')
+        parser.add_argument('--boot-snapshot-dir', type=str, help='Directory to keep snapshots of booted guests in, later boots of the same kernel/disks restore from them')
+        parser.add_argument('--boot-snapshot-max', type=int, help='Maximum number of boot snapshots to keep (default 8)')
         parser.add_argument('--test-name', type=self.valid_test_name, help='Path to the test directory in ci-scripts/tests')
+        parser.add_argument('--abort-on-warning', action='store_true', help='Stop the guest as soon as a warning is seen on the console')
+        parser.add_argument('--bake-cloud-init', action='store_true', help='Run cloud-init in a copy of the cloud image once, booting its own kernel, and boot from that (pseries only)')
+        parser.add_argument('--provision', action='store_true', help='Install the dependencies of --test-name into a derived cloud image once, and boot from that')
+        parser.add_argument('--overlay-pool', type=int, help='Number of boots that will use the same root disk, overlays are created for them along with a derived image')
         parser.add_argument('--test-output-dir', type=self.valid_test_op_mnt, help='Path to a folder where test will store the logs')
         parser.add_argument('--test-args', type=self.valid_test_args, help='Test type and configuration for the test provided in --test-name')
         parser.add_argument('--bios', type=str, help='BIOS option for qemu')
@@ -217,7 +245,19 @@ class QemuConfig:
             if args.test_args:
                 self.test_args = args.test_args
 
+        if args.boot_snapshot_dir:
+            self.boot_snapshot_dir = args.boot_snapshot_dir
+
+        if args.boot_snapshot_max:
+            self.boot_snapshot_max = args.boot_snapshot_max
+
+        self.bake_cloud_init = args.bake_cloud_init
+        self.abort_on_warning = args.abort_on_warning
+        self.provision = args.provision
+        if args.overlay_pool:
+            self.overlay_pool = args.overlay_pool
         self.compat_rootfs = args.compat_rootfs
+        self.fs_images = args.fs_images
         self.use_vof = args.use_vof
         self.quiet = args.quiet
         self.net_tests = args.net_tests
@@ -302,16 +342,11 @@ class QemuConfig:
             self.qemu_cmd = f'{self.qemu_path}/{self.qemu_cmd}'
 
         if self.smp is None:
-            if self.machine_is('mac99'): # Doesn't support SMP
-                self.smp = 1
-            elif self.accel == 'tcg':
-                self.smp = 2
-            else:
-                self.smp = 8
+            self.smp = default_smp(self.machine, self.accel)
 
         if self.mem is None:
+            self.mem = default_mem(self.machine)
             if self.machine_is('pseries'):
-                self.mem = '4G'
                 if type(self.smp) is int and self.smp % 4 == 0:
                     cpus = int(self.smp / 4)
                 else:
@@ -324,10 +359,6 @@ class QemuConfig:
                         last  = first + cpus - 1
                         s = f',cpus={first}-{last}'
                     self.extra_args.append(f'-numa node,nodeid={i},memdev=m{i}{s}')
-            elif self.machine_is('powernv'):
-                self.mem = '4G'
-            else:
-                self.mem = '1G'
 
         if self.net is None:
             if self.machine_is('pseries'):
@@ -406,9 +437,19 @@ class QemuConfig:
 
         if self.modules_tarball:
             self.modules_drive = self.add_drive(f'file={self.modules_tarball},format=raw,readonly=on')
+            if self.fs_images:
+                self.modules_image = get_fs_image(self.modules_tarball, 3)
+            if self.modules_image:
+                self.modules_image_drive = self.add_drive(f'file={self.modules_image},format=raw,readonly=on')
 
         if self.selftests_tarball:
             self.selftests_drive = self.add_drive(f'file={self.selftests_tarball},format=raw,readonly=on')
+            if self.fs_images:
+                self.selftests_image = get_fs_image(self.selftests_tarball, 1)
+            if self.selftests_image:
+                # The tests write to their directory, snapshot=on keeps that
+                # out of the image.
+                self.selftests_image_drive = self.add_drive(f'file={self.selftests_image},format=raw,snapshot=on')
 
         if self.test_name:
             if not os.path.exists(self.test_base_dir):
@@ -457,37 +498,17 @@ class QemuConfig:
         rdpath = self.root_disk_path
         img_path = f'{rdpath}/{self.cloud_image}'
 
-        # qemu-img gives random issues when we are not in
-        # the dir where the output image will be
-        cwd = os.getcwd()
-        os.chdir(rdpath)
-
-        if self.cloud_image.endswith('.qcow2'):
-            # Create snapshot image
-            pid = os.getpid()
-            dst = f'qemu-temp-{pid}.img'
-
-            if self.test_name:
-                # some tests need VMs with more disk space like avocado.
-                # hence create the image accordingly
-                cmd1 = f'qemu-img create -f qcow2 -F qcow2 -b {self.cloud_image} {dst} 50G'.split()
-                cmd2 = f'qemu-img resize {dst} 50G'.split()
-                logging.info(cmd1)
-                logging.info(cmd2)
-                subprocess.run(cmd1, check=True)
-                subprocess.run(cmd2, check=True)
-            else:
-                cmd = f'qemu-img create -f qcow2 -F qcow2 -b {self.cloud_image} {dst}'.split()
-                logging.info(cmd)
-                subprocess.run(cmd, check=True)
-            img_path = f"{rdpath}/{dst}"
+        if self.provisioning:
+            # Install into the image itself, it's kept once provisioned
+            format = 'qcow2'
+        elif self.cloud_image.endswith('.qcow2'):
+            img_path = claim_overlay(rdpath, self.cloud_image, cloud_overlay_size(self.test_name))
             atexit.register(lambda: os.unlink(img_path))
+            self.cloud_overlay = img_path
             format = 'qcow2'
         else:
             format = 'raw'
 
-        os.chdir(cwd)
-
         cloud_drive = self.add_drive(f'file={img_path},format={format}')
         self.add_drive(f'file={rdpath}/cloud-init-user-data.img,format=raw,readonly=on')
 
@@ -531,9 +552,13 @@ class QemuConfig:
             '-smp', str(self.smp),
             '-m', self.mem,
             '-accel', self.accel,
-            '-kernel', self.vmlinux,
         ]
 
+        # Without one the firmware boots from the disks
+        if self.vmlinux:
+            l.append('-kernel')
+            l.append(self.vmlinux)
+
         if self.net:
             l.append(self.net)
 
@@ -564,6 +589,448 @@ class QemuConfig:
         return ' '.join(l)
 
 
+def default_smp(machine, accel):
+    if machine.startswith('mac99'): # Doesn't support SMP
+        return 1
+    elif accel == 'tcg':
+        return 2
+    return 8
+
+
+def default_mem(machine):
+    if machine.startswith('pseries') or machine.startswith('powernv'):
+        return '4G'
+    return '1G'
+
+
+def smp_cpus(smp):
+    # -smp is [cpus=]n[,maxcpus=n,cores=n,...]
+    for part in str(smp).split(','):
+        key, _, val = part.rpartition('=')
+        if key in ['', 'cpus'] and val.isdigit():
+            return int(val)
+    return 1
+
+
+def mem_mb(mem):
+    # -m is [size=]n[M|G|T], in MB if there's no suffix
+    mem = str(mem).split(',')[0].split('=')[-1].upper().rstrip('B')
+    units = {'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if mem[-1:] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(mem)
+
+
+def qemu_resources(machine, args, smp=None, mem=None):
+    # The CPUs and MB of memory a guest uses, worked out as apply_defaults()
+    # does, given the arguments to its boot script, and the smp and mem the
+    # script sets itself, which take precedence.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--accel', type=str, default='tcg')
+    parser.add_argument('--smp', type=str)
+    parser.add_argument('--mem-size', type=str)
+    known, _ = parser.parse_known_args(args)
+
+    if smp is None:
+        smp = known.smp or default_smp(machine, known.accel)
+    if mem is None:
+        mem = known.mem_size or default_mem(machine)
+
+    return (smp_cpus(smp), mem_mb(mem))
+
+
+def create_overlay(rdpath, backing, name, size=None):
+    # Run from rdpath, qemu-img gives random issues when we are not in the
+    # dir where the output image will be
+    cmd = f'qemu-img create -f qcow2 -F qcow2 -b {backing} {name}'.split()
+    if size:
+        cmd.append(size)
+    logging.info(cmd)
+    subprocess.run(cmd, cwd=rdpath, check=True, stdout=subprocess.DEVNULL)
+
+
+def qcow2_backing_file(path):
+    # The backing file named in a qcow2 header, or None
+    with open(path, 'rb') as f:
+        header = f.read(20)
+        if len(header) < 20 or header[:4] != b'QFI\xfb':
+            return None
+        offset, size = struct.unpack('>QI', header[8:20])
+        if offset == 0:
+            return None
+        f.seek(offset)
+        return f.read(size).decode()
+
+
+def warm_image(path):
+    # Start reading an image and its backing files into the page cache, rather
+    # than qemu faulting them in a block at a time as the guest boots.
+    while path:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+            backing = qcow2_backing_file(path)
+        except OSError:
+            return
+
+        if backing and not os.path.isabs(backing):
+            backing = os.path.join(os.path.dirname(path), backing)
+        path = backing
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cloud_overlay_size(test_name):
+    # some tests need VMs with more disk space like avocado.
+    # hence create the image accordingly
+    return '50G' if test_name else None
+
+
+def overlay_pool_prefix(backing, size):
+    return f'qemu-pool-{backing}@{size or "base"}-'
+
+
+def gc_overlays(rdpath):
+    # Remove overlays left behind by boots that didn't exit cleanly, and
+    # pooled overlays made before their backing image was last changed.
+    for name in os.listdir(rdpath):
+        path = f'{rdpath}/{name}'
+        m = re.match(r'(qemu-temp-|.+\.tmp-)(\d+)[-.]', name)
+        try:
+            if m:
+                if pid_alive(int(m.group(2))):
+                    continue
+            elif name.startswith('qemu-pool-'):
+                backing = f"{rdpath}/{name[len('qemu-pool-'):].rsplit('@', 1)[0]}"
+                if os.path.exists(backing) and os.path.getmtime(backing) <= os.path.getmtime(path):
+                    continue
+            else:
+                continue
+
+            logging.info(f'Removing stale overlay {path}')
+            os.unlink(path)
+        except OSError:
+            pass # Removed or claimed by someone else
+
+
+def fill_overlay_pool(rdpath, backing, count, size=None):
+    # Create overlays of backing for boots that are about to run to claim,
+    # so creating them isn't part of each boot.
+    gc_overlays(rdpath)
+
+    prefix = overlay_pool_prefix(backing, size)
+    count -= len([name for name in os.listdir(rdpath) if name.startswith(prefix)])
+
+    def create(i):
+        # Named as a temp overlay until complete, so it's GC'ed if we die
+        name = uuid.uuid4().hex[:8]
+        tmp = f'qemu-temp-{os.getpid()}-{name}.img'
+        create_overlay(rdpath, backing, tmp, size)
+        os.rename(f'{rdpath}/{tmp}', f'{rdpath}/{prefix}{name}.img')
+
+    if count > 0:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(create, range(count)))
+
+    warm_image(f'{rdpath}/{backing}')
+
+
+def claim_overlay(rdpath, backing, size=None):
+    # Returns the path to a new overlay of backing, from the pool if there's
+    # one there. It's named for our PID so it's GC'ed if we don't remove it.
+    gc_overlays(rdpath)
+
+    dst = f'qemu-temp-{os.getpid()}-{uuid.uuid4().hex[:8]}.img'
+    prefix = overlay_pool_prefix(backing, size)
+    for name in sorted(os.listdir(rdpath)):
+        if not name.startswith(prefix):
+            continue
+
+        try:
+            os.rename(f'{rdpath}/{name}', f'{rdpath}/{dst}')
+        except FileNotFoundError:
+            continue # Claimed by another boot
+
+        logging.info(f'Using pre-created overlay {name}')
+        break
+    else:
+        create_overlay(rdpath, backing, dst, size)
+
+    warm_image(f'{rdpath}/{backing}')
+    return f'{rdpath}/{dst}'
+
+
+def file_sha1(path):
+    h = sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def get_fs_image(tarball, strip_components):
+    # Returns the path to an ext4 image of the tarball's contents, built next
+    # to the tarball and reused for as long as the tarball is unchanged.
+    # strip_components is the directory depth to use as the root, as for tar.
+    base = os.path.realpath(tarball).split('.tar.')[0]
+    image_path = f'{base}.ext4'
+    stamp_path = f'{image_path}.sha1'
+
+    digest = file_sha1(tarball)
+
+    if os.path.exists(image_path) and os.path.exists(stamp_path):
+        if open(stamp_path).read().strip() == digest:
+            return image_path
+
+    logging.info(f'Creating filesystem image {image_path} ...')
+    tmp_dir = tempfile.mkdtemp(prefix='fs-image-', dir=os.path.dirname(image_path))
+    try:
+        tree = f'{tmp_dir}/tree'
+        os.mkdir(tree)
+        subprocess.run(['tar', f'--strip-components={strip_components}', '-xf',
+                        os.path.realpath(tarball)], cwd=tree, check=True)
+
+        # Size the image generously, it's sparse so unused space costs nothing
+        size = 0
+        inodes = 0
+        for dirpath, dirnames, filenames in os.walk(tree):
+            for name in dirnames + filenames:
+                st = os.lstat(f'{dirpath}/{name}')
+                size += (st.st_size + 4095) // 4096 * 4096
+                inodes += 1
+        size_kb = (size * 2 // 1024) + 64 * 1024
+
+        tmp_image = f'{tmp_dir}/image.ext4'
+        subprocess.run(['mkfs.ext4', '-q', '-F', '-m', '0', '-O', '^has_journal', '-N', str(inodes + 1024),
+                        '-d', tree, tmp_image, f'{size_kb}K'], stdout=subprocess.DEVNULL, check=True)
+
+        # Atomically replace, in case another boot is using the old image
+        os.replace(tmp_image, image_path)
+        with open(f'{tmp_dir}/stamp', 'w') as f:
+            f.write(f'{digest}\n')
+        os.replace(f'{tmp_dir}/stamp', stamp_path)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.warning(f'Failed creating filesystem image from {tarball}: {e}')
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return image_path
+
+
+class BootSnapshot:
+    # A booted guest, saved using qemu's migration to a file plus a copy of
+    # the root disk overlay. Later boots with the same kernel, disks, machine
+    # and command line restore from it rather than booting again.
+    #
+    # A restored guest's overlay is backed by the snapshot's disk, so while
+    # it runs it holds a shared flock() on the snapshot directory, and
+    # snapshots are only removed under an exclusive one.
+    def __init__(self, qconf, cmd):
+        self.qconf = qconf
+        self.lock_fd = None
+        self.root = os.path.realpath(qconf.boot_snapshot_dir)
+        self.path = f'{self.root}/{self.get_key(cmd)}'
+        self.state = f'{self.path}/state'
+        self.disk = f'{self.path}/disk.qcow2'
+        self.console = f'{self.path}/console.log'
+
+    @staticmethod
+    def supported(qconf):
+        if '-S' in qconf.extra_args:
+            return False # Waiting for gdb
+
+        # The guest writes straight to raw cloud images, so they can't be saved
+        return qconf.cloud_image is None or qconf.cloud_overlay is not None
+
+    def get_key(self, cmd):
+        qconf = self.qconf
+        h = sha1()
+
+        # Paths that are new for every boot don't affect the guest
+        if getattr(qconf, 'test_output_dir', None):
+            cmd = cmd.replace(qconf.test_output_dir, '<testdir>')
+
+        for path in re.findall(r'file=([^,\s]+)', cmd):
+            if path == qconf.cloud_overlay:
+                # Empty when created, so the backing image is what matters
+                st = os.stat(f'{qconf.root_disk_path}/{qconf.cloud_image}')
+            else:
+                st = os.stat(path)
+
+            if path == qconf.test_tarball:
+                # Recreated for every boot, and not read until after the snapshot
+                stamp = f'<{st.st_size}>'
+            else:
+                stamp = f'<{st.st_size}-{st.st_mtime_ns}>'
+            cmd = cmd.replace(path, stamp)
+
+        if qconf.initrd:
+            st = os.stat(os.path.join(qconf.root_disk_path, qconf.initrd))
+            cmd += f' <{st.st_size}-{st.st_mtime_ns}>'
+
+        h.update(cmd.encode())
+        h.update(file_sha1(qconf.vmlinux).encode())
+        return h.hexdigest()[:16]
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def rebase(self, backing):
+        cmd = ['qemu-img', 'rebase', '-u', '-F', 'qcow2', '-b', backing, self.qconf.cloud_overlay]
+        logging.debug(cmd)
+        subprocess.run(cmd, check=True)
+
+    def replace_overlay(self):
+        # The guest may have written to the overlay, relative to the
+        # snapshot's disk, so it can't be rebased back onto the cloud image.
+        qconf = self.qconf
+        os.unlink(qconf.cloud_overlay)
+        fresh = claim_overlay(qconf.root_disk_path, qconf.cloud_image,
+                              cloud_overlay_size(qconf.test_name))
+        os.rename(fresh, qconf.cloud_overlay)
+
+    @staticmethod
+    def remove(path, fd=None):
+        # Removes the snapshot at path unless a guest is using it. fd is an
+        # open fd of path to use, which is closed either way.
+        try:
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                os.close(fd)
+        except OSError:
+            return False # In use, or already removed
+
+        return True
+
+    def restore(self, p, cmd, logfile, timeout, boot_timeout):
+        qconf = self.qconf
+        logging.info(f'Restoring boot snapshot {self.path} ...')
+
+        spawned = False
+        try:
+            # Held until we exit, see above
+            self.lock_fd = os.open(self.path, os.O_RDONLY)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_SH)
+            if not os.path.exists(self.state):
+                raise Exception('evicted by another boot')
+
+            os.utime(self.path) # Most recently used
+            if qconf.cloud_overlay:
+                self.rebase(self.disk)
+
+            # Keep the output from booting, so warnings it had are still seen
+            with open(self.console) as f:
+                logfile.write(f.read())
+            logfile.flush()
+
+            p.spawn(f'{cmd} -incoming "exec:cat {self.state}"', logfile=logfile,
+                    timeout=timeout, quiet=qconf.quiet)
+            spawned = True
+            p.push_prompt(qconf.prompt)
+            p.send('')
+            p.expect_prompt(timeout=boot_timeout)
+        except Exception as e:
+            logging.warning(f'Failed restoring boot snapshot, booting instead: {e}')
+            if spawned:
+                p.child.terminate(force=True)
+
+            if qconf.cloud_overlay:
+                self.replace_overlay()
+
+            if self.lock_fd is not None:
+                self.remove(self.path, self.lock_fd)
+                self.lock_fd = None
+
+            logfile.seek(0)
+            logfile.truncate()
+            return False
+
+        return True
+
+    def save(self, p, logfile):
+        qconf = self.qconf
+        logging.info(f'Saving boot snapshot {self.path} ...')
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        try:
+            logfile.flush()
+            shutil.copyfile(qconf.logpath, f'{tmp_dir}/console.log')
+
+            p.send('\x01c') # invoke qemu monitor
+            p.expect(r'\(qemu\)')
+            # The guest keeps running until the last pass, then is stopped
+            # with its disks flushed, so the overlay matches the saved state.
+            p.send(f'migrate "exec:cat > {tmp_dir}/state"')
+            p.expect(r'\(qemu\)')
+            while True:
+                p.send('info migrate')
+                p.expect(r'Migration status: ([a-z-]+)')
+                status = p.matches()[0]
+                p.expect(r'\(qemu\)')
+                if status in ['completed', 'failed', 'cancelled']:
+                    break
+                time.sleep(0.5)
+
+            if status == 'completed' and qconf.cloud_overlay:
+                shutil.copyfile(qconf.cloud_overlay, f'{tmp_dir}/disk.qcow2')
+                cmd = ['qemu-img', 'rebase', '-u', '-F', 'qcow2', '-b',
+                       os.path.realpath(f'{qconf.root_disk_path}/{qconf.cloud_image}'),
+                       f'{tmp_dir}/disk.qcow2']
+                logging.debug(cmd)
+                subprocess.run(cmd, check=True)
+
+            p.send('cont')
+            p.expect(r'\(qemu\)')
+            p.send('\x01c') # back to the console
+            p.expect_prompt()
+
+            if status != 'completed':
+                logging.warning(f'Saving boot snapshot failed, migration {status}')
+                return
+
+            try:
+                os.rename(tmp_dir, self.path)
+            except OSError:
+                pass # Saved concurrently by another boot
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        snapshots = []
+        for name in os.listdir(self.root):
+            path = f'{self.root}/{name}'
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                continue
+            snapshots.append((os.stat(path).st_mtime, path))
+
+        snapshots.sort(reverse=True)
+        for _, path in snapshots[self.qconf.boot_snapshot_max:]:
+            if self.remove(path):
+                logging.info(f'Evicted boot snapshot {path}')
+
+
 def qemu_monitor_shutdown(p):
     p.send('\x01c') # invoke qemu monitor
     p.expect(r'\(qemu\)')
@@ -629,6 +1096,192 @@ def qemu_net_setup(p):
     p.cmd('ip route show')
 
 
+def derived_image_name(rdpath, cloud_image, kind, inputs):
+    # Named for the cloud image and the contents of the input files
+    st = os.stat(f'{rdpath}/{cloud_image}')
+    h = sha1(f'{cloud_image} {st.st_size} {st.st_mtime_ns}'.encode())
+    for path in inputs:
+        if os.path.exists(path):
+            h.update(file_sha1(path).encode())
+
+    stem = cloud_image[:-len('.qcow2')]
+    return f'{stem}+{kind}-{h.hexdigest()[:12]}'
+
+
+def derive_cloud_image(qconf, kind, inputs, prepare, size=None, pool=0):
+    # Switch qconf to an image derived from its cloud image. If it doesn't
+    # exist yet it's created by booting a copy of the cloud image and calling
+    # prepare() on a config for that boot, and pool overlays of it are made
+    # for the boots waiting for it to claim.
+    rdpath = qconf.root_disk_path
+    name = derived_image_name(rdpath, qconf.cloud_image, kind, inputs)
+    image = f'{name}.qcow2'
+
+    # Only one boot creates each image, the others wait and use it
+    with open(f'{rdpath}/{image}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if not os.path.exists(f'{rdpath}/{image}'):
+            logging.info(f'Creating {image} ...')
+            tmp = f'{name}.tmp-{os.getpid()}.qcow2'
+            create_overlay(rdpath, qconf.cloud_image, tmp, size)
+
+            pconf = copy(qconf)
+            pconf.cloud_image = tmp
+            pconf.provision = False
+            pconf.provisioning = True
+            pconf.boot_snapshot_dir = None
+            pconf.callbacks = []
+            pconf.cmdline = copy(qconf.cmdline)
+
+            # The image is kept, so nothing else this boot is for goes in
+            # it: no host mounts or their commands, no network tests, and no
+            # modules or selftests. The only drive is the test, if any.
+            pconf.host_mounts = []
+            pconf.net_tests = False
+            pconf.test_output_dir = None
+            pconf.modules_tarball = pconf.modules_image = None
+            pconf.selftests_tarball = pconf.selftests_image = None
+            pconf.extra_args = [a for a in qconf.extra_args
+                                if not a.startswith(('-fsdev ', '-device virtio-9p-pci,'))]
+            pconf.drives = []
+            pconf.next_drive = 0
+            if qconf.test_tarball:
+                pconf.test_drive = pconf.add_drive(f'file={qconf.test_tarball},format=raw,readonly=on')
+            pconf.logpath = f'/tmp/console-{qconf.uuid}-{kind}.log'
+
+            try:
+                if not prepare(pconf):
+                    logging.error(f'Creating {image} failed, see {pconf.logpath}')
+                    return False
+                os.rename(f'{rdpath}/{tmp}', f'{rdpath}/{image}')
+            finally:
+                if os.path.exists(f'{rdpath}/{tmp}'):
+                    os.unlink(f'{rdpath}/{tmp}')
+
+            if pool > 0:
+                fill_overlay_pool(rdpath, image, pool, cloud_overlay_size(qconf.test_name))
+
+    qconf.cloud_image = image
+    return True
+
+
+def bake_boot(qconf):
+    # Boot the cloud image's own kernel, from the disk via the firmware, not
+    # the kernel under test. Every kernel booted later uses the image, so
+    # nothing a broken test kernel does on first boot can end up in it.
+    qconf.vmlinux = None
+    qconf.initrd = None
+    qconf.machine_caps = [c for c in qconf.machine_caps if c != 'x-vof=on']
+    qconf.drives = []
+    qconf.next_drive = 0
+    qconf.prepare_cloud_image()
+    qconf.cmdline = [] # The image's boot loader has its own
+    cmd = qconf.cmd()
+    logging.info(f"Running '{cmd}'")
+
+    timeout = qconf.pexpect_timeout or None
+    boot_timeout = timeout and timeout * 5
+
+    p = PexpectHelper()
+    with open(qconf.logpath, 'w', encoding='utf-8', errors='ignore') as logfile:
+        p.spawn(cmd, logfile=logfile, timeout=timeout, quiet=qconf.quiet)
+        p.push_prompt(qconf.prompt)
+        qconf.boot_func(p, boot_timeout, qconf)
+
+        # Older cloud-init has no status command, it's finished by login anyway
+        p.send('cloud-init status --wait || true')
+        p.expect_prompt(timeout=boot_timeout)
+        p.send('poweroff')
+        p.wait_for_exit(timeout=boot_timeout)
+
+    if filter_log_warnings(open(qconf.logpath), sys.stdout):
+        logging.error('Errors/warnings seen in console log')
+        return False
+
+    return True
+
+
+def bake_inputs(rdpath):
+    return [f'{rdpath}/cloud-init-user-data.txt', f'{rdpath}/cloud-init-user-data.img']
+
+
+def baked_image_name(rdpath, cloud_image):
+    return derived_image_name(rdpath, cloud_image, 'cloud-init', bake_inputs(rdpath)) + '.qcow2'
+
+
+def can_bake(machine):
+    # Only pseries firmware boots the cloud image's own kernel, see bake_boot()
+    return machine.startswith('pseries')
+
+
+def bake_cloud_image(qconf, pool=0):
+    # Boot a copy of the cloud image once to let cloud-init do its first boot
+    # setup, so later boots of it go straight to the login prompt.
+    if not can_bake(qconf.machine):
+        logging.info(f'Not baking cloud-init into {qconf.cloud_image} on {qconf.machine}')
+        return True
+
+    inputs = bake_inputs(qconf.root_disk_path)
+    return derive_cloud_image(qconf, 'cloud-init', inputs, bake_boot, pool=pool)
+
+
+def provision_inputs(test_base_dir, test_name):
+    test_dir = os.path.join(test_base_dir, test_name)
+    return [f'{test_dir}/Makefile', f'{test_dir}/install-deps.sh']
+
+
+def provision_cloud_image(qconf, pool=0):
+    # Boot a copy of the cloud image once to install the packages the test
+    # needs and run its prepare step, then keep it for later runs to boot.
+    inputs = provision_inputs(qconf.test_base_dir, qconf.test_name)
+    if not derive_cloud_image(qconf, qconf.test_name, inputs, qemu_main, size='50G', pool=pool):
+        return False
+
+    qconf.provisioned = True
+    return True
+
+
+def boot_overlay_spec(machine, args):
+    # What a boot with the given boot script arguments claims an overlay of,
+    # as chosen by qemu_main(): (cloud image, baked, provisioned test name,
+    # overlay size). None if it doesn't boot from an overlay.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--cloud-image', type=str)
+    parser.add_argument('--test-name', type=str)
+    parser.add_argument('--provision', action='store_true')
+    parser.add_argument('--bake-cloud-init', action='store_true')
+    known, _ = parser.parse_known_args(args)
+
+    if not known.cloud_image or not known.cloud_image.endswith('.qcow2'):
+        return None
+
+    baked = known.bake_cloud_init and can_bake(machine)
+    provisioned = known.test_name if known.provision else None
+    return (known.cloud_image, baked, provisioned, cloud_overlay_size(known.test_name))
+
+
+def boot_overlay_image(rdpath, spec):
+    # The image named by a boot_overlay_spec(), or None if it doesn't exist
+    # yet, in which case the boot creating it makes the overlays.
+    image, baked, provisioned, _ = spec
+    if not os.path.exists(f'{rdpath}/{image}'):
+        return None
+
+    if baked:
+        image = baked_image_name(rdpath, image)
+        if not os.path.exists(f'{rdpath}/{image}'):
+            return None
+
+    if provisioned:
+        inputs = provision_inputs(os.path.join(rdpath, '..', 'tests'), provisioned)
+        image = derived_image_name(rdpath, image, provisioned, inputs) + '.qcow2'
+        if not os.path.exists(f'{rdpath}/{image}'):
+            return None
+
+    return image
+
+
 def qemu_main(qconf):
     if qconf.expected_release is None or qconf.vmlinux is None:
         return False
@@ -638,10 +1291,29 @@ def qemu_main(qconf):
             logging.error(f"Mount points must point to directories. Not found: '{path}'")
             return False
 
+    # Derived images are layered on qcow2 cloud images, as overlays are
+    derive = qconf.cloud_image and qconf.cloud_image.endswith('.qcow2') and not qconf.provisioning
+
+    # Overlays are made for the other boots using the image, along with it
+    pool = max(qconf.overlay_pool - 1, 0)
+    provision = qconf.provision and qconf.test_name and derive
+
+    if qconf.bake_cloud_init and derive:
+        if not bake_cloud_image(qconf, 0 if provision else pool):
+            return False
+
+    if provision:
+        if not provision_cloud_image(qconf, pool):
+            return False
+
     qconf.prepare_cloud_image()
 
     cmd = qconf.cmd()
 
+    snapshot = None
+    if qconf.boot_snapshot_dir and BootSnapshot.supported(qconf):
+        snapshot = BootSnapshot(qconf, cmd)
+
     logging.info(f"Running '{cmd}'")
 
     if qconf.interactive:
@@ -666,16 +1338,54 @@ def qemu_main(qconf):
 
     p = PexpectHelper()
     logfile = open(qconf.logpath, 'w', encoding='utf-8', errors='ignore')
-    p.spawn(cmd, logfile=logfile, timeout=pexpect_timeout, quiet=qconf.quiet)
 
-    p.push_prompt(qconf.prompt)
-    qconf.boot_func(p, boot_timeout, qconf)
+    # Warnings are written out as they're seen, and checked again in the
+    # whole log at the end.
+    warnings = open('warnings.txt', 'w')
+
+    try:
+        if not qemu_session(qconf, p, cmd, snapshot, logfile, warnings,
+                            pexpect_timeout, boot_timeout):
+            return False
+    except WarningFound:
+        # With --abort-on-warning, the guest has been stopped already
+        logging.error('Errors/warnings seen in console log')
+        return False
+    finally:
+        warnings.close()
+        logfile.close()
+
+    if filter_log_warnings(open(qconf.logpath), open('warnings.txt', 'w')):
+        logging.error('Errors/warnings seen in console log')
+        return False
+
+    logging.info('Test completed OK')
+
+    return True
+
+
+def qemu_session(qconf, p, cmd, snapshot, logfile, warnings, pexpect_timeout, boot_timeout):
+    # Boots the guest and runs everything in it, up to it powering off
+    restored = False
+    if snapshot and snapshot.exists():
+        restored = snapshot.restore(p, cmd, logfile, pexpect_timeout, boot_timeout)
+        if restored:
+            p.watch_warnings(warnings, qconf.abort_on_warning)
+
+    if not restored:
+        p.spawn(cmd, logfile=logfile, timeout=pexpect_timeout, quiet=qconf.quiet)
+        p.watch_warnings(warnings, qconf.abort_on_warning)
+        p.push_prompt(qconf.prompt)
+        qconf.boot_func(p, boot_timeout, qconf)
 
     logging.info(f'Looking for kernel version: {qconf.expected_release}')
     p.send('echo "booted-revision: `uname -r`"')
     p.expect(f'booted-revision: {qconf.expected_release}')
     p.expect_prompt()
 
+    if snapshot and not restored:
+        snapshot.save(p, logfile)
+
     p.send('cat /proc/cpuinfo')
     if qconf.cpuinfo:
         for s in qconf.cpuinfo:
@@ -684,12 +1394,24 @@ def qemu_main(qconf):
 
     if qconf.modules_tarball:
         p.cmd('mkdir -p /lib/modules')
-        p.send(f'cd /lib/modules; cat /dev/vd{qconf.modules_drive} | zcat | tar --strip-components=2 -xf -; cd -')
+        extract = f'(cd /lib/modules; cat /dev/vd{qconf.modules_drive} | zcat | tar --strip-components=2 -xf -)'
+        if qconf.modules_image:
+            # Fall back to the tarball if the kernel can't mount the image
+            d = '/lib/modules/$(uname -r)'
+            mount = f'mkdir -p {d} && mount -t ext4 -o ro /dev/vd{qconf.modules_image_drive} {d}'
+            p.send(f'{mount} || {extract}')
+        else:
+            p.send(extract)
         p.expect_prompt(timeout=boot_timeout)
 
     if qconf.selftests_tarball:
         p.cmd('mkdir -p /var/tmp/selftests')
-        p.send(f'cd /var/tmp/selftests; cat /dev/vd{qconf.selftests_drive} | zcat | tar --strip-components=1 -xf -; cd -')
+        extract = f'(cd /var/tmp/selftests; cat /dev/vd{qconf.selftests_drive} | zcat | tar --strip-components=1 -xf -)'
+        if qconf.selftests_image:
+            mount = f'mount -t ext4 /dev/vd{qconf.selftests_image_drive} /var/tmp/selftests'
+            p.send(f'{mount} || {extract}')
+        else:
+            p.send(extract)
         p.expect_prompt(timeout=boot_timeout)
 
     if qconf.net_tests:
@@ -722,27 +1444,37 @@ def qemu_main(qconf):
         p.cmd(f'cd /var/tmp/test/{qconf.test_name}')
 
         #remove the temp tarball once copied in VM
-        atexit.register(lambda: os.unlink(qconf.test_tarball))
+        if not qconf.provisioning:
+            atexit.register(lambda: os.unlink(qconf.test_tarball))
 
         # set up package manager and install make
-        if 'ubuntu' in qconf.cloud_image or 'debian' in qconf.cloud_image:
+        if qconf.provisioned:
+            pass
+        elif 'ubuntu' in qconf.cloud_image or 'debian' in qconf.cloud_image:
             p.cmd(f'apt update -y')
             p.cmd(f'apt install -y make zip unzip')
         elif 'fedora' in qconf.cloud_image:
             p.cmd(f'dnf update -y; dnf install -y make zip unzip')
 
-        logging.info(f"Starting {qconf.test_name} test preparation...")
         test_runner = create_test_instance(qconf.test_name, qconf.test_args, p)
 
         # p.cmd("mkdir -p ~/avocado/job-results/latest")
         # p.cmd("echo Hello world > ~/avocado/job-results/latest/log.txt")
 
-        test_runner.setup()
-        test_runner.test()
+        if qconf.provisioned:
+            logging.info(f"Using {qconf.cloud_image}, {qconf.test_name} already prepared")
+        else:
+            logging.info(f"Starting {qconf.test_name} test preparation...")
+            test_runner.setup()
+
+        if qconf.provisioning:
+            p.cmd('sync')
+        else:
+            test_runner.test()
 
-        # avocado will copy xfstest logs to qconf.test_output_dir. All we need
-        # to do is copy avocado logs the dir so we can retrieve them later.
-        test_runner.collect_logs(guest_output_dir)
+            # avocado will copy xfstest logs to qconf.test_output_dir. All we need
+            # to do is copy avocado logs the dir so we can retrieve them later.
+            test_runner.collect_logs(guest_output_dir)
 
 
     for callback in qconf.callbacks:
@@ -758,10 +1490,4 @@ def qemu_main(qconf):
 
     p.wait_for_exit(timeout=boot_timeout)
 
-    if filter_log_warnings(open(qconf.logpath), open('warnings.txt', 'w')):
-        logging.error('Errors/warnings seen in console log')
-        return False
-
-    logging.info('Test completed OK')
-
     return True
@@ -1,4 +1,5 @@
 import os
+import re
 import logging
 import signal
 import struct
@@ -150,69 +151,230 @@ def test_harness(func, name, *args, **kwargs):
     return rc
 
 
-def filter_log_warnings(infile, outfile, extra_patterns=[]):
-    from configparser import ConfigParser
-    import re
-
+def get_filters_path():
     base = os.path.dirname(sys.argv[0])
     path = os.path.join(base, '../etc/filters.ini')
     if not os.path.exists(path):
         path = os.path.join(base, '../../etc/filters.ini')
+    return path
 
-    parser = ConfigParser()
-    parser.read_file(open(path))
-    ignore_start = parser['ignore']['start']
-    ignore_stop = parser['ignore']['stop']
-    suppressions = [t[1] for t in parser.items('suppressions', [])]
-    suppression_patterns = [t[1] for t in parser.items('suppression_patterns', [])]
-    suppression_patterns = [re.compile(p) for p in suppression_patterns]
-    strings  = [t[1] for t in parser.items('strings', [])]
-    patterns = [t[1] for t in parser.items('patterns', [])]
-    patterns = [re.compile(p) for p in patterns]
-    patterns.extend(extra_patterns)
-
-    def suppress(line):
-        for suppression in suppressions:
-            if suppression in line:
-                return True
 
-        for pattern in suppression_patterns:
+def combine_patterns(patterns, flags=0):
+    # One regex that matches wherever any of the patterns would
+    if not patterns:
+        return re.compile('(?!)', flags) # Never matches
+    return re.compile('|'.join(f'(?:{p})' for p in patterns), flags)
+
+
+def combinable(pattern):
+    # Whether a pattern means the same inside a combined regex. Not if it sets
+    # global flags, refers back to a group, whose number would change, or
+    # names a group, as another pattern could use the same name.
+    compiled = re.compile(pattern)
+    if compiled.flags & ~re.UNICODE or compiled.groupindex:
+        return False
+    return not re.search(r'\\[1-9]|\\g<|\(\?P=', pattern)
+
+
+def split_patterns(patterns, path):
+    # Returns the patterns that can be combined, and the others compiled on
+    # their own. Patterns that don't compile are logged and dropped.
+    combined = []
+    separate = []
+    for pattern in patterns:
+        try:
+            if combinable(pattern):
+                combined.append(pattern)
+            else:
+                separate.append(re.compile(pattern))
+        except re.error as e:
+            logging.error(f"Ignoring bad pattern in {path} '{pattern}': {e}")
+    return combined, separate
+
+
+class WarningRules:
+    # The rules from a filters.ini, compiled into a few combined regexes, plus
+    # any patterns that can't be combined.
+    def __init__(self, path, extra_patterns=[]):
+        from configparser import ConfigParser
+
+        parser = ConfigParser()
+        parser.read_file(open(path))
+        self.ignore_start = parser['ignore']['start']
+        self.ignore_stop = parser['ignore']['stop']
+
+        suppressions, self.extra_suppressions = split_patterns(
+            [t[1] for t in parser.items('suppression_patterns', [])], path)
+        suppressions += [re.escape(t[1]) for t in parser.items('suppressions', [])]
+        self.suppression = combine_patterns(suppressions)
+
+        warnings, self.extra = split_patterns([t[1] for t in parser.items('patterns', [])], path)
+        warnings += [re.escape(t[1]) for t in parser.items('strings', [])]
+
+        # Patterns with flags of their own can't be combined with the others
+        for p in extra_patterns:
+            if p.flags & ~re.UNICODE or not combinable(p.pattern):
+                self.extra.append(p)
+            else:
+                warnings.append(p.pattern)
+        self.warning = combine_patterns(warnings)
+
+        # Between them these match in every line that may be a warning or
+        # change whether warnings are being ignored, other lines are skipped.
+        # Used separately, as regexes starting with a literal are searched
+        # for much faster than a combined one. Leading anchors are dropped
+        # for the same reason, they only make the match more specific.
+        markers = [re.escape(self.ignore_start), re.escape(self.ignore_stop)]
+        self.scanners = [re.compile(re.sub(r'^(\\[bBA]|\^)+(?=.)', '', p), re.MULTILINE)
+                         for p in warnings + markers]
+        self.scanners += [re.compile(p.pattern, p.flags | re.MULTILINE) for p in self.extra]
+
+        # Likewise for a single line, when there are no extra patterns
+        if self.extra:
+            self.candidate = None
+        else:
+            self.candidate = combine_patterns(warnings + markers)
+
+
+warning_rules = {}
+
+def get_warning_rules(path, extra_patterns=[]):
+    # Compiled once per version of the file
+    key = (os.path.realpath(path), os.stat(path).st_mtime_ns,
+           tuple((p.pattern, p.flags) for p in extra_patterns))
+    rules = warning_rules.get(key)
+    if rules is None:
+        rules = WarningRules(path, extra_patterns)
+        warning_rules[key] = rules
+    return rules
+
+
+class WarningFilter:
+    # Applies the rules in etc/filters.ini to a log, a line at a time
+    def __init__(self, extra_patterns=[]):
+        self.rules = get_warning_rules(get_filters_path(), extra_patterns)
+        self.ignoring = False
+
+    def check(self, line):
+        # Returns True if the line is a warning that's not ignored/suppressed
+        rules = self.rules
+        if rules.candidate and not rules.candidate.search(line):
+            return False
+
+        if rules.ignore_stop in line:
+            self.ignoring = False
+        elif not self.ignoring and rules.ignore_start in line:
+            self.ignoring = True
+
+        if self.ignoring:
+            return False
+
+        if rules.suppression.search(line):
+            return False
+
+        for pattern in rules.extra_suppressions:
+            if pattern.search(line):
+                return False
+
+        if rules.warning.search(line):
+            return True
+
+        for pattern in rules.extra:
             if pattern.search(line):
                 return True
 
         return False
 
+    def scan(self, infile, chunk_size=16 * 1024 * 1024):
+        # Yields the warning lines in infile. It's read in big chunks, and only
+        # the lines that one of the scanners matches in are checked.
+        rest = ''
+        while True:
+            data = infile.read(chunk_size)
+            if data:
+                data = rest + data
+                cut = data.rfind('\n') + 1
+                data, rest = data[:cut], data[cut:]
+            elif rest:
+                # Last line, with no newline
+                data, rest = rest, ''
+            else:
+                break
+
+            lines = set()
+            for scanner in self.rules.scanners:
+                pos = 0
+                while True:
+                    m = scanner.search(data, pos)
+                    if m is None:
+                        break
+
+                    start = data.rfind('\n', 0, m.start()) + 1
+                    lines.add(start)
+
+                    # Search on from the next line, a match can span lines
+                    # where checking one line at a time wouldn't.
+                    pos = data.find('\n', m.start()) + 1
+                    if pos == 0:
+                        break
+
+            for start in sorted(lines):
+                end = data.find('\n', start) + 1
+                if end == 0:
+                    end = len(data)
+
+                line = data[start:end]
+                if self.check(line):
+                    yield line
+
+
+def filter_log_warnings(infile, outfile, extra_patterns=[]):
     found = False
-    ignoring = False
-    while True:
-        line = infile.readline()
-        if len(line) == 0:
-            break
-
-        if ignore_stop in line:
-            ignoring = False
-        elif not ignoring and ignore_start in line:
-            ignoring = True
-
-        if ignoring:
-            continue
-            
-        if suppress(line):
-            continue
-
-        for string in strings:
-            if string in line:
-                found = True
-                outfile.write(line)
-                continue
+    for line in WarningFilter(extra_patterns).scan(infile):
+        found = True
+        outfile.write(line)
 
-        for pattern in patterns:
-            if pattern.search(line):
-                found = True
-                outfile.write(line)
+    return found
+
+
+class WarningFound(Exception):
+    pass
+
+
+class WarningMonitor:
+    # A file like object that checks output for warnings as it's written,
+    # writing them to outfile as they're seen and optionally raising
+    # WarningFound on the first one. Output is passed on to next, if given.
+    def __init__(self, outfile, abort=False, next=None, extra_patterns=[]):
+        self.wfilter = WarningFilter(extra_patterns)
+        self.outfile = outfile
+        self.abort = abort
+        self.next = next
+        self.partial = ''
+        self.found = None
+
+    def write(self, data):
+        if self.next:
+            self.next.write(data)
+
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            line = line.rstrip('\r') + '\n'
+            if not self.wfilter.check(line):
                 continue
 
-    return found
+            self.outfile.write(line)
+            self.outfile.flush()
+
+            if self.found is None:
+                self.found = line
+                if self.abort:
+                    raise WarningFound(line.strip())
+
+    def flush(self):
+        if self.next:
+            self.next.flush()
 
 
 def get_endian(elf_path):
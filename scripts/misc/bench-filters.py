@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+#
+# Benchmark filter_log_warnings() on a large synthetic console log, and check
+# it finds the same warnings as checking each rule against each line.
+#
+# eg.
+# $ ~/ci-scripts/scripts/misc/bench-filters.py --size 200
+#
+# Or with existing logs:
+#
+# $ ~/ci-scripts/scripts/misc/bench-filters.py ~/output/boot/*/console.log
+
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+sys.path.append(f'{os.path.dirname(sys.argv[0])}/../../lib')
+
+from configparser import ConfigParser
+from utils import filter_log_warnings, get_filters_path
+import re
+
+
+def reference_filter(infile, outfile):
+    # Every rule against every line, as filter_log_warnings() used to
+    parser = ConfigParser()
+    parser.read_file(open(get_filters_path()))
+    ignore_start = parser['ignore']['start']
+    ignore_stop = parser['ignore']['stop']
+    suppressions = [t[1] for t in parser.items('suppressions', [])]
+    suppression_patterns = [re.compile(t[1]) for t in parser.items('suppression_patterns', [])]
+    strings = [t[1] for t in parser.items('strings', [])]
+    patterns = [re.compile(t[1]) for t in parser.items('patterns', [])]
+
+    found = False
+    ignoring = False
+    for line in infile:
+        if ignore_stop in line:
+            ignoring = False
+        elif not ignoring and ignore_start in line:
+            ignoring = True
+
+        if ignoring:
+            continue
+
+        if any(s in line for s in suppressions) or any(p.search(line) for p in suppression_patterns):
+            continue
+
+        if any(s in line for s in strings) or any(p.search(line) for p in patterns):
+            found = True
+            outfile.write(line)
+
+    return found
+
+
+def generate_log(f, size_mb):
+    parser = ConfigParser()
+    parser.read_file(open(get_filters_path()))
+    ignore_start = parser['ignore']['start']
+    ignore_stop = parser['ignore']['stop']
+    specials = [t[1] for t in parser.items('strings', [])]
+    specials += [t[1] for t in parser.items('suppressions', [])]
+    specials += ['WARNING: CPU: 3 PID: 1234 at mm/page_alloc.c:4321 foo+0x12/0x40',
+                 'BUG: sleeping function called from invalid context',
+                 'rcu: INFO: rcu_sched detected stalls on CPUs/tasks:',
+                 'WARNING: possible recursive locking detected']
+
+    random.seed(1)
+    t = 0.0
+    written = 0
+    while written < size_mb * 1024 * 1024:
+        t += random.random() / 100
+        r = random.random()
+        if r < 0.001:
+            msg = random.choice(specials)
+        elif r < 0.0012:
+            msg = random.choice([ignore_start, ignore_stop])
+        else:
+            msg = f'selftests: powerpc: test_{random.randint(0, 999)} ' + 'x' * random.randint(0, 100)
+        line = f'[{t:12.6f}] {msg}\n'
+        f.write(line)
+        written += len(line)
+
+
+def bench(path):
+    size = os.path.getsize(path) / (1024 * 1024)
+    print(f'{path}: {size:.1f}MB')
+
+    results = []
+    for name, func in [('filter', filter_log_warnings), ('reference', reference_filter)]:
+        out = io.StringIO()
+        start = time.time()
+        func(open(path), out)
+        elapsed = time.time() - start
+        lines = out.getvalue().splitlines()
+        results.append(lines)
+        print(f'  {name:9} {elapsed:7.2f}s {size / elapsed:8.1f}MB/s {len(lines)} warnings')
+
+    if results[0] != results[1]:
+        print('  Error: warnings differ!')
+        return False
+
+    return True
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark filtering console logs for warnings')
+    parser.add_argument('--size', type=int, default=100, help='Size (MB) of the synthetic log (default 100)')
+    parser.add_argument('logs', nargs='*', help='Logs to filter, rather than a synthetic one')
+    args = parser.parse_args(args)
+
+    if args.logs:
+        return all([bench(path) for path in args.logs])
+
+    with tempfile.NamedTemporaryFile('w', prefix='bench-filters-', suffix='.log') as f:
+        generate_log(f, args.size)
+        f.flush()
+        return bench(f.name)
+
+
+sys.exit(0 if main(sys.argv[1:]) else 1)
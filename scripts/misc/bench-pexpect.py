@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+#
+# Replay console logs through the pexpect matching used by the boot scripts,
+# to check it keeps up with consoles that produce lots of output.
+#
+# eg.
+# $ ~/ci-scripts/scripts/misc/bench-pexpect.py ~/output/boot/*/console.log
+#
+# Each log is matched with PexpectHelper, and with plain pexpect for
+# comparison, counting matches of the prompt (--prompt) and the bug patterns.
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(f'{os.path.dirname(sys.argv[0])}/../../lib')
+
+import pexpect
+from pexpect_utils import PexpectHelper
+
+END = 'bench-pexpect-end-of-log'
+
+
+def replay_helper(path, prompt):
+    p = PexpectHelper()
+    p.spawn(f"sh -c 'cat {path}; echo {END}'", quiet=True, timeout=None)
+    # Logs may have oopses etc. in them, so match the bug patterns as normal
+    # patterns, rather than having expect() bail out on them.
+    patterns = [END, prompt] + PexpectHelper.default_bug_patterns
+    matches = 0
+    while True:
+        idx = p.expect(patterns, bug_patterns=[])
+        if idx == 0:
+            break
+        matches += 1
+    p.wait_for_exit()
+    return matches
+
+
+def replay_plain(path, prompt):
+    child = pexpect.spawn(f"sh -c 'cat {path}; echo {END}'", encoding='utf-8',
+                          codec_errors='replace', echo=False, timeout=None)
+    matches = 0
+    while True:
+        # As PexpectHelper.expect() used to, building the list each time
+        patterns = [END, prompt] + PexpectHelper.default_bug_patterns
+        idx = child.expect(patterns)
+        if idx == 0:
+            break
+        matches += 1
+    child.expect(pexpect.EOF)
+    child.wait()
+    return matches
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark pexpect matching of console logs')
+    parser.add_argument('--prompt', type=str, default=r'~ #|root@\S+:~#|\[root@\S+ ~\]#',
+                        help='Prompt pattern to match in the logs')
+    parser.add_argument('--skip-plain', action='store_true', help="Don't compare with plain pexpect")
+    parser.add_argument('logs', nargs='+', help='Console logs to replay')
+    args = parser.parse_args(args)
+
+    for path in args.logs:
+        size = os.path.getsize(path) / (1024 * 1024)
+        print(f'{path}: {size:.1f}MB')
+
+        funcs = [('helper', replay_helper)]
+        if not args.skip_plain:
+            funcs.append(('plain', replay_plain))
+
+        for name, func in funcs:
+            start = time.time()
+            matches = func(path, args.prompt)
+            elapsed = time.time() - start
+            print(f'  {name:6} {elapsed:7.2f}s {size / elapsed:8.1f}MB/s {matches} matches')
+
+    return True
+
+
+sys.exit(0 if main(sys.argv[1:]) else 1)
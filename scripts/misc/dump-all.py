@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+#
+# Dump every table the other dump-* scripts do, other than disassembly, from
+# one load of vmlinux and its symbols.
+#
+# eg.
+# $ ~/ci-scripts/scripts/misc/dump-all.py --format json vmlinux > tables.json
+
+import os
+import sys
+sys.path.append(f'{os.path.dirname(sys.argv[0])}/../../lib')
+from dump import *
+
+
+def main(args):
+    parser = dump_arg_parser('Dump all fixup tables, the exception table, mcount records and the system call table')
+    parser.add_argument('-o', '--output', type=str, default=None, help='File to write to, rather than stdout')
+    args = parser.parse_args(args)
+
+    if dump_all(args.vmlinux, args.output, args.format) is None:
+        return 1
+
+    return 0
+
+
+sys.exit(main(sys.argv[1:]))
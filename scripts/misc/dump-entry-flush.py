@@ -7,27 +7,28 @@ from dump import *
 
 
 def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump entry flush fixups').parse_args(args)
 
-    path = args[0]
+    path = args.vmlinux
     syms = read_symbols(path)
 
-    init_begin = find_symbol(syms, '__init_begin')
-    init_end = find_symbol(syms, '__init_end')
+    tables = []
+    for type in ['entry', 'scv_entry']:
+        table = read_fixup_table(path, '__%s_flush_fixup' % type)
+        table.add_symbols(syms, 'addr')
+        add_in_init(table, syms)
+        tables.append((type, table))
+
+    if args.format != 'text':
+        write_tables([t[1] for t in tables], args.format)
+        return 0
 
     try:
-        for type in ['entry', 'scv_entry']:
+        for type, table in tables:
             print("# Dumping %s flush fixups:" % type)
             print("# Fixup entry    Address          Symbol")
-            for entry_addr, addr in iter_fixup_section(path, '__%s_flush_fixup' % type):
-                in_init = ''
-                if init_begin and init_end:
-                    if init_begin <= addr and addr <= init_end:
-                        in_init = '# in .init section'
-
-                symbol, offset = find_addr(syms, addr)
+            for entry_addr, addr, symbol, offset, in_init in table.rows():
+                in_init = '# in .init section' if in_init else ''
                 print(f'{entry_addr:016x} {addr:016x} {symbol}+0x{offset:x} {in_init}')
     except (KeyboardInterrupt, BrokenPipeError):
         pass
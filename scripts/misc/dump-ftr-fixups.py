@@ -8,182 +8,51 @@ import subprocess
 from tempfile import mkstemp
 
 
-def iter_fixups(vmlinux_path, section):
-    start_addr, offset, size = read_section_info(vmlinux_path, section)
-    endian = get_endian(vmlinux_path)
-
-    f = open(vmlinux_path, 'rb')
-
-    fmt = 'qqqqqq'
-    if endian == 'little':
-        fmt = f'<{fmt}'
+def write_ranges_elf(f, elf, ranges):
+    # An ELF with each range as a separate section at address 0, so they can
+    # all be disassembled with one objdump, as if each were a separate binary.
+    names = [f'.r{i}' for i in range(len(ranges))]
+    shstrtab = b'\0.shstrtab\0' + b''.join(name.encode() + b'\0' for name in names)
+
+    if elf.bits == 64:
+        ehdr_fmt = '16sHHIQQQIHHHHHH'
+        shdr_fmt = 'IIQQQQIIQQ'
     else:
-        fmt = f'>{fmt}'
-
-    f.seek(offset)
-    data = f.read(size)
-
-    cur_addr = start_addr
-    for tupl in struct.iter_unpack(fmt, data):
-        mask = tupl[0]
-        ftr_val = tupl[1]
-
-        start = cur_addr + tupl[2]
-        end = cur_addr + tupl[3]
-        alt_start = cur_addr + tupl[4]
-        alt_end = cur_addr + tupl[5]
-        yield (cur_addr, mask, ftr_val, start, end, alt_start, alt_end)
-        cur_addr += 6 * 8
-
-
-cpu_features = [
-    (0x0000000000000001, 'CPU_FTR_COHERENT_ICACHE'),
-    (0x0000000000000002, 'CPU_FTR_ALTIVEC'),
-    (0x0000000000000004, 'CPU_FTR_DBELL'),
-    (0x0000000000000008, 'CPU_FTR_CAN_NAP'),
-    (0x0000000000000010, 'CPU_FTR_DEBUG_LVL_EXC'),
-    (0x0000000000000020, 'CPU_FTR_NODSISRALIGN'),
-    (0x0000000000000040, 'CPU_FTR_FPU_UNAVAILABLE'),
-    (0x0000000000000080, 'CPU_FTR_LWSYNC'),
-    (0x0000000000000100, 'CPU_FTR_NOEXECUTE'),
-    (0x0000000000000200, 'CPU_FTR_EMB_HV'),
-    (0x0000000000001000, 'CPU_FTR_REAL_LE'),
-    (0x0000000000002000, 'CPU_FTR_HVMODE'),
-    (0x0000000000008000, 'CPU_FTR_ARCH_206'),
-    (0x0000000000010000, 'CPU_FTR_ARCH_207S'),
-    (0x0000000000020000, 'CPU_FTR_ARCH_300'),
-    (0x0000000000040000, 'CPU_FTR_MMCRA'),
-    (0x0000000000080000, 'CPU_FTR_CTRL'),
-    (0x0000000000100000, 'CPU_FTR_SMT'),
-    (0x0000000000200000, 'CPU_FTR_PAUSE_ZERO'),
-    (0x0000000000400000, 'CPU_FTR_PURR'),
-    (0x0000000000800000, 'CPU_FTR_CELL_TB_BUG'),
-    (0x0000000001000000, 'CPU_FTR_SPURR'),
-    (0x0000000002000000, 'CPU_FTR_DSCR'),
-    (0x0000000004000000, 'CPU_FTR_VSX'),
-    (0x0000000008000000, 'CPU_FTR_SAO'),
-    (0x0000000010000000, 'CPU_FTR_CP_USE_DCBTZ'),
-    (0x0000000020000000, 'CPU_FTR_UNALIGNED_LD_STD'),
-    (0x0000000040000000, 'CPU_FTR_ASYM_SMT'),
-    (0x0000000080000000, 'CPU_FTR_STCX_CHECKS_ADDRESS'),
-    (0x0000000100000000, 'CPU_FTR_POPCNTB'),
-    (0x0000000200000000, 'CPU_FTR_POPCNTD'),
-    (0x0000000400000000, 'CPU_FTR_PKEY'),
-    (0x0000000800000000, 'CPU_FTR_VMX_COPY'),
-    (0x0000001000000000, 'CPU_FTR_TM'),
-    (0x0000002000000000, 'CPU_FTR_CFAR'),
-    (0x0000004000000000, 'CPU_FTR_HAS_PPR'),
-    (0x0000008000000000, 'CPU_FTR_DAWR'),
-    (0x0000010000000000, 'CPU_FTR_DABRX'),
-    (0x0000020000000000, 'CPU_FTR_PMAO_BUG'),
-    (0x0000080000000000, 'CPU_FTR_POWER9_DD2_1'),
-    (0x0000100000000000, 'CPU_FTR_P9_TM_HV_ASSIST'),
-    (0x0000200000000000, 'CPU_FTR_P9_TM_XER_SO_BUG'),
-    (0x0000400000000000, 'CPU_FTR_P9_TLBIE_STQ_BUG'),
-    (0x0000800000000000, 'CPU_FTR_P9_TIDR'),
-    (0x0001000000000000, 'CPU_FTR_P9_TLBIE_ERAT_BUG'),
-    (0x0002000000000000, 'CPU_FTR_P9_RADIX_PREFETCH_BUG'),
-    (0x0004000000000000, 'CPU_FTR_ARCH_31'),
-    (0x0008000000000000, 'CPU_FTR_DAWR1'),
-]
-
-def decode_ftr(features, value):
-    s = []
-    remainder = value
-    for mask, name in features:
-        if value & mask:
-            s.append(name)
-        remainder &= ~mask
-
-    if remainder:
-        s.append("UNKNOWN={:x}".format(remainder))
-
-    return ', '.join(s)
-
-
-def decode_cpu_ftr(value):
-    return decode_ftr(cpu_features, value)
-
-mmu_features = [
-    (0x00000001, 'MMU_FTR_HPTE_TABLE'),
-    (0x00000002, 'MMU_FTR_TYPE_8xx'),
-    (0x00000004, 'MMU_FTR_TYPE_40x'),
-    (0x00000008, 'MMU_FTR_TYPE_44x'),
-    (0x00000010, 'MMU_FTR_TYPE_FSL_E'),
-    (0x00000020, 'MMU_FTR_TYPE_47x'),
-    (0x00000040, 'MMU_FTR_TYPE_RADIX'),
-    (0x00000200, 'MMU_FTR_BOOK3S_KUAP'),
-    (0x00000400, 'MMU_FTR_BOOK3S_KUEP'),
-    (0x00000800, 'MMU_FTR_PKEY'),
-    (0x00002000, 'MMU_FTR_68_BIT_VA'),
-    (0x00004000, 'MMU_FTR_KERNEL_RO'),
-    (0x00008000, 'MMU_FTR_TLBIE_CROP_VA'),
-    (0x00010000, 'MMU_FTR_USE_HIGH_BATS'),
-    (0x00020000, 'MMU_FTR_BIG_PHYS'),
-    (0x00040000, 'MMU_FTR_USE_TLBIVAX_BCAST'),
-    (0x00080000, 'MMU_FTR_USE_TLBILX'),
-    (0x00100000, 'MMU_FTR_LOCK_BCAST_INVAL'),
-    (0x00200000, 'MMU_FTR_NEED_DTLB_SW_LRU'),
-    (0x00800000, 'MMU_FTR_USE_TLBRSRV'),
-    (0x01000000, 'MMU_FTR_USE_PAIRED_MAS'),
-    (0x02000000, 'MMU_FTR_NO_SLBIE_B'),
-    (0x04000000, 'MMU_FTR_16M_PAGE'),
-    (0x08000000, 'MMU_FTR_TLBIEL'),
-    (0x10000000, 'MMU_FTR_LOCKLESS_TLBIE'),
-    (0x20000000, 'MMU_FTR_CI_LARGE_PAGE'),
-    (0x40000000, 'MMU_FTR_1T_SEGMENT'),
-    (0x80000000, 'MMU_FTR_RADIX_KUAP'),
-]
-
-
-def decode_mmu_ftr(value):
-    return decode_ftr(mmu_features, value)
-
-
-fw_features = [
-    (0x0000000000000001, 'FW_FEATURE_PFT'),
-    (0x0000000000000002, 'FW_FEATURE_TCE'),
-    (0x0000000000000004, 'FW_FEATURE_SPRG0'),
-    (0x0000000000000008, 'FW_FEATURE_DABR'),
-    (0x0000000000000010, 'FW_FEATURE_COPY'),
-    (0x0000000000000020, 'FW_FEATURE_ASR'),
-    (0x0000000000000040, 'FW_FEATURE_DEBUG'),
-    (0x0000000000000080, 'FW_FEATURE_TERM'),
-    (0x0000000000000100, 'FW_FEATURE_PERF'),
-    (0x0000000000000200, 'FW_FEATURE_DUMP'),
-    (0x0000000000000400, 'FW_FEATURE_INTERRUPT'),
-    (0x0000000000000800, 'FW_FEATURE_MIGRATE'),
-    (0x0000000000001000, 'FW_FEATURE_PERFMON'),
-    (0x0000000000002000, 'FW_FEATURE_CRQ'),
-    (0x0000000000004000, 'FW_FEATURE_VIO'),
-    (0x0000000000008000, 'FW_FEATURE_RDMA'),
-    (0x0000000000010000, 'FW_FEATURE_LLAN'),
-    (0x0000000000020000, 'FW_FEATURE_BULK_REMOVE'),
-    (0x0000000000040000, 'FW_FEATURE_XDABR'),
-    (0x0000000000080000, 'FW_FEATURE_PUT_TCE_IND'),
-    (0x0000000000100000, 'FW_FEATURE_SPLPAR'),
-    (0x0000000000400000, 'FW_FEATURE_LPAR'),
-    (0x0000000000800000, 'FW_FEATURE_PS3_LV1'),
-    (0x0000000001000000, 'FW_FEATURE_HPT_RESIZE'),
-    (0x0000000002000000, 'FW_FEATURE_CMO'),
-    (0x0000000004000000, 'FW_FEATURE_VPHN'),
-    (0x0000000008000000, 'FW_FEATURE_XCMO'),
-    (0x0000000010000000, 'FW_FEATURE_OPAL'),
-    (0x0000000040000000, 'FW_FEATURE_SET_MODE'),
-    (0x0000000080000000, 'FW_FEATURE_BEST_ENERGY'),
-    (0x0000000100000000, 'FW_FEATURE_TYPE1_AFFINITY'),
-    (0x0000000200000000, 'FW_FEATURE_PRRN'),
-    (0x0000000400000000, 'FW_FEATURE_DRMEM_V2'),
-    (0x0000000800000000, 'FW_FEATURE_DRC_INFO'),
-    (0x0000001000000000, 'FW_FEATURE_BLOCK_REMOVE'),
-    (0x0000002000000000, 'FW_FEATURE_PAPR_SCM'),
-    (0x0000004000000000, 'FW_FEATURE_ULTRAVISOR'),
-    (0x0000008000000000, 'FW_FEATURE_STUFF_TCE'),
-]
-
-
-def decode_fw_ftr(value):
-    return decode_ftr(fw_features, value)
+        ehdr_fmt = '16sHHIIIIIHHHHHH'
+        shdr_fmt = 'IIIIIIIIII'
+
+    ehdr_size = struct.calcsize(ehdr_fmt)
+    shdr_size = struct.calcsize(shdr_fmt)
+
+    blobs = []
+    offset = ehdr_size
+    # Null section, then .shstrtab
+    shdrs = [(0,) * 10, (1, 3, 0, 0, offset, len(shstrtab), 0, 0, 1, 0)]
+    blobs.append(shstrtab)
+    offset += len(shstrtab)
+
+    name_offset = len(b'\0.shstrtab\0')
+    for name, (start, end) in zip(names, ranges):
+        data = elf.read(start, end - start)
+        # Allocated and writable, like the .data section of -b binary
+        shdrs.append((name_offset, 1, 3, 0, offset, len(data), 0, 0, 1, 0))
+        blobs.append(data)
+        offset += len(data)
+        name_offset += len(name) + 1
+
+    pad = -offset % 8
+    blobs.append(b'\0' * pad)
+    shoff = offset + pad
+
+    ident = b'\x7fELF' + bytes([1 if elf.bits == 32 else 2, 1 if elf.endian == 'little' else 2, 1])
+    f.write(struct.pack(elf.prefix + ehdr_fmt, ident, 1, elf.machine, 1, 0, 0, shoff, 0,
+                        ehdr_size, 0, 0, shdr_size, len(shdrs), 1))
+    for blob in blobs:
+        f.write(blob)
+    for shdr in shdrs:
+        f.write(struct.pack(elf.prefix + shdr_fmt, *shdr))
+
+    return names
 
 
 def run_objdump(path, endian):
@@ -192,37 +61,74 @@ def run_objdump(path, endian):
     else:
         flag = '-EB'
 
-    cmd = f'ppc64le-objdump -b binary -m powerpc -D {flag} {path}'
+    cmd = f'ppc64le-objdump -m powerpc -D {flag} {path}'
     out = check_output(cmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
-    lines = out.splitlines()
-    return lines[7:]
-
-
-def objdump_range(bin_file, path, endian, start, end):
+    return out.splitlines()
+
+
+def objdump_ranges(path, ranges):
+    # Disassemble each (start, end) range with a single objdump, returning the
+    # lines for each range as a separate objdump of just its bytes would.
+    elf = get_elf(path)
+    ranges = [r for r in ranges if elf.read(r[0], r[1] - r[0]) is not None]
+    if len(ranges) == 0:
+        return {}
+
+    fd, temp_path = mkstemp(suffix='.elf')
+    with os.fdopen(fd, 'wb') as temp:
+        names = write_ranges_elf(temp, elf, ranges)
+
+    try:
+        lines = run_objdump(temp_path, elf.endian)
+    finally:
+        os.unlink(temp_path)
+
+    by_name = {}
+    cur = None
+    skip = 0
+    for line in lines:
+        if line.startswith('Disassembly of section '):
+            # The blank line before the heading isn't part of the previous section
+            if cur and cur[-1] == '':
+                cur.pop()
+            cur = by_name.setdefault(line[len('Disassembly of section '):-1], [])
+            # Skip the blank line and the <.rN>: label
+            skip = 2
+        elif skip:
+            skip -= 1
+        elif cur is not None:
+            cur.append(line)
+
+    return {r: by_name.get(name, []) for r, name in zip(ranges, names)}
+
+
+def print_range(disasm, start, end):
     if start == end:
         print("Warning: empty range {:x}".format(start))
-        return []
+        return
 
-    offset = find_section_by_addr(path, start, end)
+    lines = disasm.get((start, end))
+    if lines is None:
+        print("Warning: range {:x}-{:x} not in vmlinux".format(start, end))
+        return
 
-    bin_file.seek(offset)
-    data = bin_file.read(end - start)
+    for line in lines:
+        print(f'                   {line}')
 
-    fd, temp_path = mkstemp()
-    temp = os.fdopen(fd, 'wb')
-    temp.write(data)
-    temp.close()
 
-    s = run_objdump(temp_path, endian)
-    os.unlink(temp_path)
-    return s
+def dump_fixups(path, syms, table, decode_fn=None):
+    fixups = list(zip(*[table[c] for c in ['entry', 'mask', 'value', 'start', 'end', 'alt_start', 'alt_end']]))
 
+    ranges = set()
+    for (entry_addr, mask, value, start, end, alt_start, alt_end) in fixups:
+        if end - start > 0:
+            ranges.add((start, end))
+        if alt_end - alt_start > 0:
+            ranges.add((alt_start, alt_end))
 
-def dump_fixups(path, syms, section, decode_fn=None):
-    bin_file = open(path, 'rb')
-    endian = get_endian(path)
+    disasm = objdump_ranges(path, sorted(ranges))
 
-    for (entry_addr, mask, value, start, end, alt_start, alt_end) in iter_fixups(path, section):
+    for (entry_addr, mask, value, start, end, alt_start, alt_end) in fixups:
         start_sym, start_offset = find_addr(syms, start)
         end_sym, end_offset = find_addr(syms, end)
         alt_start_sym, alt_start_offset = find_addr(syms, alt_start)
@@ -250,36 +156,33 @@ def dump_fixups(path, syms, section, decode_fn=None):
         print(f'                 from {start:016x} {start_sym}+0x{start_offset:x}')
         print(f'                   to {end:016x} {end_sym}+0x{end_offset:x}')
 
-        for line in objdump_range(bin_file, path, endian, start, end):
-            print(f'                   {line}')
+        print_range(disasm, start, end)
 
         if alt_end - alt_start > 0:
             print(f'            alt_start {alt_start:016x} {alt_start_sym}+0x{alt_start_offset:x}')
             print(f'              alt_end {alt_end:016x} {alt_end_sym}+0x{alt_end_offset:x}')
 
-            for line in objdump_range(bin_file, path, endian, alt_start, alt_end):
-                print(f'                   {line}')
+            print_range(disasm, alt_start, alt_end)
 
         print()
 
 
 
 def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump CPU, MMU and firmware feature fixup entries').parse_args(args)
 
-    path = args[0]
+    path = args.vmlinux
     syms = read_symbols(path)
 
-    print("# Dumping CPU feature fixup entries")
-    dump_fixups(path, syms, '__ftr_fixup', decode_cpu_ftr)
+    tables = [read_ftr_fixups(path, section, syms, decode_fn) for _, section, decode_fn in ftr_fixup_sections]
 
-    print("# Dumping MMU feature fixup entries")
-    dump_fixups(path, syms, '__mmu_ftr_fixup', decode_mmu_ftr)
+    if args.format != 'text':
+        write_tables(tables, args.format)
+        return 0
 
-    print("# Dumping Firmware feature fixup entries")
-    dump_fixups(path, syms, '__fw_ftr_fixup', decode_fw_ftr)
+    for (name, section, decode_fn), table in zip(ftr_fixup_sections, tables):
+        print(f"# Dumping {name} feature fixup entries")
+        dump_fixups(path, syms, table, decode_fn)
 
     return 0
 
@@ -7,19 +7,23 @@ from dump import *
 
 
 def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump lwsync fixup sites').parse_args(args)
 
-    path = args[0]
+    path = args.vmlinux
     syms = read_symbols(path)
 
+    table = read_fixup_table(path, '__lwsync_fixup')
+    table.add_symbols(syms, 'addr')
+
+    if args.format != 'text':
+        write_tables([table], args.format)
+        return 0
+
     print("# Dumping lwsync fixup sites")
     print("# Fixup entry    Address          Symbol")
 
     try:
-        for entry_addr, addr in iter_fixup_section(path, '__lwsync_fixup'):
-            symbol, offset = find_addr(syms, addr)
+        for entry_addr, addr, symbol, offset in table.rows():
             print(f'{entry_addr:016x} {addr:016x} {symbol}+0x{offset:x}')
     except (KeyboardInterrupt, BrokenPipeError):
         pass
@@ -6,55 +6,24 @@ sys.path.append(f'{os.path.dirname(sys.argv[0])}/../../lib')
 from dump import *
 
 
-def iter_mcount(vmlinux_path, symbol_map):
-    start_vaddr = find_symbol(symbol_map, '__start_mcount_loc')
-    end_vaddr = find_symbol(symbol_map, '__stop_mcount_loc')
-
-    endian = get_endian(vmlinux_path)
-
-    if endian == 'little':
-        fmt = '<Q'
-        inst_fmt = '<I'
-    else:
-        fmt = '>Q'
-        inst_fmt = '>I'
-
-    offset = find_section_by_addr(vmlinux_path, start_vaddr, end_vaddr)
-    if offset is None:
-        return
-
-    f = open(vmlinux_path, 'rb')
-    f.seek(offset)
-    data = f.read(end_vaddr - start_vaddr)
-
-    addr = start_vaddr
-    for tupl in struct.iter_unpack(fmt, data):
-        val = tupl[0]
-
-        offset = find_section_by_addr(vmlinux_path, val, val + 4)
-        f.seek(offset)
-        instruction = struct.unpack(inst_fmt, f.read(4))[0]
-        yield (addr, val, instruction)
-        addr += 8
-
-
 def main(args):
-    if len(args) == 0:
-        print(f'Usage: {sys.argv[0]} <vmlinux>', file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump mcount records').parse_args(args)
 
-    path = args[0]
+    path = args.vmlinux
     syms = read_symbols(path)
 
+    table = read_mcount(path, syms)
+    table.add_symbols(syms, 'addr')
+
+    if args.format != 'text':
+        write_tables([table], args.format)
+        return 0
+
     print("# Dumping mcount records")
     print("# Fixup entry    Address          Inst     Symbol")
 
-    start = find_symbol(syms, '__start_mcount_loc')
-    end = find_symbol(syms, '__stop_mcount_loc')
-
     try:
-        for (entry_addr, mcount_addr, instruction) in iter_mcount(path, syms):
-            symbol, offset = find_addr(syms, mcount_addr)
+        for (entry_addr, mcount_addr, instruction, symbol, offset) in table.rows():
             print(f'{entry_addr:016x} {mcount_addr:016x} {instruction:08x} {symbol}+0x{offset:x}')
     except (KeyboardInterrupt, BrokenPipeError):
         pass
@@ -7,27 +7,25 @@ from dump import *
 
 
 def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump barrier_nospec fixup sites').parse_args(args)
 
-    path = args[0]
+    path = args.vmlinux
     syms = read_symbols(path)
 
-    init_begin = find_symbol(syms, '__init_begin')
-    init_end = find_symbol(syms, '__init_end')
+    table = read_fixup_table(path, '__spec_barrier_fixup')
+    table.add_symbols(syms, 'addr')
+    add_in_init(table, syms)
+
+    if args.format != 'text':
+        write_tables([table], args.format)
+        return 0
 
     print("# Dumping barrier_nospec fixup sites")
     print("# Fixup entry    Address          Symbol")
 
     try:
-        for entry_addr, addr in iter_nospec_fixups(path):
-            in_init = ''
-            if init_begin and init_end:
-                if init_begin <= addr and addr <= init_end:
-                    in_init = '# in .init section'
-
-            symbol, offset = find_addr(syms, addr)
+        for entry_addr, addr, symbol, offset, in_init in table.rows():
+            in_init = '# in .init section' if in_init else ''
             print(f'{entry_addr:016x} {addr:016x} {symbol}+0x{offset:x} {in_init}')
     except (KeyboardInterrupt, BrokenPipeError):
         pass
@@ -6,26 +6,10 @@ sys.path.append(f'{os.path.dirname(sys.argv[0])}/../../lib')
 from dump import *
 
 
-def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
-
-    path = args[0]
-    syms = read_symbols(path)
-
-    print("# Dumping RFI fixup entries")
-    print("# Fixup entry    Address          Symbol")
-    patched_rfids = {}
-    for entry_addr, addr in iter_fixup_section(path, '__rfi_flush_fixup'):
-        rfi_addr = addr + (4 * 3)
-        patched_rfids[rfi_addr] = True
-
-        symbol, offset = find_addr(syms, addr)
-        print(f'{entry_addr:016x} {addr:016x} {symbol}+0x{offset:x}')
-
+def read_rfids(path, syms, patched_rfids):
+    addrs = array('Q')
+    instrs = []
     patched = []
-    unpatched = []
     cmd = f'ppc64le-objdump -d {path}'
     output = check_output(cmd.split())
     for line in output.decode('utf-8').splitlines():
@@ -34,12 +18,42 @@ def main(args):
 
         # c000000000001b78:	24 00 00 4c 	rfid
         words = line.split()
-        addr = int(words[0][:-1], 16)
-        instr = words[-1]
+        addrs.append(int(words[0][:-1], 16))
+        instrs.append(words[-1])
+        patched.append(addrs[-1] in patched_rfids)
 
-        symbol, offset = find_addr(syms, addr)
+    table = Table('rfids', [('addr', addrs), ('instruction', instrs)], hex=['addr'])
+    table.add_symbols(syms, 'addr')
+    table.add_column('patched', patched)
+    return table
+
+
+def main(args):
+    args = dump_arg_parser('Dump RFI flush fixups, and (h)rfids with and without them').parse_args(args)
+
+    path = args.vmlinux
+    syms = read_symbols(path)
+
+    fixups = read_fixup_table(path, '__rfi_flush_fixup')
+    fixups.add_symbols(syms, 'addr')
+
+    patched_rfids = set(addr + (4 * 3) for addr in fixups['addr'])
+    rfids = read_rfids(path, syms, patched_rfids)
+
+    if args.format != 'text':
+        write_tables([fixups, rfids], args.format)
+        return 0
+
+    print("# Dumping RFI fixup entries")
+    print("# Fixup entry    Address          Symbol")
+    for entry_addr, addr, symbol, offset in fixups.rows():
+        print(f'{entry_addr:016x} {addr:016x} {symbol}+0x{offset:x}')
+
+    patched = []
+    unpatched = []
+    for addr, instr, symbol, offset, is_patched in rfids.rows():
         s = f'{instr:5} at {addr:016x} {symbol}+0x{offset:x}'
-        if addr in patched_rfids:
+        if is_patched:
             patched.append(s)
         else:
             unpatched.append(s)
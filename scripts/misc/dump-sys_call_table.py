@@ -7,11 +7,9 @@ from dump import *
 
 
 def main(args):
-    if len(args) == 0:
-        print("Usage: %s <vmlinux>" % sys.argv[0], file=sys.stderr)
-        return 1
+    args = dump_arg_parser('Dump the system call table').parse_args(args)
 
-    vmlinux_path = args[0]
+    vmlinux_path = args.vmlinux
     syms = read_symbols(vmlinux_path)
 
     start_vaddr, size = find_symbol_and_size(syms, 'sys_call_table')
@@ -23,39 +21,22 @@ def main(args):
         print("Error: couldn't find size of sys_call_table?!")
         return 1
 
-    endian = get_endian(vmlinux_path)
-
-    if endian == 'little':
-        fmt = '<Q'
-        inst_fmt = '<I'
-    else:
-        fmt = '>Q'
-        inst_fmt = '>I'
-
-    end_vaddr = start_vaddr + size
-    offset = find_section_by_addr(vmlinux_path, start_vaddr, end_vaddr)
-    if offset is None:
+    table = read_sys_call_table(vmlinux_path, syms)
+    if table is None:
         return
 
-    f = open(vmlinux_path, 'rb')
-    f.seek(offset)
-    data = f.read(end_vaddr - start_vaddr)
+    table.add_symbols(syms, 'addr')
+
+    if args.format != 'text':
+        write_tables([table], args.format)
+        return 0
 
     print("# Dumping system call table")
     print("# Entry          Address          Symbol")
 
-    addr = start_vaddr
-
     try:
-        num = 0
-        for tupl in struct.iter_unpack(fmt, data):
-            val = tupl[0]
-
-            symbol, offset = find_addr(syms, val)
+        for (num, addr, val, symbol, offset) in table.rows():
             print(f'{num:03} {addr:016x} {val:016x} {symbol}+0x{offset:x}')
-            addr += 8
-            num += 1
-
     except (KeyboardInterrupt, BrokenPipeError):
         pass
 